@@ -1 +1,7 @@
-broker_url = 'redis://127.0.0.1:6379/3'
\ No newline at end of file
+broker_url = 'redis://127.0.0.1:6379/3'
+
+# 下单任务使用单独的队列，通过该队列worker的并发数限制同时写数据库的下单数量
+# celery -A celery_tasks.main worker -Q orders -c 4
+task_routes = {
+    'create_order': {'queue': 'orders'},
+}
@@ -14,4 +14,4 @@ celery_app.config_from_object('celery_tasks.config')
 
 
 # 让celery worker启动时自动发现有哪些任务函数
-celery_app.autodiscover_tasks(['celery_tasks.sms', 'celery_tasks.email', 'celery_tasks.html'])
\ No newline at end of file
+celery_app.autodiscover_tasks(['celery_tasks.sms', 'celery_tasks.email', 'celery_tasks.html', 'celery_tasks.orders'])
\ No newline at end of file
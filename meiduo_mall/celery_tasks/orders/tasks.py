@@ -0,0 +1,43 @@
+# 封装celery任务函数
+import logging
+
+from rest_framework import serializers
+
+from orders.serializers import OrderSerializer
+from orders.tickets import update_ticket, TICKET_STATUS_PROCESSING, TICKET_STATUS_SUCCESS, TICKET_STATUS_FAILED
+from users.models import User
+
+from celery_tasks.main import celery_app
+
+# 获取日志器
+logger = logging.getLogger('django')
+
+
+def _get_error_message(detail):
+    """获取校验错误中的第一条错误信息"""
+    while isinstance(detail, (list, dict)):
+        if not detail:
+            return '下单失败'
+        detail = list(detail.values())[0] if isinstance(detail, dict) else detail[0]
+
+    return str(detail)
+
+
+@celery_app.task(name='create_order')
+def create_order(ticket_id, user_id, address_id, pay_method):
+    """异步下单，执行与同步下单相同的订单保存逻辑，并将结果保存到下单凭证中"""
+    update_ticket(ticket_id, TICKET_STATUS_PROCESSING)
+
+    try:
+        user = User.objects.get(id=user_id)
+
+        serializer = OrderSerializer(data={'address': address_id, 'pay_method': pay_method}, context={'user': user})
+        serializer.is_valid(raise_exception=True)
+        order = serializer.save()
+    except serializers.ValidationError as e:
+        update_ticket(ticket_id, TICKET_STATUS_FAILED, message=_get_error_message(e.detail))
+    except Exception as e:
+        logger.error('异步下单异常：[ticket_id: %s user_id: %s] %s' % (ticket_id, user_id, e))
+        update_ticket(ticket_id, TICKET_STATUS_FAILED, message='下单失败')
+    else:
+        update_ticket(ticket_id, TICKET_STATUS_SUCCESS, order_id=order.order_id)
@@ -1,5 +1,19 @@
+import logging
+
 from django.apps import AppConfig
 
+logger = logging.getLogger('django')
+
 
 class CartConfig(AppConfig):
     name = 'cart'
+
+    def ready(self):
+        """服务启动时预先加载购物车lua脚本，redis不可用时不影响服务启动"""
+        from redis.exceptions import RedisError
+        from cart.storage import load_cart_scripts
+
+        try:
+            load_cart_scripts()
+        except RedisError as e:
+            logger.warning('购物车lua脚本预加载失败: %s' % e)
@@ -1,2 +1,20 @@
 # 购物车cookie的有效期
 CART_COOKIE_EXPIRES = 365 * 24 * 60 * 60
+
+# 购物车cookie数据格式的版本号
+CART_COOKIE_VERSION = 1
+
+# 购物车cookie数据HMAC签名的字节数
+CART_COOKIE_SIGNATURE_LENGTH = 12
+
+# 购物车批量操作一次最多包含的操作数量
+CART_BATCH_OPERATIONS_LIMIT = 100
+
+# 登录用户购物车中商品种类数的上限，不超过redis hash listpack编码的默认上限(128)
+CART_MAX_ITEMS = 100
+
+# 登录用户购物车redis记录的有效期，每次访问购物车时刷新
+CART_REDIS_EXPIRES = 30 * 24 * 60 * 60
+
+# 整理购物车记录时每次SCAN返回key数量的参考值
+CART_COMPACT_SCAN_COUNT = 500
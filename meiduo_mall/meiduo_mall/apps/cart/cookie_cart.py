@@ -0,0 +1,173 @@
+# 未登录用户cookie购物车记录的编解码
+#
+# cookie中保存的数据格式(urlsafe base64编码，不含'='):
+# +---------+-----------------------------------------------+------------------+
+# | 版本号   | 商品记录                                         | HMAC签名          |
+# | 1 byte  | varint(sku_id差值) varint(count << 1 | selected) | 12 bytes         |
+# +---------+-----------------------------------------------+------------------+
+# 商品记录按sku_id升序排列，sku_id保存与前一个sku_id的差值，数值使用varint编码，
+# 一条记录通常只需要2~4个字节，签名防止客户端篡改购物车数据
+import base64
+import hashlib
+import hmac
+import io
+import pickle
+
+from django.conf import settings
+
+from cart import constants
+
+
+class CookieCartError(Exception):
+    """cookie购物车数据无效"""
+    pass
+
+
+def _encode_varint(value, buf):
+    """将非负整数按varint编码追加到buf中"""
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _decode_varint(data, pos):
+    """从data的pos位置解码一个varint，返回(value, 下一个位置)"""
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise CookieCartError('购物车数据不完整')
+
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+
+        shift += 7
+        if shift > 63:
+            raise CookieCartError('购物车数据格式错误')
+
+
+def _sign(data):
+    key = hashlib.sha256(('cart.cookie:%s' % settings.SECRET_KEY).encode()).digest()
+    return hmac.new(key, data, hashlib.sha256).digest()[:constants.CART_COOKIE_SIGNATURE_LENGTH]
+
+
+def dumps(cart_dict):
+    """
+    将购物车数据编码为cookie字符串
+    cart_dict: {
+        <sku_id>: {
+            'count': <count>,
+            'selected': <selected>
+        },
+        ...
+    }
+    """
+    buf = bytearray([constants.CART_COOKIE_VERSION])
+
+    prev_sku_id = 0
+    for sku_id in sorted(cart_dict):
+        count_selected = cart_dict[sku_id]
+        _encode_varint(sku_id - prev_sku_id, buf)
+        _encode_varint(count_selected['count'] << 1 | int(bool(count_selected['selected'])), buf)
+        prev_sku_id = sku_id
+
+    data = bytes(buf)
+    return base64.urlsafe_b64encode(data + _sign(data)).rstrip(b'=').decode()
+
+
+def _loads(cookie_cart):
+    """解析当前版本的cookie购物车数据，数据无效时抛出CookieCartError"""
+    try:
+        raw = base64.urlsafe_b64decode(cookie_cart + '=' * (-len(cookie_cart) % 4))
+    except (ValueError, TypeError):
+        raise CookieCartError('购物车数据编码错误')
+
+    data, signature = raw[:-constants.CART_COOKIE_SIGNATURE_LENGTH], raw[-constants.CART_COOKIE_SIGNATURE_LENGTH:]
+
+    if not data or data[0] != constants.CART_COOKIE_VERSION:
+        raise CookieCartError('购物车数据版本错误')
+
+    if not hmac.compare_digest(signature, _sign(data)):
+        raise CookieCartError('购物车数据签名错误')
+
+    cart_dict = {}
+    sku_id = 0
+    pos = 1
+    while pos < len(data):
+        delta, pos = _decode_varint(data, pos)
+        value, pos = _decode_varint(data, pos)
+        sku_id += delta
+        cart_dict[sku_id] = {
+            'count': value >> 1,
+            'selected': bool(value & 1)
+        }
+
+    return cart_dict
+
+
+class _LegacyCartUnpickler(pickle.Unpickler):
+    """旧版cookie购物车数据的反序列化器，只允许dict/int/bool等基本类型，禁止加载任何类和函数"""
+    def find_class(self, module, name):
+        raise CookieCartError('购物车数据包含非法内容')
+
+
+def _loads_legacy(cookie_cart):
+    """解析旧版base64(pickle)格式的cookie购物车数据，升级过渡期间使用"""
+    try:
+        cart_dict = _LegacyCartUnpickler(io.BytesIO(base64.b64decode(cookie_cart))).load()
+    except Exception:
+        raise CookieCartError('购物车数据格式错误')
+
+    if not isinstance(cart_dict, dict):
+        raise CookieCartError('购物车数据格式错误')
+
+    # 校验数据结构，只保留合法的商品记录
+    result = {}
+    for sku_id, count_selected in cart_dict.items():
+        try:
+            sku_id = int(sku_id)
+            count = int(count_selected['count'])
+            selected = bool(count_selected['selected'])
+        except (KeyError, TypeError, ValueError):
+            raise CookieCartError('购物车数据格式错误')
+
+        if sku_id > 0 and count > 0:
+            result[sku_id] = {
+                'count': count,
+                'selected': selected
+            }
+
+    return result
+
+
+def loads(cookie_cart):
+    """
+    将cookie字符串解码为购物车数据，兼容旧版pickle格式的数据
+    cookie数据无效或被篡改时返回空购物车
+    """
+    if not cookie_cart:
+        return {}
+
+    try:
+        return _loads(cookie_cart)
+    except CookieCartError:
+        pass
+
+    try:
+        return _loads_legacy(cookie_cart)
+    except CookieCartError:
+        return {}
+
+
+def get_cookie_cart(request):
+    """获取请求cookie中的购物车数据"""
+    return loads(request.COOKIES.get('cart'))
+
+
+def set_cookie_cart(response, cart_dict):
+    """在响应中设置cookie购物车数据"""
+    response.set_cookie('cart', dumps(cart_dict), max_age=constants.CART_COOKIE_EXPIRES)
@@ -0,0 +1,58 @@
+import re
+import time
+
+from django_redis import get_redis_connection
+
+from cart import constants
+from cart.storage import CartRedisStorage
+
+# 登录用户购物车相关的key: cart_v2_<user_id>, cart_summary_<user_id>, cart_touch_<user_id>
+CART_KEY_PATTERN = re.compile(r'^cart_(?:v2|summary|touch)_(\d+)$')
+
+
+def _memory_usage(redis_conn, keys):
+    """获取key占用的内存字节数之和，key不存在时为0"""
+    pl = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pl.execute_command('MEMORY', 'USAGE', key)
+    return sum(size or 0 for size in pl.execute())
+
+
+def compact_carts():
+    """
+    整理redis中登录用户的购物车记录:
+    1. 通过SCAN遍历购物车相关的key，不阻塞redis
+    2. 对每个用户的购物车执行整理脚本: 淘汰超过上限的商品，清理空购物车遗留的key，给没有过期时间的key设置过期时间
+    3. 统计整理前后的内存占用，输出回收的内存
+    """
+    print('%s: compact_carts' % time.ctime())
+    redis_conn = get_redis_connection('cart')
+
+    # 同一个用户的多个key可能都被SCAN返回，每个用户只整理一次
+    user_ids = set()
+    evicted = 0
+    removed = 0
+    reclaimed = 0
+
+    # 1. 通过SCAN遍历购物车相关的key，不阻塞redis
+    for key in redis_conn.scan_iter(match='cart_*', count=constants.CART_COMPACT_SCAN_COUNT):
+        match = CART_KEY_PATTERN.match(key.decode())
+        if not match or match.group(1) in user_ids:
+            continue
+
+        user_id = match.group(1)
+        user_ids.add(user_id)
+
+        # 2. 对每个用户的购物车执行整理脚本
+        cart_storage = CartRedisStorage(user_id)
+        before = _memory_usage(redis_conn, cart_storage.keys)
+        user_evicted, user_removed = cart_storage.compact()
+        after = _memory_usage(redis_conn, cart_storage.keys)
+
+        evicted += user_evicted
+        removed += user_removed
+        reclaimed += before - after
+
+    # 3. 统计整理前后的内存占用，输出回收的内存
+    print('整理购物车%s个，淘汰商品%s个，清理操作时间记录%s条，回收内存%s字节' % (
+        len(user_ids), evicted, removed, reclaimed))
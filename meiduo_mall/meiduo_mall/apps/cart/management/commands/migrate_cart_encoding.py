@@ -0,0 +1,35 @@
+import re
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from cart.storage import CartRedisStorage
+
+
+class Command(BaseCommand):
+    """
+    将redis中旧格式的购物车记录(cart_<user_id> hash + cart_selected_<user_id> set)
+    在线转换为新格式(cart_v2_<user_id> hash)
+    python manage.py migrate_cart_encoding
+    """
+    help = '将旧格式的购物车记录转换为合并数量和勾选状态的新格式'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scan-count', type=int, default=500, help='每次SCAN返回key数量的参考值')
+
+    def handle(self, *args, **options):
+        redis_conn = get_redis_connection('cart')
+
+        users = 0
+        items = 0
+        # 旧格式购物车hash的key: cart_<user_id>
+        for key in redis_conn.scan_iter(match='cart_[0-9]*', count=options['scan_count']):
+            key = key.decode()
+            if not re.match(r'^cart_\d+$', key):
+                continue
+
+            user_id = key[len('cart_'):]
+            items += CartRedisStorage(user_id).migrate()
+            users += 1
+
+        self.stdout.write('转换完成: 用户购物车%s个，商品记录%s条' % (users, items))
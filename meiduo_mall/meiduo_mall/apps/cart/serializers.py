@@ -1,27 +1,35 @@
 from rest_framework import serializers
 
+from cart import constants
 from goods.models import SKU
+from goods.stock_index import get_sku_stock, get_sku_stocks
 
 
 class CartSerializer(serializers.Serializer):
     """购物车序列化器类"""
     sku_id = serializers.IntegerField(label='SKU商品ID')
-    count = serializers.IntegerField(label='数量')
+    count = serializers.IntegerField(label='数量', min_value=1)
     selected = serializers.BooleanField(label='勾选状态', default=True)
 
     def validate(self, attrs):
         # sku_id商品是否存在
         sku_id = attrs['sku_id']
 
-        try:
-            sku = SKU.objects.get(id=sku_id)
-        except SKU.DoesNotExist:
+        count = attrs['count']
+
+        # 从商品库存索引中获取商品的库存和上架状态
+        stock = get_sku_stock(sku_id, count)
+
+        if stock is None:
             raise serializers.ValidationError('商品不存在')
 
-        # 商品库存是否足够
-        count = attrs['count']
+        stock, is_launched = stock
 
-        if count > sku.stock:
+        if not is_launched:
+            raise serializers.ValidationError('商品已下架')
+
+        # 商品库存是否足够
+        if count > stock:
             raise serializers.ValidationError('商品库存不足')
 
         return attrs
@@ -43,9 +51,7 @@ class CartDelSerializer(serializers.Serializer):
 
     def validate_sku_id(self, value):
         # sku_id对应商品是否存在
-        try:
-            sku = SKU.objects.get(id=value)
-        except SKU.DoesNotExist:
+        if get_sku_stock(value) is None:
             raise serializers.ValidationError('商品不存在')
 
         return value
@@ -54,3 +60,85 @@ class CartDelSerializer(serializers.Serializer):
 class CartSelectSerializer(serializers.Serializer):
     """购物车记录全选的序列化器类"""
     selected = serializers.BooleanField(label='勾选状态')
+    # 不传时设置全部商品的勾选状态，传递时只设置这些商品的勾选状态
+    sku_ids = serializers.ListField(label='SKU商品ID列表', child=serializers.IntegerField(), required=False)
+
+    def validate_sku_ids(self, value):
+        if not value:
+            raise serializers.ValidationError('商品列表不能为空')
+
+        if len(value) > constants.CART_MAX_ITEMS:
+            raise serializers.ValidationError('商品数量超过上限')
+
+        return value
+
+
+class CartSummarySerializer(serializers.Serializer):
+    """购物车汇总数据序列化器类"""
+    total_count = serializers.IntegerField(label='商品总数量')
+    selected_count = serializers.IntegerField(label='勾选商品总数量')
+    selected_amount = serializers.DecimalField(label='勾选商品总金额', max_digits=12, decimal_places=2)
+
+
+class CartOperationSerializer(serializers.Serializer):
+    """购物车批量操作中单个操作的序列化器类"""
+    ACTION_CHOICES = ('add', 'update', 'delete')
+
+    action = serializers.ChoiceField(label='操作类型', choices=ACTION_CHOICES)
+    sku_id = serializers.IntegerField(label='SKU商品ID')
+    count = serializers.IntegerField(label='数量', min_value=1, required=False)
+    selected = serializers.BooleanField(label='勾选状态', default=True)
+
+    def validate(self, attrs):
+        # 添加和修改操作必须传递数量
+        if attrs['action'] != 'delete' and 'count' not in attrs:
+            raise serializers.ValidationError('缺少商品数量')
+
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    """购物车批量操作序列化器类"""
+    operations = CartOperationSerializer(label='操作列表', many=True)
+
+    def validate_operations(self, value):
+        if not value:
+            raise serializers.ValidationError('操作列表不能为空')
+
+        if len(value) > constants.CART_BATCH_OPERATIONS_LIMIT:
+            raise serializers.ValidationError('操作数量超过上限')
+
+        return value
+
+    def validate(self, attrs):
+        operations = attrs['operations']
+
+        # 每个商品的最大购买数量，用于库存校验
+        counts = {}
+        for operation in operations:
+            sku_id = operation['sku_id']
+            counts[sku_id] = max(counts.get(sku_id, 0), operation.get('count', 0))
+
+        # 一次获取所有商品的库存和上架状态
+        stocks = get_sku_stocks(counts.keys(), counts)
+
+        for operation in operations:
+            stock = stocks.get(operation['sku_id'])
+
+            # sku_id商品是否存在
+            if stock is None:
+                raise serializers.ValidationError('商品不存在')
+
+            if operation['action'] == 'delete':
+                continue
+
+            stock, is_launched = stock
+
+            if not is_launched:
+                raise serializers.ValidationError('商品已下架')
+
+            # 商品库存是否足够
+            if operation['count'] > stock:
+                raise serializers.ValidationError('商品库存不足')
+
+        return attrs
@@ -0,0 +1,619 @@
+# 登录用户redis购物车记录的存储层
+# 每个购物车操作都通过一个预先注册的lua脚本完成，一次EVALSHA即可原子地修改商品数量和勾选状态
+#
+# 购物车记录保存在一个redis hash中: cart_v2_<user_id>
+# {
+#     '<sku_id>': '<count>',  # 正数: 勾选，负数: 未勾选
+#     ...
+# }
+# 商品数量和勾选状态合并在一个整数中，读取购物车只需一次HGETALL，
+# 并且field和value都是较短的整数，小购物车可以保持redis hash的listpack紧凑编码
+#
+# 购物车的汇总数据保存在另一个redis hash中: cart_summary_<user_id>
+# {
+#     'total_count': '<商品总数量>',
+#     'selected_count': '<勾选商品总数量>',
+#     'selected_amount': '<勾选商品总金额(分)>',
+#     'price_version': '<计算金额时商品价格的版本>',
+#     'price_<sku_id>': '<商品单价(分)>',
+#     ...
+# }
+# 每次修改购物车记录时在同一个脚本中增量更新汇总数据，获取汇总数据不需要查询商品
+#
+# 每个商品最后一次添加或修改的时间保存在一个redis zset中: cart_touch_<user_id>
+# {
+#     '<sku_id>': <timestamp>,
+#     ...
+# }
+# 商品种类数超过上限时淘汰最久未操作的商品，购物车的3个key在每次访问时刷新过期时间，
+# 长期未访问的购物车(已注销用户、机器人账号等)由redis自动删除
+import time
+from decimal import Decimal
+
+from django_redis import get_redis_connection
+
+from cart import constants
+from goods.cache import get_sku_snapshots, get_sku_price_version
+
+
+# 各个购物车脚本共用的lua函数
+# KEYS: cart_v2_<user_id>, cart_summary_<user_id>, cart_touch_<user_id>
+# ARGV: now, max_items, expires, ...(各个脚本自己的参数从ARGV[4]开始)
+CART_LUA_FUNCTIONS = """
+local now = tonumber(ARGV[1])
+local max_items = tonumber(ARGV[2])
+local expires = tonumber(ARGV[3])
+
+-- 设置购物车记录的值(value为nil或0时删除该记录)，并增量更新汇总数据
+-- price: 商品单价(分)，为nil时使用汇总数据中保存的单价
+local function cart_set(sku_id, value, price)
+    local origin = tonumber(redis.call('hget', KEYS[1], sku_id) or '0')
+    local price_field = 'price_' .. sku_id
+    local origin_price = tonumber(redis.call('hget', KEYS[2], price_field) or '0')
+    price = tonumber(price or origin_price)
+
+    local total = -math.abs(origin)
+    local selected = 0
+    local amount = 0
+    if origin > 0 then
+        selected = -origin
+        amount = -origin * origin_price
+    end
+
+    if value == nil or value == 0 then
+        redis.call('hdel', KEYS[1], sku_id)
+        redis.call('hdel', KEYS[2], price_field)
+        redis.call('zrem', KEYS[3], sku_id)
+    else
+        redis.call('hset', KEYS[1], sku_id, value)
+        redis.call('hset', KEYS[2], price_field, price)
+        total = total + math.abs(value)
+        if value > 0 then
+            selected = selected + value
+            amount = amount + value * price
+        end
+    end
+
+    redis.call('hincrby', KEYS[2], 'total_count', total)
+    redis.call('hincrby', KEYS[2], 'selected_count', selected)
+    redis.call('hincrby', KEYS[2], 'selected_amount', amount)
+    return value
+end
+
+-- 记录商品的操作时间，商品种类数超过上限时淘汰最久未操作的商品
+-- 同一秒内操作的商品分数相同，按sku_id排序，当前商品可能排在最前面，此时跳过当前商品淘汰下一个
+local function cart_touch(sku_id)
+    redis.call('zadd', KEYS[3], now, sku_id)
+    while redis.call('hlen', KEYS[1]) > max_items do
+        local oldest = redis.call('zrange', KEYS[3], 0, 1)
+        local victim = oldest[1]
+        if victim == sku_id then
+            victim = oldest[2]
+        end
+        if not victim then
+            break
+        end
+        cart_set(victim, nil, nil)
+    end
+end
+
+-- 刷新购物车各个key的过期时间
+local function cart_expire()
+    for i = 1, #KEYS do
+        redis.call('expire', KEYS[i], expires)
+    end
+end
+
+-- 添加购物车记录：数量累加，勾选时设置为勾选，未勾选时保持原来的勾选状态(新商品为未勾选)
+local function cart_add(sku_id, count, selected, price)
+    local origin = tonumber(redis.call('hget', KEYS[1], sku_id) or '0')
+    count = math.abs(origin) + tonumber(count)
+    if selected ~= '1' and origin <= 0 then
+        cart_set(sku_id, -count, price)
+    else
+        cart_set(sku_id, count, price)
+    end
+    cart_touch(sku_id)
+    return count
+end
+
+-- 修改购物车记录：直接设置数量和勾选状态
+local function cart_update(sku_id, count, selected, price)
+    count = tonumber(count)
+    if selected == '1' then
+        cart_set(sku_id, count, price)
+    else
+        cart_set(sku_id, -count, price)
+    end
+    cart_touch(sku_id)
+    return count
+end
+
+-- 删除购物车记录
+local function cart_delete(sku_id)
+    if redis.call('hexists', KEYS[1], sku_id) == 0 then
+        return 0
+    end
+    cart_set(sku_id, nil, nil)
+    return 1
+end
+"""
+
+# 添加购物车记录
+# ARGV: ..., sku_id, count, selected(1/0), price
+CART_ADD_SCRIPT = CART_LUA_FUNCTIONS + """
+local count = cart_add(ARGV[4], ARGV[5], ARGV[6], ARGV[7])
+cart_expire()
+return count
+"""
+
+# 修改购物车记录
+# ARGV: ..., sku_id, count, selected(1/0), price
+CART_UPDATE_SCRIPT = CART_LUA_FUNCTIONS + """
+local count = cart_update(ARGV[4], ARGV[5], ARGV[6], ARGV[7])
+cart_expire()
+return count
+"""
+
+# 删除购物车记录
+# ARGV: ..., sku_id, sku_id, ...
+CART_DELETE_SCRIPT = CART_LUA_FUNCTIONS + """
+local deleted = 0
+for i = 4, #ARGV do
+    deleted = deleted + cart_delete(ARGV[i])
+end
+cart_expire()
+return deleted
+"""
+
+# 批量操作购物车记录，按顺序执行所有操作，并返回操作之后的购物车记录
+# ARGV: ..., action, sku_id, count, selected(1/0), price, action, sku_id, count, selected(1/0), price, ...
+CART_BATCH_SCRIPT = CART_LUA_FUNCTIONS + """
+for i = 4, #ARGV, 5 do
+    local action = ARGV[i]
+    if action == 'add' then
+        cart_add(ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], ARGV[i + 4])
+    elseif action == 'update' then
+        cart_update(ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], ARGV[i + 4])
+    elseif action == 'delete' then
+        cart_delete(ARGV[i + 1])
+    end
+end
+cart_expire()
+return redis.call('hgetall', KEYS[1])
+"""
+
+# 购物车记录全选和取消全选，商品id不再经过网络往返
+# 勾选状态的变化不影响商品的操作时间
+# ARGV: ..., selected(1/0)
+CART_SELECT_ALL_SCRIPT = CART_LUA_FUNCTIONS + """
+local items = redis.call('hgetall', KEYS[1])
+for i = 1, #items, 2 do
+    local count = math.abs(tonumber(items[i + 1]))
+    if ARGV[4] ~= '1' then
+        count = -count
+    end
+    cart_set(items[i], count, nil)
+end
+cart_expire()
+return #items / 2
+"""
+
+# 设置购物车中部分商品的勾选状态，不在购物车中的商品忽略
+# ARGV: ..., selected(1/0), sku_id, sku_id, ...
+CART_SELECT_SCRIPT = CART_LUA_FUNCTIONS + """
+local changed = 0
+for i = 5, #ARGV do
+    local origin = redis.call('hget', KEYS[1], ARGV[i])
+    if origin then
+        local count = math.abs(tonumber(origin))
+        if ARGV[4] ~= '1' then
+            count = -count
+        end
+        if count ~= tonumber(origin) then
+            cart_set(ARGV[i], count, nil)
+            changed = changed + 1
+        end
+    end
+end
+cart_expire()
+return changed
+"""
+
+# 将cookie中的购物车记录合并到redis购物车记录中
+# 合并策略 overwrite: 使用cookie中的数量 sum: 数量相加 max: 取较大的数量，勾选状态都以cookie中的为准
+# cookie中的商品视为最近操作的商品，商品种类数超过上限时淘汰redis购物车中最久未操作的商品
+# ARGV: ..., policy, sku_id, value, price, sku_id, value, price, ...(value为编码之后的数量和勾选状态)
+CART_MERGE_SCRIPT = CART_LUA_FUNCTIONS + """
+local policy = ARGV[4]
+local merged = 0
+for i = 5, #ARGV, 3 do
+    local sku_id = ARGV[i]
+    local value = tonumber(ARGV[i + 1])
+    local count = math.abs(value)
+    local origin = redis.call('hget', KEYS[1], sku_id)
+    if origin then
+        origin = math.abs(tonumber(origin))
+        if policy == 'sum' then
+            count = count + origin
+        elseif policy == 'max' then
+            count = math.max(count, origin)
+        end
+    end
+    if value < 0 then
+        count = -count
+    end
+    cart_set(sku_id, count, ARGV[i + 2])
+    cart_touch(sku_id)
+    merged = merged + 1
+end
+cart_expire()
+return merged
+"""
+
+# 根据购物车记录和商品单价重新计算汇总数据
+# ARGV: ..., price_version, sku_id, price, sku_id, price, ...
+CART_REBUILD_SUMMARY_SCRIPT = CART_LUA_FUNCTIONS + """
+local prices = {}
+for i = 5, #ARGV, 2 do
+    prices[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+
+redis.call('del', KEYS[2])
+local total = 0
+local selected = 0
+local amount = 0
+local items = redis.call('hgetall', KEYS[1])
+for i = 1, #items, 2 do
+    local value = tonumber(items[i + 1])
+    local price = prices[items[i]] or 0
+    total = total + math.abs(value)
+    if value > 0 then
+        selected = selected + value
+        amount = amount + value * price
+    end
+    redis.call('hset', KEYS[2], 'price_' .. items[i], price)
+end
+redis.call('hmset', KEYS[2], 'total_count', total, 'selected_count', selected,
+           'selected_amount', amount, 'price_version', ARGV[4])
+cart_expire()
+return {total, selected, amount}
+"""
+
+# 整理购物车记录，由后台任务定期执行:
+# 1. 补充缺少操作时间的商品(转换之前的旧购物车记录)，视为最久未操作的商品
+# 2. 删除已经不在购物车中的商品的操作时间
+# 3. 淘汰超过商品种类数上限的商品
+# 4. 购物车为空时删除汇总数据和操作时间，未设置过期时间的key设置过期时间(不刷新已有的过期时间)
+# 返回: {淘汰的商品数, 删除的操作时间记录数}
+CART_COMPACT_SCRIPT = CART_LUA_FUNCTIONS + """
+local skus = redis.call('hkeys', KEYS[1])
+local in_cart = {}
+for _, sku_id in ipairs(skus) do
+    in_cart[sku_id] = true
+    if not redis.call('zscore', KEYS[3], sku_id) then
+        redis.call('zadd', KEYS[3], 0, sku_id)
+    end
+end
+
+local removed = 0
+for _, sku_id in ipairs(redis.call('zrange', KEYS[3], 0, -1)) do
+    if not in_cart[sku_id] then
+        redis.call('zrem', KEYS[3], sku_id)
+        removed = removed + 1
+    end
+end
+
+local evicted = 0
+while redis.call('hlen', KEYS[1]) > max_items do
+    cart_set(redis.call('zrange', KEYS[3], 0, 0)[1], nil, nil)
+    evicted = evicted + 1
+end
+
+if #skus == 0 then
+    redis.call('del', KEYS[2], KEYS[3])
+else
+    for i = 1, #KEYS do
+        if redis.call('ttl', KEYS[i]) == -1 then
+            redis.call('expire', KEYS[i], expires)
+        end
+    end
+end
+return {evicted, removed}
+"""
+
+# 将旧格式的购物车记录(cart_<user_id> hash + cart_selected_<user_id> set)转换为新格式
+# 新格式中已有的商品以新格式为准
+# KEYS: cart_<user_id>, cart_selected_<user_id>, cart_v2_<user_id>
+CART_MIGRATE_SCRIPT = """
+local items = redis.call('hgetall', KEYS[1])
+local migrated = 0
+for i = 1, #items, 2 do
+    local count = math.abs(tonumber(items[i + 1]))
+    if redis.call('sismember', KEYS[2], items[i]) == 0 then
+        count = -count
+    end
+    migrated = migrated + redis.call('hsetnx', KEYS[3], items[i], count)
+end
+redis.call('del', KEYS[1], KEYS[2])
+return migrated
+"""
+
+CART_SCRIPTS = {
+    'add': CART_ADD_SCRIPT,
+    'update': CART_UPDATE_SCRIPT,
+    'delete': CART_DELETE_SCRIPT,
+    'select_all': CART_SELECT_ALL_SCRIPT,
+    'select': CART_SELECT_SCRIPT,
+    'batch': CART_BATCH_SCRIPT,
+    'merge': CART_MERGE_SCRIPT,
+    'rebuild_summary': CART_REBUILD_SUMMARY_SCRIPT,
+    'compact': CART_COMPACT_SCRIPT,
+    'migrate': CART_MIGRATE_SCRIPT,
+}
+
+# 购物车合并策略
+CART_MERGE_POLICIES = ('overwrite', 'sum', 'max')
+
+# 已注册的脚本对象: {'<name>': Script}
+_registered_scripts = {}
+
+
+def get_cart_script(name):
+    """
+    获取已注册的购物车lua脚本对象
+    Script对象调用时使用EVALSHA，如果redis中脚本缓存被清空(NOSCRIPT)，会自动重新加载脚本再执行
+    """
+    script = _registered_scripts.get(name)
+
+    if script is None:
+        redis_conn = get_redis_connection('cart')
+        script = redis_conn.register_script(CART_SCRIPTS[name])
+        _registered_scripts[name] = script
+
+    return script
+
+
+def load_cart_scripts():
+    """服务启动时将所有购物车lua脚本加载到redis的脚本缓存中"""
+    redis_conn = get_redis_connection('cart')
+
+    for name in CART_SCRIPTS:
+        script = get_cart_script(name)
+        redis_conn.script_load(script.script)
+
+
+def encode_cart_value(count, selected):
+    """将商品数量和勾选状态编码为一个整数"""
+    return count if selected else -count
+
+
+def decode_cart_value(value):
+    """将redis中保存的整数解码为(count, selected)"""
+    value = int(value)
+    return abs(value), value > 0
+
+
+def get_sku_prices(sku_ids):
+    """从商品快照缓存中获取商品单价(分): {<sku_id>: <price>}"""
+    return {sku['id']: int(Decimal(sku['price']) * 100) for sku in get_sku_snapshots(sku_ids)}
+
+
+class CartRedisStorage(object):
+    """登录用户的redis购物车记录"""
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.cart_key = 'cart_v2_%s' % user_id
+        self.summary_key = 'cart_summary_%s' % user_id
+        self.touch_key = 'cart_touch_%s' % user_id
+        # 旧格式的购物车记录
+        self.legacy_cart_key = 'cart_%s' % user_id
+        self.legacy_selected_key = 'cart_selected_%s' % user_id
+
+    @property
+    def keys(self):
+        return [self.cart_key, self.summary_key, self.touch_key]
+
+    def _call(self, name, *args):
+        script = get_cart_script(name)
+        args = [int(time.time()), constants.CART_MAX_ITEMS, constants.CART_REDIS_EXPIRES] + list(args)
+        return script(keys=self.keys, args=args)
+
+    def _expire(self, pl):
+        """在pipeline中刷新购物车各个key的过期时间"""
+        for key in self.keys:
+            pl.expire(key, constants.CART_REDIS_EXPIRES)
+
+    def add(self, sku_id, count, selected):
+        """添加商品，如果购物车已经添加过该商品，数量进行累加，返回累加之后的数量"""
+        price = get_sku_prices([sku_id]).get(sku_id, 0)
+        return self._call('add', sku_id, count, int(selected), price)
+
+    def update(self, sku_id, count, selected):
+        """修改商品的数量和勾选状态"""
+        price = get_sku_prices([sku_id]).get(sku_id, 0)
+        return self._call('update', sku_id, count, int(selected), price)
+
+    def delete(self, sku_id):
+        """删除商品"""
+        return self._call('delete', sku_id)
+
+    def delete_many(self, sku_ids):
+        """批量删除商品"""
+        if not sku_ids:
+            return 0
+
+        return self._call('delete', *sku_ids)
+
+    def select_all(self, selected):
+        """全选或取消全选，返回购物车中商品的种类数"""
+        return self._call('select_all', int(selected))
+
+    def select(self, sku_ids, selected):
+        """勾选或取消勾选购物车中的部分商品，返回勾选状态发生变化的商品种类数"""
+        if not sku_ids:
+            return 0
+
+        return self._call('select', int(selected), *sku_ids)
+
+    def batch(self, operations):
+        """
+        按顺序执行多个购物车操作，返回操作之后的购物车记录(格式同get_cart)
+        operations: [
+            {'action': 'add'|'update'|'delete', 'sku_id': <sku_id>, 'count': <count>, 'selected': <selected>},
+            ...
+        ]
+        """
+        prices = get_sku_prices({operation['sku_id'] for operation in operations})
+
+        args = []
+        for operation in operations:
+            args.extend([
+                operation['action'],
+                operation['sku_id'],
+                operation.get('count') or 0,
+                int(operation.get('selected', True)),
+                prices.get(operation['sku_id'], 0)
+            ])
+
+        items = self._call('batch', *args)
+        return self._decode_cart(dict(zip(items[::2], items[1::2])))
+
+    def merge(self, cart_dict, policy):
+        """
+        将cookie中的购物车记录合并到redis购物车记录中，返回合并的商品种类数
+        cart_dict: {
+            '<sku_id>': {
+                'count': '<count>',
+                'selected': '<selected>'
+            },
+            ...
+        }
+        policy: 合并策略 overwrite/sum/max
+        """
+        if policy not in CART_MERGE_POLICIES:
+            raise ValueError('无效的购物车合并策略: %s' % policy)
+
+        if not cart_dict:
+            return 0
+
+        # 最多合并购物车商品种类数上限个商品，合并耗时与cookie购物车的大小无关
+        sku_ids = sorted(cart_dict)[:constants.CART_MAX_ITEMS]
+        prices = get_sku_prices(sku_ids)
+
+        args = [policy]
+        for sku_id in sku_ids:
+            count_selected = cart_dict[sku_id]
+            value = encode_cart_value(count_selected['count'], count_selected['selected'])
+            args.extend([sku_id, value, prices.get(sku_id, 0)])
+
+        return self._call('merge', *args)
+
+    def get_cart(self):
+        """
+        获取购物车中所有商品的数量和勾选状态:
+        {
+            <sku_id>: {
+                'count': <count>,
+                'selected': <selected>
+            },
+            ...
+        }
+        """
+        redis_conn = get_redis_connection('cart')
+        pl = redis_conn.pipeline(transaction=False)
+        pl.hgetall(self.cart_key)
+        pl.exists(self.legacy_cart_key)
+        self._expire(pl)
+        cart_redis, legacy = pl.execute()[:2]
+
+        # 还有旧格式的购物车记录时(部署之后尚未批量转换)，先转换该用户的记录再读取
+        if legacy:
+            self.migrate()
+            cart_redis = redis_conn.hgetall(self.cart_key)
+
+        return self._decode_cart(cart_redis)
+
+    @staticmethod
+    def _decode_cart(cart_redis):
+        """将redis hash中的数据解码为购物车记录"""
+        cart_dict = {}
+        for sku_id, value in cart_redis.items():
+            count, selected = decode_cart_value(value)
+            cart_dict[int(sku_id)] = {
+                'count': count,
+                'selected': selected
+            }
+
+        return cart_dict
+
+    def get_selected(self):
+        """
+        获取购物车中被勾选的商品和对应数量:
+        {
+            <sku_id>: <count>,
+            ...
+        }
+        """
+        cart_dict = self.get_cart()
+
+        return {sku_id: item['count'] for sku_id, item in cart_dict.items() if item['selected']}
+
+    def rebuild_summary(self, price_version=None):
+        """根据购物车记录和商品快照中的单价重新计算汇总数据"""
+        if price_version is None:
+            price_version = get_sku_price_version()
+
+        cart_dict = self.get_cart()
+        prices = get_sku_prices(cart_dict.keys())
+
+        args = [price_version]
+        for sku_id, price in prices.items():
+            args.extend([sku_id, price])
+
+        total_count, selected_count, selected_amount = self._call('rebuild_summary', *args)
+        return total_count, selected_count, selected_amount
+
+    def get_summary(self):
+        """
+        获取购物车的汇总数据:
+        {
+            'total_count': <商品总数量>,
+            'selected_count': <勾选商品总数量>,
+            'selected_amount': <勾选商品总金额>
+        }
+        汇总数据不存在(旧的购物车记录)或者商品价格有变化时，重新计算汇总数据
+        """
+        redis_conn = get_redis_connection('cart')
+        pl = redis_conn.pipeline(transaction=False)
+        pl.hmget(self.summary_key, 'total_count', 'selected_count', 'selected_amount', 'price_version')
+        self._expire(pl)
+        total_count, selected_count, selected_amount, version = pl.execute()[0]
+
+        price_version = get_sku_price_version()
+        if total_count is None or version is None or int(version) != price_version:
+            total_count, selected_count, selected_amount = self.rebuild_summary(price_version)
+
+        return {
+            'total_count': int(total_count),
+            'selected_count': int(selected_count),
+            'selected_amount': Decimal(int(selected_amount)) / 100
+        }
+
+    def compact(self):
+        """整理购物车记录，返回(淘汰的商品数, 删除的操作时间记录数)"""
+        evicted, removed = self._call('compact')
+        return evicted, removed
+
+    def migrate(self):
+        """
+        将该用户旧格式的购物车记录转换为新格式，返回转换的商品种类数
+        读取购物车时发现旧格式的记录会自动调用，migrate_cart_encoding命令用于批量转换
+        """
+        script = get_cart_script('migrate')
+        keys = [self.legacy_cart_key, self.legacy_selected_key, self.cart_key]
+        migrated = script(keys=keys)
+
+        self.rebuild_summary()
+        self.compact()
+        return migrated
@@ -1,3 +1,90 @@
-from django.test import TestCase
+import base64
+import pickle
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from cart import cookie_cart
+from cart.cookie_cart import CookieCartError
+
+
+class EvilPayload(object):
+    """反序列化时会调用os.system的对象"""
+    def __reduce__(self):
+        import os
+        return os.system, ('echo pwned',)
+
+
+class CookieCartTest(SimpleTestCase):
+    """cookie购物车数据的编解码"""
+    cart_dict = {
+        1: {'count': 2, 'selected': True},
+        3: {'count': 1, 'selected': False},
+        100000: {'count': 300, 'selected': True},
+    }
+
+    def test_round_trip(self):
+        """编码之后解码得到原来的购物车数据"""
+        value = cookie_cart.dumps(self.cart_dict)
+
+        self.assertNotIn('=', value)
+        self.assertEqual(cookie_cart.loads(value), self.cart_dict)
+
+    def test_round_trip_empty(self):
+        """空购物车"""
+        self.assertEqual(cookie_cart.loads(cookie_cart.dumps({})), {})
+        self.assertEqual(cookie_cart.loads(None), {})
+        self.assertEqual(cookie_cart.loads(''), {})
+
+    def test_tampered(self):
+        """修改商品记录之后签名不匹配"""
+        value = cookie_cart.dumps(self.cart_dict)
+        raw = bytearray(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        # 修改第一个商品的数量
+        raw[2] ^= 0x02
+        tampered = base64.urlsafe_b64encode(bytes(raw)).rstrip(b'=').decode()
+
+        with self.assertRaises(CookieCartError):
+            cookie_cart._loads(tampered)
+        self.assertEqual(cookie_cart.loads(tampered), {})
+
+    def test_truncated(self):
+        """截断的数据无效"""
+        value = cookie_cart.dumps(self.cart_dict)
+
+        for length in (1, 4, len(value) // 2, len(value) - 1):
+            with self.assertRaises(CookieCartError):
+                cookie_cart._loads(value[:length])
+            self.assertEqual(cookie_cart.loads(value[:length]), {})
+
+    def test_invalid_encoding(self):
+        """不是base64编码的数据"""
+        self.assertEqual(cookie_cart.loads('!!!不是购物车数据!!!'), {})
+
+    def test_legacy_pickle(self):
+        """兼容旧版base64(pickle)格式的数据"""
+        value = base64.b64encode(pickle.dumps(self.cart_dict)).decode()
+
+        self.assertEqual(cookie_cart.loads(value), self.cart_dict)
+
+    def test_legacy_pickle_invalid_records(self):
+        """旧版数据中数量不合法的商品记录被丢弃，结构错误的数据返回空购物车"""
+        value = base64.b64encode(pickle.dumps({
+            1: {'count': 2, 'selected': True},
+            2: {'count': 0, 'selected': True},
+        })).decode()
+        self.assertEqual(cookie_cart.loads(value), {1: {'count': 2, 'selected': True}})
+
+        value = base64.b64encode(pickle.dumps({1: 2})).decode()
+        self.assertEqual(cookie_cart.loads(value), {})
+
+        value = base64.b64encode(pickle.dumps([1, 2])).decode()
+        self.assertEqual(cookie_cart.loads(value), {})
+
+    def test_legacy_pickle_disallowed_class(self):
+        """旧版数据中引用了类或函数时拒绝加载"""
+        for payload in (EvilPayload(), {1: {'count': 1, 'selected': True, 'obj': EvilPayload()}}):
+            value = base64.b64encode(pickle.dumps(payload)).decode()
+
+            with self.assertRaises(CookieCartError):
+                cookie_cart._loads_legacy(value)
+            self.assertEqual(cookie_cart.loads(value), {})
@@ -1,20 +1,17 @@
 # 封装合并购物车记录函数
-import base64
-import pickle
+from decimal import Decimal
 
-from django_redis import get_redis_connection
+from django.conf import settings
+
+from cart.cookie_cart import get_cookie_cart
+from cart.serializers import CartSKUSerializer, CartSummarySerializer
+from cart.storage import CartRedisStorage
+from goods.cache import get_sku_snapshots
 
 
 def merge_cookie_cart_to_redis(request, user, response):
     """将cookie中的购物车记录合并到登录用户的redis记录中"""
     # 1. 获取cookie中购物车记录
-    cookie_cart = request.COOKIES.get('cart') # None
-
-    if cookie_cart is None:
-        # cookie购物车中无数据
-        return
-
-    # 解析cookie中的购物车数据
     # {
     #     '<sku_id>': {
     #         'count': '<count>',
@@ -22,58 +19,65 @@ def merge_cookie_cart_to_redis(request, user, response):
     #     },
     #     ...
     # }
-    cart_dict = pickle.loads(base64.b64decode(cookie_cart)) # {}
+    cart_dict = get_cookie_cart(request)
 
     if not cart_dict:
-        # 字典为空，cookie购物车中无数据
+        # cookie购物车中无数据
         return
 
     # 2. 将cookie中购物车记录合并到登录用户的redis记录中
-    # 存储cookie购物车记录中添加的商品id和对应数量count，此字典中的数据在进行购物车记录合并时需要设置到redis hash中
-    # {
-    #     '<sku_id>': '<count>',
-    #     ...
-    # }
-    cart = {}
-
-    # 存储cookie购物车记录中被勾选的商品的id，此列表中商品id在进行购物车记录合并时需要添加到redis set中
-    cart_selected_add = []
-
-    # 存储cookie购物车记录中未被勾选商品的id，此列表中商品id在进行购物车记录合并时需要从redis set中移除
-    cart_selected_remove = []
-
-    for sku_id, count_selected in cart_dict.items():
-        cart[sku_id] = count_selected['count']
-
-        if count_selected['selected']:
-            # 勾选
-            cart_selected_add.append(sku_id)
-        else:
-            # 未勾选
-            cart_selected_remove.append(sku_id)
-
-    # 合并
-    redis_conn = get_redis_connection('cart')
-
-    # 将`cart`字典中key和value作为属性和值设置到redis 对应的hash元素中
-    cart_key = 'cart_%s' % user.id
-    redis_conn.hmset(cart_key, cart)
-
-    # 将`cart_selected_add`中商品id添加到redis 对应的set元素中
-    cart_selected_key = 'cart_selected_%s' % user.id
-
-    if cart_selected_add:
-        redis_conn.sadd(cart_selected_key, *cart_selected_add)
-
-    # 将`cart_selected_remove`中商品的id从redis 对应的set元素中移除
-    if cart_selected_remove:
-        redis_conn.srem(cart_selected_key, *cart_selected_remove)
+    # 在redis中通过lua脚本一次原子地完成合并，合并策略由配置指定
+    policy = getattr(settings, 'CART_MERGE_POLICY', 'sum')
+    CartRedisStorage(user.id).merge(cart_dict, policy)
 
     # 3. 删除cookie中购物车数据
     response.delete_cookie('cart')
 
 
-
-
-
-
+def get_cart_skus_data(cart_dict):
+    """
+    根据购物车记录获取购物车中商品的序列化数据
+    cart_dict: {
+        '<sku_id>': {
+            'count': '<count>',
+            'selected': '<selected>'
+        },
+        ...
+    }
+    """
+    # 商品数据从商品快照缓存中获取，缓存未命中时才查询数据库
+    skus = get_sku_snapshots(cart_dict.keys())
+
+    for sku in skus:
+        # 给sku增加count和selected，分别保存该商品在购物车中添加数量和勾选状态
+        sku['count'] = cart_dict[sku['id']]['count']
+        sku['selected'] = cart_dict[sku['id']]['selected']
+
+    serializer = CartSKUSerializer(skus, many=True)
+    return serializer.data
+
+
+def get_cart_summary_data(cart_storage=None, cart_dict=None):
+    """
+    获取购物车汇总数据(商品总数量、勾选商品总数量、勾选商品总金额)的序列化数据
+    cart_storage: 登录用户的redis购物车，汇总数据在修改购物车时已经增量计算好
+    cart_dict: 未登录用户cookie中的购物车记录，根据商品快照中的单价计算
+    """
+    if cart_storage is not None:
+        summary = cart_storage.get_summary()
+    else:
+        summary = {
+            'total_count': 0,
+            'selected_count': 0,
+            'selected_amount': Decimal('0')
+        }
+
+        for sku in get_sku_snapshots(cart_dict.keys()):
+            count_selected = cart_dict[sku['id']]
+            summary['total_count'] += count_selected['count']
+            if count_selected['selected']:
+                summary['selected_count'] += count_selected['count']
+                summary['selected_amount'] += Decimal(sku['price']) * count_selected['count']
+
+    serializer = CartSummarySerializer(summary)
+    return serializer.data
@@ -1,17 +1,114 @@
-import base64
-import pickle
-
 from django.shortcuts import render
-from django_redis import get_redis_connection
 from rest_framework import status
 from rest_framework.response import Response
 
 from rest_framework.views import APIView
 
-from cart import constants
-from cart.serializers import CartSerializer, CartSKUSerializer, CartDelSerializer, CartSelectSerializer
+from cart.cookie_cart import get_cookie_cart, set_cookie_cart
+from cart.serializers import CartSerializer, CartDelSerializer, CartSelectSerializer, CartBatchSerializer
+from cart.storage import CartRedisStorage
+from cart.utils import get_cart_skus_data, get_cart_summary_data
 # Create your views here.
-from goods.models import SKU
+
+
+# GET /cart/summary/
+class CartSummaryView(APIView):
+    def perform_authentication(self, request):
+        """让当前视图跳过DRF框架默认认证过程"""
+        pass
+
+    def get(self, request):
+        """
+        购物车汇总数据获取:
+        1. 获取用户购物车的汇总数据
+            1.1 如果用户已登录，从redis中获取增量维护的汇总数据
+            1.2 如果用户未登录，根据cookie中的购物车记录计算汇总数据
+        2. 返回汇总数据
+        """
+        try:
+            user = request.user
+        except Exception:
+            user = None
+
+        # 1. 获取用户购物车的汇总数据
+        if user and user.is_authenticated:
+            # 1.1 如果用户已登录，从redis中获取增量维护的汇总数据
+            data = get_cart_summary_data(cart_storage=CartRedisStorage(user.id))
+        else:
+            # 1.2 如果用户未登录，根据cookie中的购物车记录计算汇总数据
+            data = get_cart_summary_data(cart_dict=get_cookie_cart(request))
+
+        # 2. 返回汇总数据
+        return Response(data)
+
+
+# POST /cart/batch/
+class CartBatchView(APIView):
+    def perform_authentication(self, request):
+        """让当前视图跳过DRF框架默认认证过程"""
+        pass
+
+    def post(self, request):
+        """
+        购物车记录批量操作:
+        1. 获取操作列表并进行校验(参数完整性，所有sku_id商品是否存在，商品的库存)
+        2. 按顺序执行所有操作
+            2.1 如果用户已登录，在redis中一次完成所有操作
+            2.2 如果用户未登录，修改cookie中的购物车记录之后一次重新设置cookie
+        3. 返回操作之后的购物车记录
+        """
+        # 1. 获取操作列表并进行校验(参数完整性，所有sku_id商品是否存在，商品的库存)
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # 获取校验之后的操作列表
+        operations = serializer.validated_data['operations']
+
+        try:
+            user = request.user
+        except Exception:
+            user = None
+
+        # 2. 按顺序执行所有操作
+        if user and user.is_authenticated:
+            # 2.1 如果用户已登录，在redis中一次完成所有操作
+            cart_dict = CartRedisStorage(user.id).batch(operations)
+
+            # 3. 返回操作之后的购物车记录
+            return Response(get_cart_skus_data(cart_dict))
+        else:
+            # 2.2 如果用户未登录，修改cookie中的购物车记录之后一次重新设置cookie
+            # {
+            #     '<sku_id>': {
+            #         'count': '<count>',
+            #         'selected': '<selected>'
+            #     },
+            #     ...
+            # }
+            cart_dict = get_cookie_cart(request)
+
+            for operation in operations:
+                action = operation['action']
+                sku_id = operation['sku_id']
+
+                if action == 'delete':
+                    cart_dict.pop(sku_id, None)
+                elif action == 'add' and sku_id in cart_dict:
+                    # 购物车已经添加过该商品，数量进行累加
+                    cart_dict[sku_id]['count'] += operation['count']
+                    if operation['selected']:
+                        cart_dict[sku_id]['selected'] = True
+                else:
+                    cart_dict[sku_id] = {
+                        'count': operation['count'],
+                        'selected': operation['selected']
+                    }
+
+            # 3. 返回操作之后的购物车记录
+            response = Response(get_cart_skus_data(cart_dict))
+            # 设置cookie中购物车数据
+            set_cookie_cart(response, cart_dict)
+            return response
 
 
 # PUT /cart/selection/
@@ -22,19 +119,20 @@ class CartSelectAllView(APIView):
 
     def put(self, request):
         """
-        购物车记录全选和取消全选:
-        1. 获取参数selected并进行校验(selected必传)
+        购物车记录全选和取消全选(传递sku_ids时只勾选或取消勾选这些商品):
+        1. 获取参数selected并进行校验(selected必传，sku_ids可选)
         2. 设置用户购物车记录勾选状态
             2.1 如果用户已登录，设置redis中用户购物车记录勾选状态
             2.2 如果用户未登录，设置cookie中用户购物车记录勾选状态
         3. 返回应答，设置成功
         """
-        # 1. 获取参数selected并进行校验(selected必传)
+        # 1. 获取参数selected并进行校验(selected必传，sku_ids可选)
         serializer = CartSelectSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        # 获取校验之后的selected
+        # 获取校验之后的selected和sku_ids
         selected = serializer.validated_data['selected'] # True: 全选 False: 全不选
+        sku_ids = serializer.validated_data.get('sku_ids') # None: 所有商品
 
         try:
             # request.user会触发DRF框架认证过程
@@ -45,51 +143,35 @@ class CartSelectAllView(APIView):
         # 2. 设置用户购物车记录勾选状态
         if user and user.is_authenticated:
             # 2.1 如果用户已登录，设置redis中用户购物车记录勾选状态
-            # 获取redis链接
-            redis_conn = get_redis_connection('cart')
-
-            # 从redis hash中获取用户购物车中所有商品的id
-            cart_key = 'cart_%s' % user.id
-            # (b'<sku_id>', b'<sku_id>', ...)
-            sku_ids = redis_conn.hkeys(cart_key)
-
-            cart_selected_key = 'cart_selected_%s' % user.id
-
-            if selected:
-                # 全选：将用户购物车所有商品的id添加到redis set中
-                redis_conn.sadd(cart_selected_key, *sku_ids)
+            # 在redis中通过lua脚本一次完成，商品id不经过网络往返，空购物车直接返回
+            cart_storage = CartRedisStorage(user.id)
+            if sku_ids is None:
+                cart_storage.select_all(selected)
             else:
-                # 全不选：将用户购物车所有商品的id从redis set中移除
-                redis_conn.srem(cart_selected_key, *sku_ids)
+                cart_storage.select(sku_ids, selected)
 
             return Response({'message': 'OK'})
         else:
             # 2.2 如果用户未登录，设置cookie中用户购物车记录勾选状态
             # 获取cookie的购物车记录
-            cookie_cart = request.COOKIES.get('cart')
-
-            if cookie_cart:
-                # 解析cookie中的购物车数据
-                # {
-                #     '<sku_id>': {
-                #         'count': '<count>',
-                #         'selected': '<selected>'
-                #     },
-                #     ...
-                # }
-                cart_dict = pickle.loads(base64.b64decode(cookie_cart))
-            else:
-                cart_dict = {}
+            # {
+            #     '<sku_id>': {
+            #         'count': '<count>',
+            #         'selected': '<selected>'
+            #     },
+            #     ...
+            # }
+            cart_dict = get_cookie_cart(request)
 
             # 设置cookie购物车记录勾选状态
             for sku_id, count_selected in cart_dict.items():
-                cart_dict[sku_id]['selected'] = selected
+                if sku_ids is None or sku_id in sku_ids:
+                    cart_dict[sku_id]['selected'] = selected
 
             # 3. 返回应答，设置成功
             response = Response({'message': 'OK'})
             # 设置cookie中的购物车数据
-            cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
-            response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
+            set_cookie_cart(response, cart_dict)
             return response
 
 
@@ -123,29 +205,14 @@ class CartView(APIView):
         # 2. 删除用户的购物车记录
         if user and user.is_authenticated:
             # 2.1 如果用户已登录，删除redis中对应的购物车记录
-            # 获取redis链接
-            redis_conn = get_redis_connection('cart')
-
-            # 从redis hash删除对应商品的id和数量count
-            cart_key = 'cart_%s' % user.id
-            redis_conn.hdel(cart_key, sku_id)
-
-            # 从redis set删除对应商品的id
-            cart_selected_key = 'cart_selected_%s' % user.id
-            redis_conn.srem(cart_selected_key, sku_id)
+            # 从redis hash(cart_v2_<user_id>)删除对应商品的id，数量和勾选状态一起删除
+            CartRedisStorage(user.id).delete(sku_id)
 
             return Response(status=status.HTTP_204_NO_CONTENT)
         else:
             # 2.2 如果用户未登录，删除cookie中对应的购物车记录
             response = Response(status=status.HTTP_204_NO_CONTENT)
             # 获取cookie中的购物车记录
-            cookie_cart = request.COOKIES.get('cart') # None
-
-            if cookie_cart is None:
-                # 购物车无数据
-                return response
-
-            # 解析cookie中购物车数据
             # {
             #     '<sku_id>': {
             #         'count': '<count>',
@@ -153,14 +220,13 @@ class CartView(APIView):
             #     },
             #     ...
             # }
-            cart_dict = pickle.loads(base64.b64decode(cookie_cart))
+            cart_dict = get_cookie_cart(request)
 
             # 删除对应的购物车记录
             if sku_id in cart_dict:
                 del cart_dict[sku_id]
                 # 重新设置cookie购物车数据
-                cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
-                response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
+                set_cookie_cart(response, cart_dict)
 
             # 3. 返回应答，购物车记录删除成功
             return response
@@ -194,22 +260,8 @@ class CartView(APIView):
         # 2. 修改用户的购物车记录
         if user and user.is_authenticated:
             # 2.1 如果用户已登录，修改redis中对应的购物车记录
-            # 获取redis链接
-            redis_conn = get_redis_connection('cart')
-
-            # 修改redis hash中商品id对应数量count
-            cart_key = 'cart_%s' % user.id
-            redis_conn.hset(cart_key, sku_id, count)
-
-            # 修改redis set中勾选的商品id
-            cart_selected_key= 'cart_selected_%s' % user.id
-
-            if selected:
-                # 勾选
-                redis_conn.sadd(cart_selected_key, sku_id)
-            else:
-                # 取消勾选
-                redis_conn.srem(cart_selected_key, sku_id)
+            # 修改redis hash(cart_v2_<user_id>)中商品id对应的值: 数量count，正数为勾选，负数为未勾选
+            CartRedisStorage(user.id).update(sku_id, count, selected)
 
             return Response(serializer.validated_data)
         else:
@@ -217,13 +269,6 @@ class CartView(APIView):
             response = Response(serializer.validated_data)
 
             # 获取cookie中的购物车数据
-            cookie_cart = request.COOKIES.get('cart') # None
-
-            if cookie_cart is None:
-                # 购物车中无数据
-                return response
-
-            # 解析cookie中的购物车数据
             # {
             #     '<sku_id>': {
             #         'count': '<count>',
@@ -231,9 +276,9 @@ class CartView(APIView):
             #     },
             #     ...
             # }
-            cart_dict = pickle.loads(base64.b64decode(cookie_cart)) # {}
+            cart_dict = get_cookie_cart(request)
             if not cart_dict:
-                # 字典为空，购物车无数据
+                # 购物车无数据
                 return response
 
             # 修改购物车数据
@@ -244,8 +289,7 @@ class CartView(APIView):
 
             # 3. 返回应答，购物车记录修改成功
             # 设置cookie中购物车数据
-            cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
-            response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
+            set_cookie_cart(response, cart_dict)
             return response
 
     # GET /cart/
@@ -266,24 +310,6 @@ class CartView(APIView):
         # 1. 获取用户的购物车记录
         if user and user.is_authenticated:
             # 1.1 如果用户已登录，从redis中获取用户的购物车记录
-            # 获取redis链接
-            redis_conn = get_redis_connection('cart')
-
-            # 从redis hash中获取用户购物车中添加的商品id和对应的数量count
-            cart_key = 'cart_%s' % user.id
-
-            # {
-            #     b'<sku_id>': b'<count>',
-            #     ...
-            # }
-            cart_redis = redis_conn.hgetall(cart_key)
-
-            # 从redis set中获取用户购物车中勾选的商品id
-            cart_selected_key = 'cart_selected_%s' % user.id
-
-            # (b'<sku_id>', ...)
-            cart_selected_redis = redis_conn.smembers(cart_selected_key)
-
             # {
             #     '<sku_id>': {
             #         'count': '<count>',
@@ -291,42 +317,22 @@ class CartView(APIView):
             #     },
             #     ...
             # }
-            cart_dict = {}
-            for sku_id, count in cart_redis.items():
-                cart_dict[int(sku_id)] = {
-                    'count': int(count),
-                    'selected': sku_id in cart_selected_redis
-                }
+            cart_dict = CartRedisStorage(user.id).get_cart()
         else:
             # 1.2 如果用户未登录，从cookie中获取用户的购物车记录
             # 获取cookie中的购物车数据
-            cookie_cart = request.COOKIES.get('cart') # None
-
-            if cookie_cart:
-                # 解析cookie中购物车数据
-                # {
-                #     '<sku_id>': {
-                #         'count': '<count>',
-                #         'selected': '<selected>'
-                #     },
-                #     ...
-                # }
-                cart_dict = pickle.loads(base64.b64decode(cookie_cart))
-            else:
-                cart_dict = {}
+            # {
+            #     '<sku_id>': {
+            #         'count': '<count>',
+            #         'selected': '<selected>'
+            #     },
+            #     ...
+            # }
+            cart_dict = get_cookie_cart(request)
 
         # 2. 根据用户购物车中商品id获取对应商品的数据
-        sku_ids = cart_dict.keys()
-        skus = SKU.objects.filter(id__in=sku_ids)
-
-        for sku in skus:
-            # 给sku对象增加属性count和selected，分别保存该商品在购物车中添加数量和勾选状态
-            sku.count = cart_dict[sku.id]['count']
-            sku.selected = cart_dict[sku.id]['selected']
-
         # 3. 将购物车商品的数据序列化并返回
-        serializer = CartSKUSerializer(skus, many=True)
-        return Response(serializer.data)
+        return Response(get_cart_skus_data(cart_dict))
 
     # POST /cart/
     def post(self, request):
@@ -360,39 +366,23 @@ class CartView(APIView):
         # 2. 保存用户的购物车记录
         if user and user.is_authenticated:
             # 2.1 如果用户已登录，在redis中保存用户的购物车记录
-            # 获取redis链接
-            redis_conn = get_redis_connection('cart')
-
-            # hash: 在redis hash中存储用户购物车添加的商品id和数量count
-            cart_key = 'cart_%s' % user.id
-
+            # 在redis hash(cart_v2_<user_id>)中存储用户购物车添加的商品id和数量count，
+            # 数量的符号表示勾选状态: 正数为勾选，负数为未勾选
             # 如果购物车已经添加过该商品，数量需要进行累加，如果未添加，直接添加一个新元素
-            redis_conn.hincrby(cart_key, sku_id, count)
-
-            # set: 在redis set中存储用户购物车勾选的商品id
-            cart_selected_key = 'cart_selected_%s' % user.id
-
-            if selected:
-                redis_conn.sadd(cart_selected_key, sku_id)
+            CartRedisStorage(user.id).add(sku_id, count, selected)
 
             return Response(serializer.validated_data, status=status.HTTP_201_CREATED)
         else:
             # 2.2 如果用户未登录，在cookie中保存用户的购物车记录
             # 获取原始cookie的购物车数据
-            cookie_cart = request.COOKIES.get('cart') # None
-
-            if cookie_cart:
-                # 解析cookie中购物车数据
-                # {
-                #     '<sku_id>': {
-                #         'count': '<count>',
-                #         'selected': '<selected>'
-                #     },
-                #     ...
-                # }
-                cart_dict = pickle.loads(base64.b64decode(cookie_cart))
-            else:
-                cart_dict = {}
+            # {
+            #     '<sku_id>': {
+            #         'count': '<count>',
+            #         'selected': '<selected>'
+            #     },
+            #     ...
+            # }
+            cart_dict = get_cookie_cart(request)
 
             # 如果购物车已经添加过该商品，数量需要进行累加
             if sku_id in cart_dict:
@@ -406,6 +396,5 @@ class CartView(APIView):
             # 3. 返回应答，购物车记录添加成功
             response = Response(serializer.validated_data, status=status.HTTP_201_CREATED)
             # 设置cookie中购物车数据
-            cart_data = base64.b64encode(pickle.dumps(cart_dict)).decode()
-            response.set_cookie('cart', cart_data, max_age=constants.CART_COOKIE_EXPIRES)
+            set_cookie_cart(response, cart_dict)
             return response
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ContentsConfig(AppConfig):
     name = 'contents'
+
+    def ready(self):
+        # 注册首页内容相关的信号处理函数
+        import contents.signals
@@ -0,0 +1,5 @@
+# 首页内容修改之后延迟重新生成首页的时间:s，这段时间内的多次修改只重新生成一次
+INDEX_HTML_DEBOUNCE = 5
+
+# 生成首页的分布式锁的有效期:s
+INDEX_HTML_LOCK_EXPIRES = 60
@@ -0,0 +1,134 @@
+# 首页静态页面index.html的按需生成
+# 广告内容、商品分类或频道修改时(信号)标记首页需要重新生成(index_html_dirty)，并延迟INDEX_HTML_DEBOUNCE秒发出一个生成任务，
+# 延迟期间的多次修改只发出一个任务(index_html_scheduled)；生成时使用分布式锁(index_html_lock)，多个节点不会同时生成。
+# 定时任务作为兜底，只在首页标记为需要重新生成，或相关表的修改时间/记录数(index_html_fingerprint)变化时才重新生成
+import json
+import uuid
+
+from django.db import transaction
+from django.db.models import Count, Max
+from django.template import loader
+from django_redis import get_redis_connection
+
+from contents import constants
+from contents.models import Content, ContentCategory
+from goods.models import GoodsCategory, GoodsChannel
+from goods.utils import get_categories
+from meiduo_mall.utils.static_html import write_static_html
+
+INDEX_HTML_DIRTY_KEY = 'index_html_dirty'
+INDEX_HTML_SCHEDULED_KEY = 'index_html_scheduled'
+INDEX_HTML_LOCK_KEY = 'index_html_lock'
+INDEX_HTML_FINGERPRINT_KEY = 'index_html_fingerprint'
+
+# 首页数据来源的模型类，任何一个修改都需要重新生成首页
+INDEX_HTML_MODELS = (Content, ContentCategory, GoodsChannel, GoodsCategory)
+
+# 只有锁的持有者才能释放锁
+# KEYS: index_html_lock
+# ARGV: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_release_lock_script = None
+
+
+def _schedule():
+    """延迟期间还没有发出过生成任务时，发出一个延迟执行的生成任务"""
+    redis_conn = get_redis_connection('default')
+    if redis_conn.set(INDEX_HTML_SCHEDULED_KEY, 1, nx=True, ex=constants.INDEX_HTML_DEBOUNCE):
+        from celery_tasks.html.tasks import generate_static_index_html
+        generate_static_index_html.apply_async(countdown=constants.INDEX_HTML_DEBOUNCE)
+
+
+def mark_index_dirty():
+    """标记首页需要重新生成，事务提交之后发出生成任务，保证任务能查询到修改之后的数据"""
+    redis_conn = get_redis_connection('default')
+    redis_conn.set(INDEX_HTML_DIRTY_KEY, 1)
+    transaction.on_commit(_schedule)
+
+
+def get_index_fingerprint():
+    """首页相关各个表的最大修改时间和记录数，每个表一条聚合查询"""
+    fingerprint = []
+    for model in INDEX_HTML_MODELS:
+        data = model.objects.aggregate(update_time=Max('update_time'), count=Count('id'))
+        update_time = data['update_time'].isoformat() if data['update_time'] else None
+        fingerprint.append([model._meta.db_table, update_time, data['count']])
+
+    return json.dumps(fingerprint)
+
+
+def render_index_html():
+    """生成首页静态页面index.html"""
+    # 1. 从数据库中查询出首页所需的`商品分类`和`首页广告`
+    # 商品分类数据，从版本化的缓存中获取
+    categories = get_categories()
+
+    # 广告内容
+    contents = {}
+    content_categories = ContentCategory.objects.all()
+    for cat in content_categories:
+        contents[cat.key] = cat.content_set.filter(status=True).order_by('sequence')
+
+    # 2. 调用`index.html`模板文件，进行模板渲染，给模板文件传递数据，进行模板变量替换，获取替换之后页面内容
+    context = {
+        'categories': categories,
+        'contents': contents
+    }
+    temp = loader.get_template('index.html')
+    res_html = temp.render(context)
+
+    # 3. 将替换之后页面内容保存成一个静态文件，内容没有变化时不写入
+    write_static_html('index.html', res_html)
+
+
+def regenerate_index_html(check_fingerprint=False, force=False):
+    """
+    在分布式锁的保护下重新生成首页:
+    1. 获取锁，其他节点正在生成时返回None
+    2. 首页没有标记为需要重新生成时直接返回False，check_fingerprint为True时再比较相关表的修改时间和记录数
+    3. 清除标记之后生成首页(生成期间的修改会重新标记)，并记录生成时的指纹
+    返回是否重新生成了首页
+    """
+    global _release_lock_script
+
+    redis_conn = get_redis_connection('default')
+    if _release_lock_script is None:
+        _release_lock_script = redis_conn.register_script(RELEASE_LOCK_SCRIPT)
+
+    # 1. 获取锁
+    token = uuid.uuid4().hex
+    if not redis_conn.set(INDEX_HTML_LOCK_KEY, token, nx=True, ex=constants.INDEX_HTML_LOCK_EXPIRES):
+        return None
+
+    try:
+        # 2. 判断是否需要重新生成，没有修改时不访问数据库
+        dirty = force or redis_conn.get(INDEX_HTML_DIRTY_KEY) is not None
+        fingerprint = None
+        if not dirty and check_fingerprint:
+            fingerprint = get_index_fingerprint()
+            stored = redis_conn.get(INDEX_HTML_FINGERPRINT_KEY)
+            dirty = stored is None or stored.decode() != fingerprint
+
+        if not dirty:
+            return False
+
+        # 3. 先清除标记、计算指纹，再生成首页
+        redis_conn.delete(INDEX_HTML_DIRTY_KEY)
+        if fingerprint is None:
+            fingerprint = get_index_fingerprint()
+
+        render_index_html()
+        redis_conn.set(INDEX_HTML_FINGERPRINT_KEY, fingerprint)
+        return True
+    except Exception:
+        # 生成失败，保留标记，下次重新生成
+        redis_conn.set(INDEX_HTML_DIRTY_KEY, 1)
+        raise
+    finally:
+        _release_lock_script(keys=[INDEX_HTML_LOCK_KEY], args=[token])
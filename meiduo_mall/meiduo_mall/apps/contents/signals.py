@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from contents.index_html import mark_index_dirty
+from contents.models import Content, ContentCategory
+from goods.models import GoodsCategory, GoodsChannel
+
+
+@receiver(post_save, sender=Content)
+@receiver(post_delete, sender=Content)
+@receiver(post_save, sender=ContentCategory)
+@receiver(post_delete, sender=ContentCategory)
+@receiver(post_save, sender=GoodsChannel)
+@receiver(post_delete, sender=GoodsChannel)
+@receiver(post_save, sender=GoodsCategory)
+@receiver(post_delete, sender=GoodsCategory)
+def index_content_changed(sender, **kwargs):
+    """首页的广告内容、商品分类或频道修改之后，标记首页需要重新生成"""
+    mark_index_dirty()
@@ -20,17 +20,17 @@ class SKUSpecificationAdmin(admin.ModelAdmin):
         obj.save()
 
         # 附加逻辑：发出重新生成静态详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(obj.sku.id)
+        from celery_tasks.html.tasks import generate_static_goods_detail_html
+        generate_static_goods_detail_html.delay(obj.sku.goods_id)
 
     def delete_model(self, request, obj):
         # 数据保存
-        sku_id = obj.sku.id
+        goods_id = obj.sku.goods_id
         obj.delete()
 
         # 附加逻辑：发出重新生成静态详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(sku_id)
+        from celery_tasks.html.tasks import generate_static_goods_detail_html
+        generate_static_goods_detail_html.delay(goods_id)
 
 
 class SKUImageAdmin(admin.ModelAdmin):
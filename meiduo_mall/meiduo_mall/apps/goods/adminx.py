@@ -1,5 +1,6 @@
 import xadmin
 from xadmin import views
+from goods.counters import merge_pending_counters
 from goods.models import SKU, Goods, SKUSpecification
 
 
@@ -31,6 +32,12 @@ class SKUAdmin(object):
     list_export = ['xls', 'csv', 'xml']
     readonly_fields = ['sales', 'comments']
 
+    def make_result_list(self):
+        super().make_result_list()
+
+        # 列表中的销量和评价数合并尚未写入数据库的计数增量(goods.counters)
+        merge_pending_counters(self.result_list)
+
 
 class SKUSpecificationAdmin(object):
     def save_models(self):
@@ -39,18 +46,18 @@ class SKUSpecificationAdmin(object):
         obj.save()
 
         # 附加逻辑：发出重新生成静态详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(obj.sku.id)
+        from celery_tasks.html.tasks import generate_static_goods_detail_html
+        generate_static_goods_detail_html.delay(obj.sku.goods_id)
 
     def delete_model(self):
         # 数据删除
         obj = self.obj
-        sku_id = obj.sku.id
+        goods_id = obj.sku.goods_id
         obj.delete()
 
         # 附加逻辑：发出重新生成静态详情页面的任务消息
-        from celery_tasks.html.tasks import generate_static_sku_detail_html
-        generate_static_sku_detail_html.delay(sku_id)
+        from celery_tasks.html.tasks import generate_static_goods_detail_html
+        generate_static_goods_detail_html.delay(goods_id)
 
 
 xadmin.site.register(SKU, SKUAdmin)
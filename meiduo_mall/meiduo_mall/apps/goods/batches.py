@@ -0,0 +1,37 @@
+# redis增量批次写入数据库的幂等标记
+# 计数器、秒杀库存等先在redis中累加增量，再由定时任务把一批增量写入数据库，每个批次在取出时分配一个批次id。
+# 写入数据库的事务中同时插入批次id(tb_applied_batch.batch_id唯一)，插入失败说明该批次已经写入过，
+# 在事务提交之后、删除redis中的批次之前崩溃时，下次重新取出同一批次也不会重复写入
+import uuid
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from goods import constants
+from goods.models import AppliedBatch
+
+
+def new_batch_id(scope):
+    """生成批次id"""
+    return '%s:%s' % (scope, uuid.uuid4().hex)
+
+
+def mark_batch_applied(batch_id):
+    """
+    在写入数据库的事务中记录批次已写入，该批次已经写入过时返回False，调用者不应再写入
+    并发写入同一批次时，后插入的事务等待先插入的事务提交之后插入失败
+    """
+    try:
+        with transaction.atomic():
+            AppliedBatch.objects.create(batch_id=batch_id)
+    except IntegrityError:
+        return False
+
+    return True
+
+
+def clear_applied_batches():
+    """删除超过保留时间的批次记录"""
+    expired = timezone.now() - timedelta(seconds=constants.APPLIED_BATCH_RETENTION)
+    AppliedBatch.objects.filter(create_time__lt=expired).delete()
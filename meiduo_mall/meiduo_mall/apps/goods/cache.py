@@ -0,0 +1,181 @@
+# SKU商品展示数据的快照缓存
+# 购物车和订单结算页面只需要商品的id、name、price、default_image_url，
+# 这些数据先从进程内的LRU缓存中获取，再从redis hash(sku_snapshot_<sku_id>)中批量获取，
+# 两级缓存都未命中时才查询数据库
+import threading
+import time
+from collections import OrderedDict
+
+from django_redis import get_redis_connection
+
+from goods import constants
+from goods.models import SKU
+
+# 快照中保存的SKU字段
+SKU_SNAPSHOT_FIELDS = ('id', 'name', 'price', 'default_image_url')
+
+# 商品价格版本号
+SKU_PRICE_VERSION_KEY = 'sku_price_version'
+
+# 商品分类版本号
+GOODS_CATEGORY_VERSION_KEY = 'goods_category_version'
+
+
+class LRUCache(object):
+    """进程内带过期时间的LRU缓存"""
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SKUSnapshotCache(object):
+    """SKU商品展示数据的快照缓存"""
+    def __init__(self):
+        self.local = LRUCache(constants.SKU_SNAPSHOT_LOCAL_CACHE_SIZE, constants.SKU_SNAPSHOT_LOCAL_CACHE_EXPIRES)
+
+    @staticmethod
+    def _redis_key(sku_id):
+        return 'sku_snapshot_%s' % sku_id
+
+    @staticmethod
+    def _decode(data):
+        return {
+            'id': int(data[b'id']),
+            'name': data[b'name'].decode(),
+            'price': data[b'price'].decode(),
+            'default_image_url': data[b'default_image_url'].decode(),
+        }
+
+    def get_many(self, sku_ids):
+        """
+        批量获取SKU商品的快照数据，不存在的商品不会出现在结果中
+        返回: {
+            <sku_id>: {'id': <sku_id>, 'name': <name>, 'price': <price>, 'default_image_url': <url>},
+            ...
+        }
+        """
+        sku_ids = [int(sku_id) for sku_id in sku_ids]
+        snapshots = {}
+
+        # 1. 进程内LRU缓存
+        missing = []
+        for sku_id in sku_ids:
+            snapshot = self.local.get(sku_id)
+            if snapshot is None:
+                missing.append(sku_id)
+            else:
+                snapshots[sku_id] = snapshot
+
+        # 2. redis中的快照，一次pipeline批量获取
+        if missing:
+            redis_conn = get_redis_connection('goods')
+            pl = redis_conn.pipeline(transaction=False)
+            for sku_id in missing:
+                pl.hgetall(self._redis_key(sku_id))
+
+            db_missing = []
+            for sku_id, data in zip(missing, pl.execute()):
+                if data:
+                    snapshot = self._decode(data)
+                    snapshots[sku_id] = snapshot
+                    self.local.set(sku_id, snapshot)
+                else:
+                    db_missing.append(sku_id)
+
+            # 3. 查询数据库并回填redis和进程内缓存
+            if db_missing:
+                pl = redis_conn.pipeline(transaction=False)
+                for sku in SKU.objects.filter(id__in=db_missing).only(*SKU_SNAPSHOT_FIELDS):
+                    snapshot = {
+                        'id': sku.id,
+                        'name': sku.name,
+                        'price': str(sku.price),
+                        'default_image_url': sku.default_image_url or '',
+                    }
+                    snapshots[sku.id] = snapshot
+                    self.local.set(sku.id, snapshot)
+
+                    key = self._redis_key(sku.id)
+                    pl.hmset(key, snapshot)
+                    pl.expire(key, constants.SKU_SNAPSHOT_REDIS_EXPIRES)
+                pl.execute()
+
+        # 返回副本，避免调用者修改缓存中的数据
+        return {sku_id: dict(snapshot) for sku_id, snapshot in snapshots.items()}
+
+    def invalidate(self, sku_ids):
+        """使指定SKU商品的快照缓存失效"""
+        sku_ids = [int(sku_id) for sku_id in sku_ids]
+        if not sku_ids:
+            return
+
+        for sku_id in sku_ids:
+            self.local.delete(sku_id)
+
+        redis_conn = get_redis_connection('goods')
+        redis_conn.delete(*[self._redis_key(sku_id) for sku_id in sku_ids])
+
+
+sku_snapshot_cache = SKUSnapshotCache()
+
+
+def get_sku_snapshots(sku_ids):
+    """按sku_id升序返回SKU商品快照数据的列表"""
+    snapshots = sku_snapshot_cache.get_many(sku_ids)
+    return [snapshots[sku_id] for sku_id in sorted(snapshots)]
+
+
+def invalidate_sku_snapshots(sku_ids):
+    """使指定SKU商品的快照缓存失效"""
+    sku_snapshot_cache.invalidate(sku_ids)
+
+
+def get_sku_price_version():
+    """获取商品价格的版本号，购物车汇总数据中的金额以该版本号判断是否需要重新计算"""
+    redis_conn = get_redis_connection('goods')
+    return int(redis_conn.get(SKU_PRICE_VERSION_KEY) or 0)
+
+
+def incr_sku_price_version():
+    """商品价格变化时增加价格版本号"""
+    redis_conn = get_redis_connection('goods')
+    return redis_conn.incr(SKU_PRICE_VERSION_KEY)
+
+
+def get_goods_category_version():
+    """获取商品分类的版本号，缓存的商品分类数据以该版本号判断是否需要重新生成"""
+    redis_conn = get_redis_connection('goods')
+    return int(redis_conn.get(GOODS_CATEGORY_VERSION_KEY) or 0)
+
+
+def incr_goods_category_version():
+    """商品分类或频道变化时增加分类版本号"""
+    redis_conn = get_redis_connection('goods')
+    return redis_conn.incr(GOODS_CATEGORY_VERSION_KEY)
@@ -0,0 +1,23 @@
+# SKU商品快照在进程内LRU缓存中保存的最大数量
+SKU_SNAPSHOT_LOCAL_CACHE_SIZE = 10000
+
+# SKU商品快照在进程内LRU缓存中的有效期:s，其他进程修改商品之后最多延迟这么久生效
+SKU_SNAPSHOT_LOCAL_CACHE_EXPIRES = 10
+
+# SKU商品快照在redis中的有效期:s
+SKU_SNAPSHOT_REDIS_EXPIRES = 24 * 60 * 60
+
+# 库存索引near模式下，索引中的库存减去购买数量小于该值时查询数据库进行确认
+SKU_STOCK_RECHECK_MARGIN = 5
+
+# 商品分类数据在redis中的有效期:s，分类变化时版本号增加，旧版本的数据自然过期
+GOODS_CATEGORIES_REDIS_EXPIRES = 24 * 60 * 60
+
+# 增量生成静态详情页面时，水位时间向前回退的秒数，避免遗漏生成期间尚未提交的修改
+GOODS_DETAIL_HTML_WATERMARK_OVERLAP = 60
+
+# 并行生成静态详情页面时，每次分派给工作进程的商品SPU数量
+GOODS_DETAIL_HTML_CHUNK_SIZE = 10
+
+# 已写入数据库的增量批次记录的保留时间:s
+APPLIED_BATCH_RETENTION = 7 * 24 * 60 * 60
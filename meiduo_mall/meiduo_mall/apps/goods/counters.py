@@ -0,0 +1,198 @@
+# 商品销量、评价数计数器的延迟写入
+# SKU.sales/SKU.comments/Goods.sales/Goods.comments是冗余的计数字段，每个订单都直接更新会成为热点行写入。
+# 计数的增量先累加到redis hash(goods_counters_pending)中，由定时任务批量写入数据库:
+# {
+#     '<model>:<id>:<field>': '<增量>',  # 例如 'sku:1:sales': '3'，'goods:1:comments': '1'
+#     ...
+# }
+# 写入数据库时先将goods_counters_pending改名为goods_counters_flushing，并在其中记录批次id(__batch_id)，之后的增量累加到新的hash中；
+# 写入数据库的事务中同时记录批次id(goods.batches)，事务提交之后再删除goods_counters_flushing。
+# 写入过程中崩溃时，下次从goods_counters_flushing继续写入，增量不会丢失；批次已经写入过时只删除，不会重复写入
+import logging
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django_redis import get_redis_connection
+
+from goods.batches import new_batch_id, mark_batch_applied, clear_applied_batches
+from goods.models import SKU, Goods
+
+logger = logging.getLogger('django')
+
+COUNTERS_PENDING_KEY = 'goods_counters_pending'
+COUNTERS_FLUSHING_KEY = 'goods_counters_flushing'
+
+# 计数器对应的模型类和字段
+COUNTER_MODELS = {
+    'sku': SKU,
+    'goods': Goods,
+}
+COUNTER_FIELDS = ('sales', 'comments')
+
+# goods_counters_flushing中记录批次id的字段
+BATCH_ID_FIELD = '__batch_id'
+
+# 取出待写入数据库的增量，上次写入未完成时继续写入上次的数据(批次id不变)
+# KEYS: goods_counters_pending, goods_counters_flushing
+# ARGV: 新批次的id
+FETCH_PENDING_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 0 then
+    if redis.call('exists', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('rename', KEYS[1], KEYS[2])
+    redis.call('hset', KEYS[2], '__batch_id', ARGV[1])
+end
+return redis.call('hgetall', KEYS[2])
+"""
+
+_fetch_pending_script = None
+
+
+def incr_counters(deltas):
+    """
+    累加计数器的增量
+    deltas: {
+        ('<model>', <id>, '<field>'): <增量>,
+        ...
+    }
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    redis_conn = get_redis_connection('goods')
+    pl = redis_conn.pipeline(transaction=False)
+    for (model, obj_id, field), delta in deltas.items():
+        pl.hincrby(COUNTERS_PENDING_KEY, '%s:%s:%s' % (model, obj_id, field), delta)
+    pl.execute()
+
+
+def incr_sales(items):
+    """
+    增加商品销量(count为负数时减少)，同时累加SKU和所属Goods的销量
+    items: [(<sku_id>, <goods_id>, <count>), ...]
+    """
+    deltas = {}
+    for sku_id, goods_id, count in items:
+        deltas[('sku', sku_id, 'sales')] = deltas.get(('sku', sku_id, 'sales'), 0) + count
+        deltas[('goods', goods_id, 'sales')] = deltas.get(('goods', goods_id, 'sales'), 0) + count
+
+    incr_counters(deltas)
+
+
+def _parse(items):
+    """
+    将redis hash中的数据解析为:
+    {
+        '<model>': {
+            <id>: {'<field>': <增量>, ...},
+            ...
+        },
+        ...
+    }
+    """
+    counters = {}
+    for key, delta in items:
+        model, obj_id, field = key.decode().split(':')
+        delta = int(delta)
+        if model not in COUNTER_MODELS or field not in COUNTER_FIELDS or not delta:
+            continue
+
+        fields = counters.setdefault(model, {}).setdefault(int(obj_id), {})
+        fields[field] = fields.get(field, 0) + delta
+
+    return counters
+
+
+def get_pending_counters(model, ids):
+    """
+    获取尚未写入数据库的增量(包括正在写入的)，用于需要精确计数的读取
+    返回: {<id>: {'<field>': <增量>, ...}}
+    """
+    ids = [int(obj_id) for obj_id in ids]
+    if not ids:
+        return {}
+
+    fields = ['%s:%s:%s' % (model, obj_id, field) for obj_id in ids for field in COUNTER_FIELDS]
+
+    redis_conn = get_redis_connection('goods')
+    pl = redis_conn.pipeline(transaction=False)
+    pl.hmget(COUNTERS_PENDING_KEY, fields)
+    pl.hmget(COUNTERS_FLUSHING_KEY, fields)
+    pending, flushing = pl.execute()
+
+    items = [(field.encode(), int(a or 0) + int(b or 0)) for field, a, b in zip(fields, pending, flushing)]
+    return _parse(items).get(model, {})
+
+
+def merge_pending_counters(objs):
+    """将尚未写入数据库的增量合并到SKU或Goods对象的计数字段中，返回objs"""
+    objs = list(objs)
+    if not objs:
+        return objs
+
+    model = 'sku' if isinstance(objs[0], SKU) else 'goods'
+    pending = get_pending_counters(model, [obj.id for obj in objs])
+
+    for obj in objs:
+        for field, delta in pending.get(obj.id, {}).items():
+            setattr(obj, field, getattr(obj, field) + delta)
+
+    return objs
+
+
+def _update_counters(model_class, counters):
+    """一个模型类的所有计数器增量用一条UPDATE语句写入数据库"""
+    updates = {}
+    for field in COUNTER_FIELDS:
+        whens = [When(id=obj_id, then=Value(fields[field])) for obj_id, fields in counters.items() if field in fields]
+        if whens:
+            updates[field] = F(field) + Case(*whens, default=Value(0), output_field=IntegerField())
+
+    if updates:
+        model_class.objects.filter(id__in=counters.keys()).update(**updates)
+
+
+def flush_counters():
+    """
+    将计数器的增量批量写入数据库:
+    1. 将goods_counters_pending改名为goods_counters_flushing并取出其中的增量和批次id
+    2. 在一个事务中记录批次id，每个模型类用一条UPDATE语句写入所有增量；批次已经写入过时不再写入
+    3. 事务提交之后删除goods_counters_flushing
+    返回写入的计数器个数
+    """
+    global _fetch_pending_script
+
+    redis_conn = get_redis_connection('goods')
+    if _fetch_pending_script is None:
+        _fetch_pending_script = redis_conn.register_script(FETCH_PENDING_SCRIPT)
+
+    # 1. 取出待写入数据库的增量和批次id
+    items = _fetch_pending_script(keys=[COUNTERS_PENDING_KEY, COUNTERS_FLUSHING_KEY], args=[new_batch_id('counters')])
+    items = dict(zip(items[::2], items[1::2]))
+    if not items:
+        return 0
+
+    # 升级之前遗留的goods_counters_flushing中没有批次id
+    batch_id = items.pop(BATCH_ID_FIELD.encode(), b'').decode() or new_batch_id('counters')
+    counters = _parse(items.items())
+
+    # 2. 在一个事务中记录批次id并写入所有增量
+    with transaction.atomic():
+        if mark_batch_applied(batch_id):
+            for model in sorted(counters):
+                _update_counters(COUNTER_MODELS[model], counters[model])
+        else:
+            logger.warning('商品计数器批次已写入数据库，不再重复写入: %s' % batch_id)
+            counters = {}
+
+    # 3. 删除goods_counters_flushing
+    redis_conn.delete(COUNTERS_FLUSHING_KEY)
+    clear_applied_batches()
+
+    total = sum(len(objs) for objs in counters.values())
+    if total:
+        logger.info('商品计数器写入数据库: %s' % total)
+
+    return total
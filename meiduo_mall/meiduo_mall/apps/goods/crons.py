@@ -0,0 +1,10 @@
+import time
+
+from goods.counters import flush_counters
+
+
+def flush_goods_counters():
+    """将redis中累加的商品销量、评价数增量批量写入数据库"""
+    print('%s: flush_goods_counters' % time.ctime())
+    total = flush_counters()
+    print('写入数据库的计数器个数: %s' % total)
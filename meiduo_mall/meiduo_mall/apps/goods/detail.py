@@ -0,0 +1,194 @@
+# 商品静态详情页面的生成
+# 同一个商品SPU的所有SKU共用商品信息、规格和规格选项，规格参数-sku字典也只需要构建一次，
+# 按商品SPU批量加载数据之后，在一次遍历中渲染所有SKU的详情页面，查询次数与SKU数量无关
+#
+# 增量生成时，上次生成的开始时间和商品分类版本号作为水位保存在redis hash(goods_detail_html_watermark)中:
+# {
+#     'time': '<时间戳>',
+#     'category_version': '<商品分类版本号>'
+# }
+from datetime import datetime
+
+from django.template import loader
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from goods import constants
+from goods.counters import merge_pending_counters
+from goods.models import (
+    Goods, GoodsChannel, GoodsSpecification, SKU, SKUImage, SKUSpecification, SpecificationOption
+)
+from goods.utils import get_categories
+from meiduo_mall.utils.static_html import write_static_html
+
+GOODS_DETAIL_HTML_WATERMARK_KEY = 'goods_detail_html_watermark'
+
+
+class GoodsDetail(object):
+    """一个商品SPU生成详情页面所需的数据"""
+    def __init__(self, goods_id):
+        # 1. 商品SPU及其三级分类
+        # select ... from tb_goods inner join tb_goods_category ... where id=<goods_id>;
+        self.goods = Goods.objects.select_related('category1', 'category2', 'category3').get(id=goods_id)
+
+        # 面包屑导航信息中的频道
+        self.goods.channel = GoodsChannel.objects.filter(category_id=self.goods.category1_id).first()
+
+        # 2. 商品SPU的所有SKU及其图片
+        self.skus = {sku.id: sku for sku in SKU.objects.filter(goods_id=goods_id)}
+        images = {}
+        for image in SKUImage.objects.filter(sku__goods_id=goods_id).order_by('id'):
+            images.setdefault(image.sku_id, []).append(image)
+        for sku_id, sku in self.skus.items():
+            sku.images = images.get(sku_id, [])
+
+        # 页面中显示的评价数需要精确值，合并尚未写入数据库的计数增量
+        merge_pending_counters(self.skus.values())
+        merge_pending_counters([self.goods])
+
+        # 3. 商品SPU的规格和规格选项
+        self.specs = list(self.goods.goodsspecification_set.order_by('id'))
+        options = {}
+        for option in SpecificationOption.objects.filter(spec__goods_id=goods_id).order_by('id'):
+            options.setdefault(option.spec_id, []).append(option)
+        self.options = [options.get(spec.id, []) for spec in self.specs]
+
+        # 4. 每个SKU的规格键
+        # sku_keys = {
+        #     <sku_id>: [规格1参数id, 规格2参数id, 规格3参数id, ...],
+        #     ...
+        # }
+        self.sku_keys = {sku_id: [] for sku_id in self.skus}
+        sku_specs = SKUSpecification.objects.filter(sku__goods_id=goods_id).order_by('sku_id', 'spec_id')
+        for sku_id, option_id in sku_specs.values_list('sku_id', 'option_id'):
+            self.sku_keys[sku_id].append(option_id)
+
+        # 构建不同规格参数（选项）的sku字典
+        # spec_sku_map = {
+        #     (规格1参数id, 规格2参数id, 规格3参数id, ...): sku_id,
+        #     ...
+        # }
+        self.spec_sku_map = {tuple(key): sku_id for sku_id, key in sorted(self.sku_keys.items())}
+
+    def get_specs(self, sku_id):
+        """
+        获取指定SKU详情页面中的规格信息，SKU的规格信息不完整时返回None
+        specs = [
+            {
+                'name': '屏幕尺寸',
+                'options': [
+                    {'value': '13.3寸', 'sku_id': xxx},
+                    {'value': '15.4寸', 'sku_id': xxx},
+                ]
+            },
+            ...
+        ]
+        """
+        sku_key = self.sku_keys[sku_id]
+        if len(sku_key) < len(self.specs):
+            return None
+
+        specs = []
+        for index, spec in enumerate(self.specs):
+            # 复制当前sku的规格键
+            key = sku_key[:]
+            options = []
+            for option in self.options[index]:
+                # 在规格参数sku字典中查找符合当前规格的sku
+                key[index] = option.id
+                options.append({'value': option.value, 'sku_id': self.spec_sku_map.get(tuple(key))})
+
+            specs.append({'name': spec.name, 'options': options})
+
+        return specs
+
+
+def render_goods_detail_html(goods_id, sku_ids=None):
+    """
+    生成商品SPU下SKU的静态详情页面，sku_ids为None时生成所有SKU的页面
+    返回生成了页面的sku_id列表
+    """
+    # 1. 获取商品详情页面所需数据
+    detail = GoodsDetail(goods_id)
+    categories = get_categories()
+    temp = loader.get_template('detail.html')
+
+    if sku_ids is None:
+        sku_ids = detail.skus.keys()
+
+    generated = []
+    for sku_id in sorted(sku_ids):
+        if sku_id not in detail.skus:
+            continue
+
+        # 若当前sku的规格信息不完整，则不生成页面
+        specs = detail.get_specs(sku_id)
+        if specs is None:
+            continue
+
+        # 2. 模板渲染：获取替换之后html页面内容
+        context = {
+            'categories': categories,
+            'goods': detail.goods,
+            'specs': specs,
+            'sku': detail.skus[sku_id]
+        }
+        res_html = temp.render(context)
+
+        # 3. 将渲染之后的html页面内容保存成一个静态文件，内容没有变化时不写入
+        write_static_html('goods/%s.html' % sku_id, res_html)
+
+        generated.append(sku_id)
+
+    return generated
+
+
+def render_sku_detail_html(sku_id):
+    """生成指定SKU的静态详情页面"""
+    goods_id = SKU.objects.filter(id=sku_id).values_list('goods_id', flat=True).first()
+    if goods_id is None:
+        return []
+
+    return render_goods_detail_html(goods_id, [sku_id])
+
+
+def get_detail_html_watermark():
+    """获取上次生成静态详情页面的水位: (<开始时间戳>, <商品分类版本号>)，从未生成过时返回None"""
+    redis_conn = get_redis_connection('goods')
+    data = redis_conn.hgetall(GOODS_DETAIL_HTML_WATERMARK_KEY)
+    if not data:
+        return None
+
+    return float(data[b'time']), int(data[b'category_version'])
+
+
+def set_detail_html_watermark(start_time, category_version):
+    """生成成功之后记录水位"""
+    redis_conn = get_redis_connection('goods')
+    redis_conn.hmset(GOODS_DETAIL_HTML_WATERMARK_KEY, {
+        'time': start_time,
+        'category_version': category_version
+    })
+
+
+def get_changed_goods_ids(since):
+    """
+    获取since时间戳之后商品、SKU、图片或规格有修改的商品SPU id集合
+    删除的记录没有修改时间，由admin中的删除操作触发重新生成
+    """
+    since = datetime.fromtimestamp(since - constants.GOODS_DETAIL_HTML_WATERMARK_OVERLAP, tz=timezone.utc)
+
+    querysets = [
+        Goods.objects.filter(update_time__gt=since).values_list('id', flat=True),
+        SKU.objects.filter(update_time__gt=since).values_list('goods_id', flat=True),
+        SKUImage.objects.filter(update_time__gt=since).values_list('sku__goods_id', flat=True),
+        SKUSpecification.objects.filter(update_time__gt=since).values_list('sku__goods_id', flat=True),
+        GoodsSpecification.objects.filter(update_time__gt=since).values_list('goods_id', flat=True),
+        SpecificationOption.objects.filter(update_time__gt=since).values_list('spec__goods_id', flat=True),
+    ]
+
+    goods_ids = set()
+    for queryset in querysets:
+        goods_ids.update(queryset.distinct().iterator())
+
+    return goods_ids
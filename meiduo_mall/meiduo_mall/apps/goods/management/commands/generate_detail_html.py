@@ -0,0 +1,74 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from goods import constants
+from goods.cache import get_goods_category_version
+from goods.detail import (
+    render_goods_detail_html, get_detail_html_watermark, set_detail_html_watermark, get_changed_goods_ids
+)
+from goods.models import Goods
+
+
+def _init_worker():
+    """工作进程不能使用父进程的数据库连接，关闭之后在首次查询时重新建立"""
+    connections.close_all()
+
+
+def _render(goods_id):
+    """在工作进程中生成一个商品SPU的所有静态详情页面，返回: (<goods_id>, <页面数>, <错误信息>)"""
+    try:
+        return goods_id, len(render_goods_detail_html(goods_id)), None
+    except Exception as e:
+        return goods_id, 0, '%s: %s' % (e.__class__.__name__, e)
+
+
+class Command(BaseCommand):
+    """
+    并行生成商品静态详情页面
+    python manage.py generate_detail_html           # 只生成上次生成之后有修改的商品
+    python manage.py generate_detail_html --full    # 生成所有商品
+    """
+    help = '按商品SPU并行生成静态详情页面，默认只生成上次生成之后有修改的商品'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='生成所有商品的页面')
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='工作进程数')
+        parser.add_argument('--chunk-size', type=int, default=constants.GOODS_DETAIL_HTML_CHUNK_SIZE,
+                            help='每次分派给工作进程的商品数量')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        category_version = get_goods_category_version()
+        watermark = get_detail_html_watermark()
+
+        # 1. 确定需要生成的商品: 首次生成、指定--full或商品分类变化(所有页面的分类菜单都需要更新)时生成所有商品
+        if options['full'] or watermark is None or watermark[1] != category_version:
+            self.stdout.write('生成所有商品的静态详情页面')
+            goods_ids = Goods.objects.order_by('id').values_list('id', flat=True).iterator()
+        else:
+            goods_ids = sorted(get_changed_goods_ids(watermark[0]))
+            self.stdout.write('上次生成之后有修改的商品: %s个' % len(goods_ids))
+
+        # 2. 分派给工作进程并行生成，fork之前关闭当前进程的数据库连接
+        connections.close_all()
+        pages = 0
+        failures = []
+        with multiprocessing.Pool(options['processes'], initializer=_init_worker) as pool:
+            for goods_id, count, error in pool.imap_unordered(_render, goods_ids, options['chunk_size']):
+                pages += count
+                if error:
+                    failures.append(goods_id)
+                    self.stderr.write('商品%s生成失败: %s' % (goods_id, error))
+
+        # 3. 报告生成速度，全部成功时记录水位，有失败时保留原水位，下次重新生成
+        elapsed = time.time() - start_time
+        self.stdout.write('生成页面%s个，耗时%.2f秒，%.1f页/秒，失败商品%s个' % (
+            pages, elapsed, pages / elapsed if elapsed else 0, len(failures)))
+
+        if failures:
+            self.stderr.write('生成失败的商品: %s' % failures)
+        else:
+            set_detail_html_watermark(start_time, category_version)
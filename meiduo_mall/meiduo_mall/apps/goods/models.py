@@ -168,4 +168,20 @@ class SKUSpecification(BaseModel):
         verbose_name_plural = verbose_name
 
     def __str__(self):
-        return '%s: %s - %s' % (self.sku, self.spec.name, self.option.value)
\ No newline at end of file
+        return '%s: %s - %s' % (self.sku, self.spec.name, self.option.value)
+
+
+class AppliedBatch(models.Model):
+    """
+    已写入数据库的redis增量批次，用于保证同一批次只写入一次
+    """
+    batch_id = models.CharField(max_length=64, unique=True, verbose_name='批次id')
+    create_time = models.DateTimeField(auto_now_add=True, verbose_name='写入时间')
+
+    class Meta:
+        db_table = 'tb_applied_batch'
+        verbose_name = '已写入批次'
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return self.batch_id
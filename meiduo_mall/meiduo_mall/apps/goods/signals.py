@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from goods.cache import (
+    invalidate_sku_snapshots, incr_sku_price_version, incr_goods_category_version, SKU_SNAPSHOT_FIELDS
+)
+from goods.models import SKU, GoodsCategory, GoodsChannel
+from goods.stock_index import set_sku_stocks, delete_sku_stocks
+
+
+@receiver(post_save, sender=SKU)
+def sku_saved(sender, instance, update_fields=None, **kwargs):
+    """
+    SKU商品保存的事务提交之后，快照中的字段可能变化时使对应的商品快照缓存失效，并更新库存索引
+    在提交之前失效时，并发的读取可能把提交之前的数据重新写入缓存
+    """
+    sku_id, stock, is_launched = instance.id, instance.stock, instance.is_launched
+    if update_fields is None or set(update_fields) & set(SKU_SNAPSHOT_FIELDS):
+        transaction.on_commit(lambda: invalidate_sku_snapshots([sku_id]))
+    transaction.on_commit(lambda: set_sku_stocks({sku_id: (stock, is_launched)}))
+
+    # 价格可能变化，购物车汇总数据中的金额需要重新计算
+    # 提交之后再增加版本号，避免提交之前重新计算的汇总数据以旧价格记录新版本号
+    if update_fields is None or 'price' in update_fields:
+        transaction.on_commit(incr_sku_price_version)
+
+
+@receiver(post_delete, sender=SKU)
+def sku_deleted(sender, instance, **kwargs):
+    """SKU商品删除的事务提交之后，使对应的商品快照缓存失效，并从库存索引中删除"""
+    sku_id = instance.id
+    transaction.on_commit(lambda: invalidate_sku_snapshots([sku_id]))
+    transaction.on_commit(lambda: delete_sku_stocks([sku_id]))
+    transaction.on_commit(incr_sku_price_version)
+
+
+@receiver(post_save, sender=GoodsCategory)
+@receiver(post_delete, sender=GoodsCategory)
+@receiver(post_save, sender=GoodsChannel)
+@receiver(post_delete, sender=GoodsChannel)
+def category_changed(sender, **kwargs):
+    """
+    商品分类或频道修改的事务提交之后，增加分类版本号，使缓存的商品分类数据失效
+    在提交之前增加时，并发的请求可能以旧数据生成分类数据并缓存在新版本号下
+    """
+    transaction.on_commit(incr_goods_category_version)
@@ -0,0 +1,123 @@
+# SKU商品库存和上架状态索引
+# 购物车和浏览记录的参数校验只需要知道商品是否存在、是否上架以及库存，
+# 这些数据保存在redis hash(sku_stock_index)中，校验时不再每次查询数据库
+# {
+#     '<sku_id>': '<value>',  # value >= 0: 已上架，库存为value；value < 0: 未上架，库存为-value-1
+#     ...
+# }
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from goods import constants
+from goods.models import SKU
+
+SKU_STOCK_INDEX_KEY = 'sku_stock_index'
+
+# 一致性模式
+# db: 每次都查询数据库(不使用索引)
+# cache: 完全信任索引中的数据，只在索引未命中时查询数据库
+# near: 索引中的库存接近购买数量时，再查询数据库进行确认
+SKU_STOCK_INDEX_MODES = ('db', 'cache', 'near')
+
+
+def _encode(stock, is_launched):
+    return stock if is_launched else -stock - 1
+
+
+def _decode(value):
+    value = int(value)
+    if value >= 0:
+        return value, True
+    return -value - 1, False
+
+
+def get_stock_index_mode():
+    mode = getattr(settings, 'SKU_STOCK_INDEX_MODE', 'near')
+    if mode not in SKU_STOCK_INDEX_MODES:
+        raise ValueError('无效的SKU_STOCK_INDEX_MODE: %s' % mode)
+    return mode
+
+
+def set_sku_stocks(stocks):
+    """
+    更新索引中商品的库存和上架状态
+    stocks: {
+        <sku_id>: (<stock>, <is_launched>),
+        ...
+    }
+    """
+    if not stocks:
+        return
+
+    mapping = {sku_id: _encode(stock, is_launched) for sku_id, (stock, is_launched) in stocks.items()}
+
+    redis_conn = get_redis_connection('goods')
+    redis_conn.hmset(SKU_STOCK_INDEX_KEY, mapping)
+
+
+def delete_sku_stocks(sku_ids):
+    """从索引中删除商品"""
+    if not sku_ids:
+        return
+
+    redis_conn = get_redis_connection('goods')
+    redis_conn.hdel(SKU_STOCK_INDEX_KEY, *sku_ids)
+
+
+def load_sku_stocks(sku_ids):
+    """从数据库中查询商品的库存和上架状态，并写入索引"""
+    stocks = {}
+    for sku_id, stock, is_launched in SKU.objects.filter(id__in=sku_ids).values_list('id', 'stock', 'is_launched'):
+        stocks[sku_id] = (stock, is_launched)
+
+    set_sku_stocks(stocks)
+    return stocks
+
+
+def get_sku_stocks(sku_ids, counts=None):
+    """
+    批量获取商品的库存和上架状态，不存在的商品不会出现在结果中
+    sku_ids: 商品id列表
+    counts: 商品购买数量 {<sku_id>: <count>}，near模式下用于判断是否需要查询数据库确认
+    返回: {
+        <sku_id>: (<stock>, <is_launched>),
+        ...
+    }
+    """
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return {}
+
+    mode = get_stock_index_mode()
+    if mode == 'db':
+        return load_sku_stocks(sku_ids)
+
+    redis_conn = get_redis_connection('goods')
+    values = redis_conn.hmget(SKU_STOCK_INDEX_KEY, sku_ids)
+
+    stocks = {}
+    recheck = []
+    for sku_id, value in zip(sku_ids, values):
+        if value is None:
+            # 索引未命中
+            recheck.append(sku_id)
+            continue
+
+        stock, is_launched = _decode(value)
+        count = (counts or {}).get(sku_id, 0)
+        if mode == 'near' and stock - count < constants.SKU_STOCK_RECHECK_MARGIN:
+            # 库存接近购买数量，查询数据库进行确认
+            recheck.append(sku_id)
+            continue
+
+        stocks[sku_id] = (stock, is_launched)
+
+    if recheck:
+        stocks.update(load_sku_stocks(recheck))
+
+    return stocks
+
+
+def get_sku_stock(sku_id, count=0):
+    """获取商品的(库存, 上架状态)，商品不存在时返回None"""
+    return get_sku_stocks([sku_id], {int(sku_id): count}).get(int(sku_id))
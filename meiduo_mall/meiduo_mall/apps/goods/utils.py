@@ -1,31 +1,99 @@
+# 商品分类数据
+# 两次查询取出所有商品类别和频道，在内存中组装分类数据，以分类版本号为键缓存在redis中(goods_categories_<version>)，
+# 商品类别或频道修改时增加版本号，所有进程和定时任务共用同一份缓存的分类数据
+import json
+import threading
 from collections import OrderedDict
 
-from goods.models import GoodsChannel
+from django_redis import get_redis_connection
 
+from goods import constants
+from goods.cache import get_goods_category_version
+from goods.models import GoodsCategory, GoodsChannel
+
+# 进程内缓存的当前版本的分类数据
+_local_categories = {'version': None, 'categories': None}
+_local_lock = threading.Lock()
 
-def get_categories():
-    """返回商品分类的数据"""
-    categories = OrderedDict()  # 有序字典
-    channels = GoodsChannel.objects.order_by('group_id', 'sequence')
-    for channel in channels:
-        group_id = channel.group_id  # 当前组
 
-        if group_id not in categories:
-            categories[group_id] = {'channels': [], 'sub_cats': []}
+def build_categories():
+    """
+    查询数据库生成商品分类的数据:
+    [
+        [<group_id>, {
+            'channels': [{'id': <cat1_id>, 'name': <cat1_name>, 'url': <url>}, ...],
+            'sub_cats': [{'id': <cat2_id>, 'name': <cat2_name>, 'sub_cats': [{'id':, 'name':}, ...]}, ...]
+        }],
+        ...
+    ]
+    """
+    # 1. 查询所有商品类别，按父类别分组
+    # select id, name, parent_id from tb_goods_category order by id;
+    names = {}
+    children = {}
+    for cat in GoodsCategory.objects.order_by('id').values('id', 'name', 'parent_id'):
+        names[cat['id']] = cat['name']
+        children.setdefault(cat['parent_id'], []).append({'id': cat['id'], 'name': cat['name']})
 
-        cat1 = channel.category  # 当前频道的类别
+    # 2. 按组号和组内顺序查询所有频道
+    # select group_id, category_id, url from tb_goods_channel order by group_id, sequence;
+    groups = OrderedDict()
+    for channel in GoodsChannel.objects.order_by('group_id', 'sequence').values('group_id', 'category_id', 'url'):
+        group = groups.setdefault(channel['group_id'], {'channels': [], 'sub_cats': []})
 
         # 追加当前频道
-        categories[group_id]['channels'].append({
-            'id': cat1.id,
-            'name': cat1.name,
-            'url': channel.url
+        cat1_id = channel['category_id']
+        group['channels'].append({
+            'id': cat1_id,
+            'name': names.get(cat1_id),
+            'url': channel['url']
         })
+
         # 构建当前类别的子类别
-        for cat2 in cat1.goodscategory_set.all():
-            cat2.sub_cats = []
-            for cat3 in cat2.goodscategory_set.all():
-                cat2.sub_cats.append(cat3)
-            categories[group_id]['sub_cats'].append(cat2)
+        for cat2 in children.get(cat1_id, []):
+            group['sub_cats'].append({
+                'id': cat2['id'],
+                'name': cat2['name'],
+                'sub_cats': children.get(cat2['id'], [])
+            })
+
+    return list(groups.items())
+
+
+def get_categories():
+    """
+    返回商品分类的数据(有序字典，多次调用共用同一个对象，不要修改):
+    {
+        <group_id>: {
+            'channels': [{'id':, 'name':, 'url':}, ...],
+            'sub_cats': [{'id':, 'name':, 'sub_cats': [{'id':, 'name':}, ...]}, ...]
+        },
+        ...
+    }
+    1. 当前版本的数据已在进程内缓存时直接返回
+    2. 从redis中获取当前版本的数据，不存在时查询数据库生成并保存到redis中
+    """
+    version = get_goods_category_version()
+
+    # 1. 进程内缓存
+    with _local_lock:
+        if _local_categories['version'] == version:
+            return _local_categories['categories']
+
+    # 2. redis中当前版本的数据
+    key = 'goods_categories_%s' % version
+    redis_conn = get_redis_connection('goods')
+    data = redis_conn.get(key)
+    if data is None:
+        groups = build_categories()
+        redis_conn.set(key, json.dumps(groups), ex=constants.GOODS_CATEGORIES_REDIS_EXPIRES)
+    else:
+        groups = json.loads(data.decode())
+
+    categories = OrderedDict((group_id, group) for group_id, group in groups)
+
+    with _local_lock:
+        _local_categories['version'] = version
+        _local_categories['categories'] = categories
 
-    return categories
\ No newline at end of file
+    return categories
@@ -35,7 +35,7 @@ class SKUListView(ListAPIView):
 
     # 排序
     filter_backends = [OrderingFilter]
-    # 指定排序字段
+    # 指定排序字段，sales为已经写入数据库的销量(goods.counters定时写入)
     ordering_fields = ('create_time', 'price', 'sales')
 
     # def get(self, request, category_id):
@@ -0,0 +1,42 @@
+# 异步下单凭证的有效期
+ORDER_TICKET_EXPIRES = 60 * 60
+
+# 订单id中节点号的个数(4位)和每个节点每毫秒的序号个数(3位)
+ORDER_ID_MAX_NODES = 10000
+ORDER_ID_MAX_SEQ = 1000
+
+# 未配置节点号时，每个进程通过redis租用一个节点号:
+# order_id_node为分配节点号时开始查找的位置，order_id_node_<node>为节点号的租约(SET NX EX)
+ORDER_ID_NODE_KEY = 'order_id_node'
+ORDER_ID_NODE_LEASE_KEY = 'order_id_node_%s'
+
+# 节点号租约的有效期(秒)，持有节点号的进程每隔有效期的1/3续约一次
+ORDER_ID_NODE_LEASE = 30
+
+# 乐观锁更新商品库存的最大尝试次数
+ORDER_STOCK_OPTIMISTIC_RETRIES = 3
+
+# 组提交时收集同一商品库存减少请求的时间窗口(秒)、一个批次的最大请求数，以及下单线程等待结果的超时时间(秒)
+ORDER_STOCK_GROUP_WINDOW = 0.005
+ORDER_STOCK_GROUP_MAX_BATCH = 500
+ORDER_STOCK_GROUP_TIMEOUT = 5
+
+# 组提交中商品提交锁的有效期(秒)，leader进程崩溃时其他进程在锁过期之后接手
+ORDER_STOCK_GROUP_LOCK_EXPIRES = 10
+
+# 组提交减少的库存由预留记录持有，超过有效期(秒)仍未被订单确认的预留记录由对账任务归还，以及每批处理的预留记录数
+ORDER_STOCK_HOLD_EXPIRES = 60
+ORDER_STOCK_HOLD_BATCH_SIZE = 100
+
+# 在线支付订单的支付期限，超时未支付的订单自动取消
+ORDER_UNPAID_EXPIRES = 30 * 60
+
+# 每批取消的超时订单数，以及取出的订单在处理完成之前被其他任务重新取出的等待时间(秒)
+ORDER_CANCEL_BATCH_SIZE = 100
+ORDER_CANCEL_LEASE = 60
+
+# 秒杀商品库存预留的有效期(秒)，下单进程在此期间内未提交订单时，预留的库存由对账任务归还
+ORDER_FLASH_HOLD_EXPIRES = 60
+
+# 每批处理的过期预留数
+ORDER_FLASH_HOLD_BATCH_SIZE = 100
@@ -0,0 +1,26 @@
+import time
+
+from orders.expiration import cancel_expired_orders
+from orders.group_commit import expire_stock_holds
+from orders.reservation import reconcile_flash_stocks
+
+
+def reconcile_flash_stock():
+    """将秒杀商品在redis中预留的库存批量写入数据库"""
+    print('%s: reconcile_flash_stock' % time.ctime())
+    pending = reconcile_flash_stocks()
+    print('写入数据库的库存减少量: %s' % pending)
+
+
+def cancel_unpaid_orders():
+    """取消超过支付期限仍未支付的订单，并归还库存"""
+    print('%s: cancel_unpaid_orders' % time.ctime())
+    total = cancel_expired_orders()
+    print('取消超时未支付订单%s个' % total)
+
+
+def expire_stock_hold():
+    """归还组提交中超过有效期仍未被订单确认的库存预留"""
+    print('%s: expire_stock_hold' % time.ctime())
+    total = expire_stock_holds()
+    print('归还过期的库存预留%s条' % total)
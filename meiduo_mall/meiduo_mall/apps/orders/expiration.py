@@ -0,0 +1,147 @@
+# 待支付订单的超时取消
+# 在线支付的订单创建之后，订单id按支付截止时间加入redis zset(order_unpaid_deadlines)中，
+# 支付成功时从zset中删除，后台任务每次只取出已经到期的订单，不需要定期扫描tb_order_info。
+# 订单在下单事务提交之前登记，已提交的待支付订单一定已经登记
+# {
+#     '<order_id>': <支付截止时间戳>,
+#     ...
+# }
+import logging
+import time
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django_redis import get_redis_connection
+
+from goods.counters import incr_sales
+from goods.models import SKU
+from goods.stock_index import load_sku_stocks
+from orders import constants
+from orders.models import OrderInfo, OrderGoods
+from orders.reservation import get_flash_sku_ids, release_stocks
+
+logger = logging.getLogger('django')
+
+ORDER_UNPAID_DEADLINES_KEY = 'order_unpaid_deadlines'
+
+# 取出一批已经到期的订单，并把它们的截止时间推迟一个租期:
+# 处理完成之后再从zset中删除，处理过程中崩溃时，租期过后这些订单会被重新取出
+# KEYS: order_unpaid_deadlines
+# ARGV: now, batch_size, lease
+POP_DUE_SCRIPT = """
+local order_ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local lease_until = tonumber(ARGV[1]) + tonumber(ARGV[3])
+for _, order_id in ipairs(order_ids) do
+    redis.call('zadd', KEYS[1], lease_until, order_id)
+end
+return order_ids
+"""
+
+_pop_due_script = None
+
+
+def schedule_order_cancel(order_id, expires=constants.ORDER_UNPAID_EXPIRES):
+    """
+    订单在expires秒之后仍未支付时自动取消
+    在下单事务提交之前调用: 登记失败时订单随事务回滚，事务回滚之后遗留的登记在到期时因订单不存在而被跳过
+    """
+    redis_conn = get_redis_connection('orders')
+    redis_conn.execute_command('ZADD', ORDER_UNPAID_DEADLINES_KEY, time.time() + expires, order_id)
+
+
+def get_unpaid_deadline(order):
+    """获取待支付订单的支付截止时间戳"""
+    return order.create_time.timestamp() + constants.ORDER_UNPAID_EXPIRES
+
+
+def unschedule_order_cancel(order_id):
+    """订单已支付，不再需要自动取消"""
+    redis_conn = get_redis_connection('orders')
+    redis_conn.zrem(ORDER_UNPAID_DEADLINES_KEY, order_id)
+
+
+def _pop_due_orders():
+    global _pop_due_script
+
+    if _pop_due_script is None:
+        _pop_due_script = get_redis_connection('orders').register_script(POP_DUE_SCRIPT)
+
+    args = [time.time(), constants.ORDER_CANCEL_BATCH_SIZE, constants.ORDER_CANCEL_LEASE]
+    return [order_id.decode() for order_id in _pop_due_script(keys=[ORDER_UNPAID_DEADLINES_KEY], args=args)]
+
+
+def _restore_db_stocks(counts):
+    """
+    一条UPDATE语句归还多个商品的库存
+    counts: {
+        <sku_id>: <count>,
+        ...
+    }
+    """
+    whens = [When(id=sku_id, then=Value(count)) for sku_id, count in counts.items()]
+    delta = Case(*whens, default=Value(0), output_field=IntegerField())
+    SKU.objects.filter(id__in=counts.keys()).update(stock=F('stock') + delta)
+
+
+def cancel_orders(order_ids):
+    """
+    取消仍未支付的订单，并归还订单商品的库存，返回实际取消的订单id列表
+    1. 锁定仍处于待支付状态的订单，条件更新订单状态为已取消(已支付的订单不受影响)
+    2. 按商品汇总已取消订单的商品数量，一条UPDATE归还库存；秒杀商品归还到redis预留库存中
+    3. 减少商品销量
+    """
+    unpaid = OrderInfo.ORDER_STATUS_ENUM['UNPAID']
+
+    with transaction.atomic():
+        # 1. 锁定仍处于待支付状态的订单，条件更新订单状态为已取消
+        canceled = list(OrderInfo.objects.select_for_update().filter(
+            order_id__in=order_ids, status=unpaid).order_by('order_id').values_list('order_id', flat=True))
+
+        if not canceled:
+            return []
+
+        OrderInfo.objects.filter(order_id__in=canceled, status=unpaid).update(
+            status=OrderInfo.ORDER_STATUS_ENUM['CANCELED'])
+
+        # 2. 按商品汇总已取消订单的商品数量
+        rows = list(OrderGoods.objects.filter(order_id__in=canceled).values('sku_id', 'sku__goods_id').annotate(
+            total=Sum('count')).values_list('sku_id', 'sku__goods_id', 'total'))
+        counts = {sku_id: total for sku_id, _, total in rows}
+
+        flash_sku_ids = get_flash_sku_ids(counts.keys())
+        db_counts = {sku_id: count for sku_id, count in counts.items() if sku_id not in flash_sku_ids}
+        if db_counts:
+            _restore_db_stocks(db_counts)
+
+    # 秒杀商品的库存在redis中，归还到预留库存中，由对账任务写回数据库
+    release_stocks({sku_id: counts[sku_id] for sku_id in flash_sku_ids})
+
+    # 只修改了库存，商品快照不变，只刷新库存索引
+    if db_counts:
+        load_sku_stocks(list(db_counts.keys()))
+
+    # 3. 减少商品销量，由定时任务批量写入数据库
+    incr_sales([(sku_id, goods_id, -total) for sku_id, goods_id, total in rows])
+
+    return canceled
+
+
+def cancel_expired_orders():
+    """分批取消所有已经超过支付截止时间的订单，返回取消的订单数"""
+    redis_conn = get_redis_connection('orders')
+
+    total = 0
+    while True:
+        order_ids = _pop_due_orders()
+        if not order_ids:
+            break
+
+        canceled = cancel_orders(order_ids)
+        total += len(canceled)
+        if canceled:
+            logger.info('取消超时未支付订单: %s' % canceled)
+
+        # 已取消或已支付的订单都不再需要处理
+        redis_conn.zrem(ORDER_UNPAID_DEADLINES_KEY, *order_ids)
+
+    return total
@@ -0,0 +1,320 @@
+# 热点商品库存的组提交
+# 大量订单同时购买同一个商品时，每个订单各自执行一次条件更新，会在tb_sku的同一行锁上排队。
+# 组提交时，下单线程把库存减少请求交给提交线程，提交线程在一个很短的时间窗口内收集请求，
+# 同一个商品的所有请求合并为一条UPDATE语句执行，再把每个请求的成功或失败通知给等待的下单线程，
+# 热点行上的吞吐量随批次大小增加，而不再受限于一次行锁往返
+#
+# 跨进程合并:
+# 1. 下单线程把请求('<order_id>:<count>')放入redis list(stock_group_queue_<sku_id>)，并通知当前进程的提交线程
+# 2. 提交线程在时间窗口之后获取商品的提交锁(stock_group_lock_<sku_id>，SET NX PX)，获取到锁的进程成为leader，
+#    取出所有进程放入的请求合并执行，再把每个请求的结果('<sku_id>:<result>')放入redis list(stock_group_result_<order_id>)
+# 3. 没有获取到锁的进程不需要处理，leader会一直处理到队列为空，释放锁之后队列不为空时重新竞争
+#
+# 预留记录: 提交线程使用自己的数据库连接，库存的修改独立于下单事务提交，
+# 合并执行的事务中同时为每个成功的请求插入一条预留记录(tb_stock_hold)，减少的库存由预留记录持有:
+# 1. 下单事务提交之前，在下单事务中删除订单的预留记录(confirm_holds)，订单提交之后库存归订单所有
+# 2. 下单失败时，在下单事务之外删除预留记录并归还库存(release_holds)
+# 3. 进程在两者之间崩溃或等待结果超时，预留记录保留在数据库中，由对账任务(expire_stock_holds)归还
+# 删除预留记录与归还库存在同一个事务中，按删除的行数决定是否归还，一条预留记录只会被订单或归还中的一方取走
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.db import transaction, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from goods.models import SKU
+from orders import constants
+from orders.models import StockHold
+
+logger = logging.getLogger('django')
+
+STOCK_GROUP_QUEUE_KEY = 'stock_group_queue_%s'
+STOCK_GROUP_LOCK_KEY = 'stock_group_lock_%s'
+STOCK_GROUP_RESULT_KEY = 'stock_group_result_%s'
+
+# 请求结果
+RESULT_OK = 'ok'
+RESULT_MISSING = 'missing'  # 商品不存在
+RESULT_INSUFFICIENT = 'insufficient'  # 商品库存不足
+RESULT_ERROR = 'error'  # 合并执行异常
+
+# 从队列头部取出最多ARGV[1]个请求
+# KEYS: stock_group_queue_<sku_id>
+# ARGV: max_batch
+POP_REQUESTS_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('ltrim', KEYS[1], #items, -1)
+end
+return items
+"""
+
+# 只有锁的持有者才能释放锁
+# KEYS: stock_group_lock_<sku_id>
+# ARGV: token
+UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class StockGroupCommitter(object):
+    """组提交: 下单线程提交请求并等待结果，各进程的提交线程竞争成为leader，合并执行所有进程的请求"""
+    def __init__(self, window=constants.ORDER_STOCK_GROUP_WINDOW, max_batch=constants.ORDER_STOCK_GROUP_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._scripts = {}
+
+    def _ensure_started(self):
+        """首次使用时启动提交线程，fork出的子进程中重新启动"""
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='stock-group-committer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _get_script(self, name, source):
+        script = self._scripts.get(name)
+        if script is None:
+            script = get_redis_connection('orders').register_script(source)
+            self._scripts[name] = script
+        return script
+
+    def _notify(self, sku_ids):
+        """通知当前进程的提交线程处理商品的请求队列"""
+        self._ensure_started()
+        for sku_id in sku_ids:
+            self._queue.put(sku_id)
+
+    def submit(self, order_id, items):
+        """
+        提交一个订单所有商品的库存减少请求，并等待结果
+        items: {
+            <sku_id>: <count>,
+            ...
+        }
+        返回: {<sku_id>: RESULT_*}，超时没有得到结果的商品不在返回值中
+        """
+        redis_conn = get_redis_connection('orders')
+        result_key = STOCK_GROUP_RESULT_KEY % order_id
+
+        pl = redis_conn.pipeline(transaction=False)
+        for sku_id in sorted(items):
+            pl.rpush(STOCK_GROUP_QUEUE_KEY % sku_id, '%s:%s' % (order_id, items[sku_id]))
+        pl.execute()
+        self._notify(sorted(items))
+
+        results = {}
+        deadline = time.time() + constants.ORDER_STOCK_GROUP_TIMEOUT
+        while len(results) < len(items) and time.time() < deadline:
+            item = redis_conn.blpop([result_key], timeout=1)
+            if item is None:
+                # 请求可能在leader释放锁时放入队列而没有被处理，重新通知提交线程
+                self._notify([sku_id for sku_id in sorted(items) if sku_id not in results])
+                continue
+
+            sku_id, result = item[1].decode().split(':')
+            results[int(sku_id)] = result
+
+        redis_conn.delete(result_key)
+        return results
+
+    def _collect(self):
+        """阻塞等待第一个通知，然后在时间窗口内继续收集，返回需要处理的sku_id集合"""
+        sku_ids = {self._queue.get()}
+        deadline = time.time() + self.window
+
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                sku_ids.add(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return sku_ids
+
+    def _run(self):
+        while True:
+            sku_ids = self._collect()
+
+            close_old_connections()
+            for sku_id in sorted(sku_ids):
+                try:
+                    self._lead(sku_id)
+                except Exception as e:
+                    logger.error('商品库存组提交异常: [sku_id: %s] %s' % (sku_id, e))
+
+    def _lead(self, sku_id):
+        """
+        获取商品的提交锁，成为leader之后处理队列中所有进程的请求，直到队列为空
+        锁只用于让一个进程合并尽可能多的请求: 锁过期之后两个进程同时处理时，每个请求仍然只会被取出一次
+        """
+        redis_conn = get_redis_connection('orders')
+        queue_key = STOCK_GROUP_QUEUE_KEY % sku_id
+        lock_key = STOCK_GROUP_LOCK_KEY % sku_id
+        pop = self._get_script('pop', POP_REQUESTS_SCRIPT)
+        unlock = self._get_script('unlock', UNLOCK_SCRIPT)
+
+        while True:
+            token = uuid.uuid4().hex
+            if not redis_conn.set(lock_key, token, nx=True, px=constants.ORDER_STOCK_GROUP_LOCK_EXPIRES * 1000):
+                # 其他进程正在处理该商品的请求
+                return
+
+            try:
+                while True:
+                    items = pop(keys=[queue_key], args=[self.max_batch])
+                    if not items:
+                        break
+
+                    requests = []
+                    for item in items:
+                        order_id, count = item.decode().split(':')
+                        requests.append((order_id, int(count)))
+
+                    try:
+                        results = self._apply(sku_id, requests)
+                    except Exception as e:
+                        # 事务已回滚或提交结果未知，提交之后的预留记录由下单失败时的归还或对账任务处理
+                        logger.error('商品库存组提交异常: [sku_id: %s] %s' % (sku_id, e))
+                        results = [RESULT_ERROR] * len(requests)
+
+                    self._publish(sku_id, requests, results)
+            finally:
+                unlock(keys=[lock_key], args=[token])
+
+            # 释放锁之前放入队列的请求可能没有进程处理
+            if not redis_conn.llen(queue_key):
+                return
+
+    @staticmethod
+    def _apply(sku_id, requests):
+        """
+        在一个事务中合并执行同一个商品的请求，并为成功的请求插入预留记录
+        requests: [(<order_id>, <count>), ...]，按到达顺序排列
+        返回与requests一一对应的结果列表
+        """
+        total = sum(count for order_id, count in requests)
+
+        with transaction.atomic():
+            # 1. 快速路径: 库存足够所有请求时，一条条件更新完成整个批次
+            if SKU.objects.filter(id=sku_id, stock__gte=total).update(stock=F('stock') - total):
+                results = [RESULT_OK] * len(requests)
+            else:
+                # 2. 库存不足以满足所有请求: 锁定该商品，按到达顺序满足库存足够的请求，剩余请求失败
+                stock = SKU.objects.select_for_update().filter(id=sku_id).values_list('stock', flat=True).first()
+                if stock is None:
+                    return [RESULT_MISSING] * len(requests)
+
+                results = []
+                accepted = 0
+                for order_id, count in requests:
+                    if accepted + count <= stock:
+                        accepted += count
+                        results.append(RESULT_OK)
+                    else:
+                        results.append(RESULT_INSUFFICIENT)
+
+                if accepted:
+                    SKU.objects.filter(id=sku_id).update(stock=F('stock') - accepted)
+
+            # 3. 减少的库存由预留记录持有，与库存的修改一起提交
+            StockHold.objects.bulk_create([
+                StockHold(order_id=order_id, sku_id=sku_id, count=count)
+                for (order_id, count), result in zip(requests, results) if result == RESULT_OK
+            ])
+
+        return results
+
+    @staticmethod
+    def _publish(sku_id, requests, results):
+        """把每个请求的结果放入对应订单的结果队列"""
+        redis_conn = get_redis_connection('orders')
+        pl = redis_conn.pipeline(transaction=False)
+        for (order_id, count), result in zip(requests, results):
+            result_key = STOCK_GROUP_RESULT_KEY % order_id
+            pl.rpush(result_key, '%s:%s' % (sku_id, result))
+            pl.expire(result_key, constants.ORDER_STOCK_GROUP_TIMEOUT * 2)
+        pl.execute()
+
+
+stock_group_committer = StockGroupCommitter()
+
+
+def confirm_holds(order_id, count):
+    """
+    在下单事务中、提交之前删除订单的count条预留记录，订单提交之后减少的库存归订单所有
+    预留记录已被归还(等待超时或对账任务)时返回False，下单事务需要回滚
+    """
+    # 按主键删除，只锁定预留记录本身，不会因为order_id索引上的间隙锁阻塞leader插入其他订单的预留记录
+    hold_ids = list(StockHold.objects.filter(order_id=order_id).values_list('id', flat=True))
+    if len(hold_ids) != count:
+        return False
+
+    deleted, _ = StockHold.objects.filter(id__in=hold_ids).delete()
+    return deleted == count
+
+
+def _release_hold(hold_id, sku_id, count):
+    """在一个事务中删除预留记录并归还库存，预留记录已被订单或其他归还取走时不归还"""
+    with transaction.atomic():
+        deleted, _ = StockHold.objects.filter(id=hold_id).delete()
+        if not deleted:
+            return False
+
+        SKU.objects.filter(id=sku_id).update(stock=F('stock') + count)
+
+    return True
+
+
+def release_holds(order_id):
+    """下单失败时归还订单预留的库存，必须在下单事务之外调用，返回归还的{<sku_id>: <count>}"""
+    holds = StockHold.objects.filter(order_id=order_id).order_by('sku_id').values_list('id', 'sku_id', 'count')
+
+    released = {}
+    for hold_id, sku_id, count in holds:
+        if _release_hold(hold_id, sku_id, count):
+            released[sku_id] = count
+
+    return released
+
+
+def expire_stock_holds():
+    """
+    归还超过有效期仍未被订单确认的预留记录，返回归还的预留记录数
+    下单进程在库存减少之后、下单事务提交之前崩溃，或等待结果超时之后请求才执行成功时，预留记录由此归还
+    """
+    expired = timezone.now() - timedelta(seconds=constants.ORDER_STOCK_HOLD_EXPIRES)
+
+    released = 0
+    last_id = 0
+    while True:
+        holds = list(StockHold.objects.filter(create_time__lt=expired, id__gt=last_id).order_by('id').values_list(
+            'id', 'sku_id', 'count')[:constants.ORDER_STOCK_HOLD_BATCH_SIZE])
+
+        for hold_id, sku_id, count in holds:
+            if _release_hold(hold_id, sku_id, count):
+                released += 1
+                logger.warning('归还过期的商品库存预留: [sku_id: %s count: %s]' % (sku_id, count))
+
+        if len(holds) < constants.ORDER_STOCK_HOLD_BATCH_SIZE:
+            break
+        last_id = holds[-1][0]
+
+    return released
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from orders.reservation import (
+    FLASH_SKU_STOCK_KEY, FLASH_SKU_PENDING_KEY, load_flash_skus, unload_flash_skus, reconcile_flash_stocks
+)
+
+
+class Command(BaseCommand):
+    """
+    管理秒杀商品的redis库存预留
+    python manage.py flash_stock load <sku_id> [<sku_id> ...]
+    python manage.py flash_stock unload <sku_id> [<sku_id> ...]
+    python manage.py flash_stock reconcile
+    python manage.py flash_stock status
+    """
+    help = '标记/取消秒杀商品，并将预留的库存写入数据库'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('load', 'unload', 'reconcile', 'status'))
+        parser.add_argument('sku_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_ids = options['sku_ids']
+
+        if action == 'load':
+            loaded = load_flash_skus(sku_ids)
+            for sku_id, stock in loaded.items():
+                self.stdout.write('标记秒杀商品%s，库存%s' % (sku_id, stock))
+        elif action == 'unload':
+            pending = unload_flash_skus(sku_ids)
+            self.stdout.write('取消秒杀商品%s，写入数据库的库存减少量: %s' % (sku_ids, pending))
+        elif action == 'reconcile':
+            pending = reconcile_flash_stocks()
+            self.stdout.write('写入数据库的库存减少量: %s' % pending)
+        else:
+            redis_conn = get_redis_connection('orders')
+            stocks = redis_conn.hgetall(FLASH_SKU_STOCK_KEY)
+            pending = redis_conn.hgetall(FLASH_SKU_PENDING_KEY)
+            for sku_id in sorted(stocks, key=int):
+                self.stdout.write('商品%s: redis库存%s，待写入数据库%s' % (
+                    sku_id.decode(), stocks[sku_id].decode(), int(pending.get(sku_id, 0))))
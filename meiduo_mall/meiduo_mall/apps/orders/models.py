@@ -25,7 +25,8 @@ class OrderInfo(BaseModel):
         "UNSEND": 2,
         "UNRECEIVED": 3,
         "UNCOMMENT": 4,
-        "FINISHED": 5
+        "FINISHED": 5,
+        "CANCELED": 6
     }
 
     ORDER_STATUS_CHOICES = (
@@ -50,6 +51,10 @@ class OrderInfo(BaseModel):
         db_table = "tb_order_info"
         verbose_name = '订单基本信息'
         verbose_name_plural = verbose_name
+        # 用户订单列表按(user_id, create_time)查询和排序
+        indexes = [
+            models.Index(fields=['user', 'create_time'], name='order_info_user_create_time'),
+        ]
 
 
 class OrderGoods(BaseModel):
@@ -76,4 +81,19 @@ class OrderGoods(BaseModel):
     class Meta:
         db_table = "tb_order_goods"
         verbose_name = '订单商品'
-        verbose_name_plural = verbose_name
\ No newline at end of file
+        verbose_name_plural = verbose_name
+
+
+class StockHold(BaseModel):
+    """
+    组提交减少的商品库存的预留记录
+    """
+    order_id = models.CharField(max_length=64, verbose_name="订单编号")
+    sku = models.ForeignKey(SKU, on_delete=models.CASCADE, verbose_name="商品")
+    count = models.IntegerField(verbose_name="数量")
+
+    class Meta:
+        db_table = "tb_stock_hold"
+        verbose_name = '商品库存预留'
+        verbose_name_plural = verbose_name
+        unique_together = ('order_id', 'sku')
@@ -0,0 +1,355 @@
+# 秒杀商品的redis库存预留
+# 被标记为秒杀的商品，其库存被复制到redis hash(flash_sku_stock)中，下单时先通过lua脚本原子地预留库存，
+# 预留成功的订单才会访问数据库，数据库中该商品的库存不再在下单事务中修改，热点行上不再有CAS重试
+# {
+#     '<sku_id>': '<redis中可预留的库存>',
+#     ...
+# }
+# 已预留但尚未写入数据库的库存减少量保存在redis hash(flash_sku_pending)中，由对账任务批量写入tb_sku
+# {
+#     '<sku_id>': '<待写入数据库的库存减少量>',
+#     ...
+# }
+# 每个订单预留的库存同时记录在redis hash(flash_hold_<order_id>)中，并按过期时间加入zset(flash_sku_holds):
+# {
+#     '<sku_id>': '<预留数量>',
+#     ...
+#     '__state': 'held'(已预留) | 'confirmed'(下单事务即将提交)
+# }
+# 下单进程在订单提交之前崩溃时，对账任务把过期的预留归还到可预留的库存中，预留的库存不会丢失
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+
+from goods.batches import new_batch_id, mark_batch_applied, clear_applied_batches
+from goods.models import SKU
+from goods.stock_index import load_sku_stocks
+from orders import constants
+from orders.models import OrderInfo
+
+logger = logging.getLogger('django')
+
+FLASH_SKU_STOCK_KEY = 'flash_sku_stock'
+FLASH_SKU_PENDING_KEY = 'flash_sku_pending'
+# 对账任务正在写入数据库的库存减少量
+FLASH_SKU_APPLYING_KEY = 'flash_sku_applying'
+# 订单预留记录的过期时间
+FLASH_SKU_HOLDS_KEY = 'flash_sku_holds'
+# flash_sku_applying中记录批次id的字段
+BATCH_ID_FIELD = '__batch_id'
+
+# 预留状态
+HOLD_STATE_HELD = 'held'
+HOLD_STATE_CONFIRMED = 'confirmed'
+
+# 预留库存：所有秒杀商品的库存都足够时才全部预留，否则都不预留，预留的商品和数量记录到订单的预留记录中
+# KEYS: flash_sku_stock, flash_sku_pending, flash_sku_holds, flash_hold_<order_id>
+# ARGV: order_id, 过期时间戳, sku_id, count, sku_id, count, ...
+# 返回: {1, <预留的sku_id>, ...} 或 {0, <库存不足的sku_id>}
+RESERVE_SCRIPT = """
+local reserved = {}
+for i = 3, #ARGV, 2 do
+    local stock = redis.call('hget', KEYS[1], ARGV[i])
+    if stock then
+        if tonumber(stock) < tonumber(ARGV[i + 1]) then
+            return {0, ARGV[i]}
+        end
+        table.insert(reserved, i)
+    end
+end
+
+local result = {1}
+for _, i in ipairs(reserved) do
+    redis.call('hincrby', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+    redis.call('hincrby', KEYS[2], ARGV[i], ARGV[i + 1])
+    redis.call('hset', KEYS[4], ARGV[i], ARGV[i + 1])
+    table.insert(result, ARGV[i])
+end
+
+if #reserved > 0 then
+    redis.call('hset', KEYS[4], '__state', 'held')
+    redis.call('zadd', KEYS[3], ARGV[2], ARGV[1])
+end
+return result
+"""
+
+# 下单事务提交之前确认预留: 预留已过期被归还时返回0，下单事务需要回滚
+# 确认之后延长过期时间，过期时由对账任务根据订单是否存在决定归还还是删除
+# KEYS: flash_sku_holds, flash_hold_<order_id>
+# ARGV: order_id, 过期时间戳
+CONFIRM_HOLD_SCRIPT = """
+if redis.call('hget', KEYS[2], '__state') ~= 'held' then
+    return 0
+end
+redis.call('hset', KEYS[2], '__state', 'confirmed')
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+# 归还订单预留的库存，并删除预留记录；预留记录不存在(已归还)或状态不是expected_state时不做处理
+# KEYS: flash_sku_stock, flash_sku_pending, flash_sku_holds, flash_hold_<order_id>
+# ARGV: order_id, expected_state(空字符串表示任意状态)
+RELEASE_HOLD_SCRIPT = """
+local state = redis.call('hget', KEYS[4], '__state')
+if not state then
+    redis.call('zrem', KEYS[3], ARGV[1])
+    return 0
+end
+if ARGV[2] ~= '' and state ~= ARGV[2] then
+    return 0
+end
+
+local items = redis.call('hgetall', KEYS[4])
+for i = 1, #items, 2 do
+    if items[i] ~= '__state' then
+        if redis.call('hexists', KEYS[1], items[i]) == 1 then
+            redis.call('hincrby', KEYS[1], items[i], items[i + 1])
+        end
+        if redis.call('hincrby', KEYS[2], items[i], -tonumber(items[i + 1])) == 0 then
+            redis.call('hdel', KEYS[2], items[i])
+        end
+    end
+end
+redis.call('del', KEYS[4])
+redis.call('zrem', KEYS[3], ARGV[1])
+return 1
+"""
+
+# 归还库存(已提交的订单被取消时)，已取消秒杀标记的商品只减少待写入数据库的数量
+# 预留记录已经被对账任务取走时，待写入数据库的数量为负数，下次对账时把库存加回数据库
+# KEYS: flash_sku_stock, flash_sku_pending
+# ARGV: sku_id, count, sku_id, count, ...
+RELEASE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call('hexists', KEYS[1], ARGV[i]) == 1 then
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    if redis.call('hincrby', KEYS[2], ARGV[i], -tonumber(ARGV[i + 1])) == 0 then
+        redis.call('hdel', KEYS[2], ARGV[i])
+    end
+end
+return #ARGV / 2
+"""
+
+# 取出待写入数据库的库存减少量和批次id，上次对账未完成时继续处理上次的数据(批次id不变)
+# KEYS: flash_sku_pending, flash_sku_applying
+# ARGV: 新批次的id
+FETCH_PENDING_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 0 then
+    if redis.call('exists', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('rename', KEYS[1], KEYS[2])
+    redis.call('hset', KEYS[2], '__batch_id', ARGV[1])
+end
+return redis.call('hgetall', KEYS[2])
+"""
+
+
+class FlashStockError(Exception):
+    """秒杀商品库存不足"""
+    def __init__(self, sku_id):
+        super().__init__('商品库存不足: %s' % sku_id)
+        self.sku_id = sku_id
+
+
+def is_reservation_enabled():
+    return getattr(settings, 'ORDER_STOCK_RESERVATION', False)
+
+
+# 已注册的脚本对象: {'<name>': Script}
+_registered_scripts = {}
+
+
+def _get_script(name, source):
+    script = _registered_scripts.get(name)
+    if script is None:
+        script = get_redis_connection('orders').register_script(source)
+        _registered_scripts[name] = script
+    return script
+
+
+def _hold_key(order_id):
+    return 'flash_hold_%s' % order_id
+
+
+def reserve_stocks(cart_dict, order_id):
+    """
+    为订单中的秒杀商品预留库存，返回预留的商品和数量{<sku_id>: <count>}，非秒杀商品不会出现在结果中
+    cart_dict: {
+        <sku_id>: <count>,
+        ...
+    }
+    预留记录在ORDER_FLASH_HOLD_EXPIRES秒之后过期，下单事务提交之前需要调用confirm_hold确认
+    秒杀商品库存不足时抛出FlashStockError
+    """
+    if not cart_dict:
+        return {}
+
+    args = [order_id, time.time() + constants.ORDER_FLASH_HOLD_EXPIRES]
+    for sku_id in sorted(cart_dict):
+        args.extend([sku_id, cart_dict[sku_id]])
+
+    script = _get_script('reserve', RESERVE_SCRIPT)
+    result = script(keys=[FLASH_SKU_STOCK_KEY, FLASH_SKU_PENDING_KEY, FLASH_SKU_HOLDS_KEY, _hold_key(order_id)],
+                    args=args)
+
+    if not result[0]:
+        raise FlashStockError(int(result[1]))
+
+    return {int(sku_id): cart_dict[int(sku_id)] for sku_id in result[1:]}
+
+
+def confirm_hold(order_id):
+    """在下单事务中、提交之前确认订单的预留，预留已过期被归还时返回False"""
+    script = _get_script('confirm_hold', CONFIRM_HOLD_SCRIPT)
+    args = [order_id, time.time() + constants.ORDER_FLASH_HOLD_EXPIRES]
+    return bool(script(keys=[FLASH_SKU_HOLDS_KEY, _hold_key(order_id)], args=args))
+
+
+def finish_hold(order_id):
+    """订单已提交，预留的库存已经属于订单，删除预留记录"""
+    redis_conn = get_redis_connection('orders')
+    pl = redis_conn.pipeline()
+    pl.delete(_hold_key(order_id))
+    pl.zrem(FLASH_SKU_HOLDS_KEY, order_id)
+    pl.execute()
+
+
+def release_hold(order_id, expected_state=''):
+    """订单创建失败时归还订单预留的库存，预留已经归还过时不做处理，返回是否归还"""
+    script = _get_script('release_hold', RELEASE_HOLD_SCRIPT)
+    keys = [FLASH_SKU_STOCK_KEY, FLASH_SKU_PENDING_KEY, FLASH_SKU_HOLDS_KEY, _hold_key(order_id)]
+    return bool(script(keys=keys, args=[order_id, expected_state]))
+
+
+def expire_holds():
+    """
+    处理过期的订单预留记录，返回归还的订单id列表:
+    1. 未确认的预留: 下单进程崩溃或超时，归还库存
+    2. 已确认的预留: 订单已提交时删除预留记录，订单不存在(确认之后事务未提交)时归还库存
+    """
+    redis_conn = get_redis_connection('orders')
+
+    released = []
+    while True:
+        order_ids = redis_conn.zrangebyscore(FLASH_SKU_HOLDS_KEY, '-inf', time.time(),
+                                             start=0, num=constants.ORDER_FLASH_HOLD_BATCH_SIZE)
+        for order_id in order_ids:
+            order_id = order_id.decode()
+            state = redis_conn.hget(_hold_key(order_id), '__state')
+            state = state.decode() if state is not None else ''
+
+            if state == HOLD_STATE_CONFIRMED and OrderInfo.objects.filter(order_id=order_id).exists():
+                finish_hold(order_id)
+            elif release_hold(order_id, state):
+                released.append(order_id)
+            else:
+                # 预留记录已不存在或状态已变化
+                redis_conn.zrem(FLASH_SKU_HOLDS_KEY, order_id)
+
+        if len(order_ids) < constants.ORDER_FLASH_HOLD_BATCH_SIZE:
+            break
+
+    if released:
+        logger.warning('归还过期的秒杀商品预留: %s' % released)
+
+    return released
+
+
+def release_stocks(reserved):
+    """归还已取消订单中秒杀商品的库存"""
+    if not reserved:
+        return
+
+    args = []
+    for sku_id, count in reserved.items():
+        args.extend([sku_id, count])
+
+    script = _get_script('release', RELEASE_SCRIPT)
+    script(keys=[FLASH_SKU_STOCK_KEY, FLASH_SKU_PENDING_KEY], args=args)
+
+
+def get_flash_sku_ids(sku_ids):
+    """返回sku_ids中被标记为秒杀商品的sku_id集合"""
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return set()
+
+    redis_conn = get_redis_connection('orders')
+    stocks = redis_conn.hmget(FLASH_SKU_STOCK_KEY, sku_ids)
+    return {sku_id for sku_id, stock in zip(sku_ids, stocks) if stock is not None}
+
+
+def load_flash_skus(sku_ids):
+    """将商品标记为秒杀商品，并将数据库中的库存复制到redis中，已经标记的商品不受影响"""
+    redis_conn = get_redis_connection('orders')
+
+    loaded = {}
+    for sku_id, stock in SKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'):
+        if redis_conn.hsetnx(FLASH_SKU_STOCK_KEY, sku_id, stock):
+            loaded[sku_id] = stock
+
+    return loaded
+
+
+def unload_flash_skus(sku_ids):
+    """取消商品的秒杀标记，并将已预留的库存写入数据库"""
+    if sku_ids:
+        redis_conn = get_redis_connection('orders')
+        redis_conn.hdel(FLASH_SKU_STOCK_KEY, *sku_ids)
+
+    return reconcile_flash_stocks()
+
+
+def reconcile_flash_stocks():
+    """
+    将秒杀商品已预留的库存减少量批量写入数据库:
+    0. 归还过期的订单预留
+    1. 将flash_sku_pending改名为flash_sku_applying并记录批次id，之后的预留记录到新的flash_sku_pending中
+    2. 在一个事务中记录批次id并更新tb_sku的库存，批次已经写入过(上次在第2步和第3步之间崩溃)时不再写入
+    3. 删除flash_sku_applying，并刷新库存索引
+    返回: {<sku_id>: <写入的库存减少量>}
+    """
+    redis_conn = get_redis_connection('orders')
+
+    # 0. 归还过期的订单预留
+    expire_holds()
+
+    # 1. 取出待写入数据库的库存减少量和批次id
+    script = _get_script('fetch_pending', FETCH_PENDING_SCRIPT)
+    items = script(keys=[FLASH_SKU_PENDING_KEY, FLASH_SKU_APPLYING_KEY], args=[new_batch_id('flash_stock')])
+    items = dict(zip(items[::2], items[1::2]))
+    if not items:
+        return {}
+
+    # 升级之前遗留的flash_sku_applying中没有批次id
+    batch_id = items.pop(BATCH_ID_FIELD.encode(), b'').decode() or new_batch_id('flash_stock')
+
+    pending = {}
+    for sku_id, count in items.items():
+        if int(count) != 0:
+            pending[int(sku_id)] = int(count)
+
+    # 2. 在一个事务中记录批次id并更新tb_sku的库存，按sku_id升序更新，避免与下单事务死锁
+    with transaction.atomic():
+        if mark_batch_applied(batch_id):
+            for sku_id in sorted(pending):
+                SKU.objects.filter(id=sku_id).update(stock=F('stock') - pending[sku_id])
+        else:
+            logger.warning('秒杀商品库存批次已写入数据库，不再重复写入: %s' % batch_id)
+            pending = {}
+
+    # 3. 删除flash_sku_applying，并刷新库存索引(只修改了库存，商品快照不变)
+    redis_conn.delete(FLASH_SKU_APPLYING_KEY)
+    clear_applied_batches()
+
+    if pending:
+        load_sku_stocks(list(pending.keys()))
+        logger.info('秒杀商品库存对账完成: %s' % pending)
+
+    return pending
@@ -1,13 +1,27 @@
-from datetime import datetime
-
 from decimal import Decimal
 
 from django.db import transaction
-from django_redis import get_redis_connection
 from rest_framework import serializers
 
+from cart.storage import CartRedisStorage
+from goods.counters import incr_sales
 from goods.models import SKU
+from goods.stock_index import set_sku_stocks
+from orders.expiration import schedule_order_cancel
 from orders.models import OrderInfo, OrderGoods
+from orders.reservation import (
+    is_reservation_enabled, reserve_stocks, confirm_hold, finish_hold, release_hold, FlashStockError
+)
+from orders.stock import decrement_stocks, confirm_stocks, restore_stocks, StockDecrementError
+from orders.utils import generate_order_id
+
+
+# 减少商品库存失败时的错误信息
+STOCK_ERROR_MESSAGES = {
+    StockDecrementError.MISSING: '商品不存在',
+    StockDecrementError.INSUFFICIENT: '商品库存不足',
+    StockDecrementError.CONFLICT: '下单失败2',
+}
 
 
 class OrderSKUSerializer(serializers.ModelSerializer):
@@ -19,6 +33,31 @@ class OrderSKUSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'price', 'default_image_url', 'count')
 
 
+class OrderGoodsSKUSerializer(serializers.ModelSerializer):
+    """订单列表中商品的序列化器类"""
+    class Meta:
+        model = SKU
+        fields = ('id', 'name', 'default_image_url')
+
+
+class OrderGoodsSerializer(serializers.ModelSerializer):
+    """订单列表中订单商品的序列化器类"""
+    sku = OrderGoodsSKUSerializer(label='商品')
+
+    class Meta:
+        model = OrderGoods
+        fields = ('sku', 'count', 'price')
+
+
+class OrderListSerializer(serializers.ModelSerializer):
+    """订单列表序列化器类"""
+    skus = OrderGoodsSerializer(label='订单商品', many=True)
+
+    class Meta:
+        model = OrderInfo
+        fields = ('order_id', 'create_time', 'total_count', 'total_amount', 'freight', 'pay_method', 'status', 'skus')
+
+
 class OrderSerializer(serializers.ModelSerializer):
     """订单序列化器类"""
     class Meta:
@@ -42,15 +81,11 @@ class OrderSerializer(serializers.ModelSerializer):
         address = validated_data['address']
         pay_method = validated_data['pay_method']
 
-        # 获取登录用户
-        user = self.context['request'].user
+        # 获取下单用户(异步下单时由下单任务传入)
+        user = self.context['user'] if 'user' in self.context else self.context['request'].user
 
-        # 订单id: 年月日时分秒+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + '%010d' % user.id
-
-        # 订单商品总数和实付款
-        total_count = 0
-        total_amount = Decimal(0)
+        # 订单id: 年月日时分秒毫秒+节点号+序号
+        order_id = generate_order_id(user)
 
         # 运费: 10
         freight = Decimal(10.0)
@@ -63,248 +98,133 @@ class OrderSerializer(serializers.ModelSerializer):
 
         status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] if pay_method == OrderInfo.PAY_METHODS_ENUM['CASH'] else OrderInfo.ORDER_STATUS_ENUM['UNPAID']
 
-        # 获取redis链接
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set中获取用户购物车中被勾选的商品的id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash中获取用户购物车中添加的所有商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
+        # 从redis中获取用户购物车中被勾选的商品的id和对应数量count
+        cart_storage = CartRedisStorage(user.id)
 
         # {
-        #     b'<sku_id>': b'<count>',
+        #     <sku_id>: <count>,
         #     ...
         # }
-        cart_redis = redis_conn.hgetall(cart_key)
-
-        with transaction.atomic():
-            # with语句块下的代码，凡是涉及到数据库操作的代码，在进行数据库操作时，都会放在同一个事务中
-
-            # 设置一个事务的保存点
-            sid = transaction.savepoint()
-
-            try:
-                # 1）向订单基本信息表中添加一条记录
-                order = OrderInfo.objects.create(
-                    order_id=order_id,
-                    user=user,
-                    address=address,
-                    total_count=total_count,
-                    total_amount=total_amount,
-                    freight=freight,
-                    pay_method=pay_method,
-                    status=status
-                )
-
-                # 2）订单中包含几个商品，就需要向订单商品表中添加几条记录
-                for sku_id in sku_ids:
-                    # 获取用户所要购买的该商品的数量count
-                    count = cart_redis[sku_id]
-                    count = int(count)
-
-                    for i in range(3):
-                        # 根据sku_id获取商品对象
-                        # select * from tb_sku where id=<sku_id>;
-                        sku = SKU.objects.get(id=sku_id)
-
-                        # 商品库存判断
-                        if count > sku.stock:
-                            # 回滚事务到sid保存点
-                            transaction.savepoint_rollback(sid)
-                            raise serializers.ValidationError('商品库存不足')
-
-                        # 记录商品的原始库存
-                        origin_stock = sku.stock
-                        new_stock = origin_stock - count
-                        new_sales = sku.sales + count
-
-                        # 模拟订单并发问题
-                        # print('users: %s times: %s stock: %s' % (user.id, i, origin_stock))
-                        # import time
-                        # time.sleep(10)
-
-                        # 减少商品库存、增加销量
-                        # update tb_sku
-                        # set stock=<new_stock>, sales=<new_sales>
-                        # where id=<sku_id> and stock=<origin_stock>;
-                        # res: 更新行数
-                        res = SKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
-
-                        if res == 0:
-                            if i == 2:
-                                # 循序更新了3次，仍然更新失败，直接下单失败
-                                # 回滚事务到sid保存点
-                                transaction.savepoint_rollback(sid)
-                                raise serializers.ValidationError('下单失败2')
-                            # 更新失败，重新进行尝试
-                            continue
-
-                        # 向订单商品表添加一条记录
-                        OrderGoods.objects.create(
-                            order=order,
-                            sku=sku,
-                            count=count,
-                            price=sku.price
-                        )
-
-                        # 累加计算订单中商品的总数量和总金额
-                        total_count += count
-                        total_amount += sku.price*count
-
-                        # 更新成功，break跳出循环
-                        break
-
-                # 实付款
-                total_amount += freight
-                # 更新订单商品的总数量和实付款
-                order.total_count = total_count
-                order.total_amount = total_amount
-                order.save()
-            except serializers.ValidationError:
-                # 继续向外抛出捕获的异常
-                raise
-            except Exception:
-                # 回滚事务到sid保存点
-                transaction.savepoint_rollback(sid)
-                raise serializers.ValidationError('下单失败1')
-
-        # 3）删除redis中对应购物车记录
-        pl = redis_conn.pipeline()
-        pl.hdel(cart_key, *sku_ids)
-        pl.srem(cart_selected_key, *sku_ids)
-        pl.execute()
-
-        return order
-
-    def create_1(self, validated_data):
-        """保存订单的数据"""
-        # 获取address和pay_method
-        address = validated_data['address']
-        pay_method = validated_data['pay_method']
-
-        # 获取登录用户
-        user = self.context['request'].user
-
-        # 订单id: 年月日时分秒+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + '%010d' % user.id
-
-        # 订单商品总数和实付款
-        total_count = 0
-        total_amount = Decimal(0)
-
-        # 运费: 10
-        freight = Decimal(10.0)
-
-        # 支付状态
-        # if pay_method == OrderInfo.PAY_METHODS_ENUM['CASH']: # 货到付款
-        #     status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] # 待发货
-        # else: # 在线支付
-        #     status = OrderInfo.ORDER_STATUS_ENUM['UNPAID'] # 待支付
-
-        status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] if pay_method == OrderInfo.PAY_METHODS_ENUM['CASH'] else OrderInfo.ORDER_STATUS_ENUM['UNPAID']
-
-        # 获取redis链接
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set中获取用户购物车中被勾选的商品的id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash中获取用户购物车中添加的所有商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
+        cart_dict = cart_storage.get_selected()
 
+        # 下单之后商品的库存和上架状态，用于更新商品库存索引
         # {
-        #     b'<sku_id>': b'<count>',
+        #     <sku_id>: (<stock>, <is_launched>),
         #     ...
         # }
-        cart_redis = redis_conn.hgetall(cart_key)
+        sku_stocks = {}
 
-        with transaction.atomic():
-            # with语句块下的代码，凡是涉及到数据库操作的代码，在进行数据库操作时，都会放在同一个事务中
+        if not cart_dict:
+            raise serializers.ValidationError('没有需要结算的商品')
 
-            # 设置一个事务的保存点
-            sid = transaction.savepoint()
+        # 按sku_id升序处理商品
+        sku_ids = sorted(cart_dict)
 
+        # 秒杀商品先在redis中预留库存，库存不足时直接下单失败，不再访问数据库
+        # 预留记录以订单id为键，下单进程崩溃时过期的预留由对账任务归还
+        reserved = {}
+        if is_reservation_enabled():
             try:
-                # 1）向订单基本信息表中添加一条记录
-                order = OrderInfo.objects.create(
-                    order_id=order_id,
-                    user=user,
-                    address=address,
-                    total_count=total_count,
-                    total_amount=total_amount,
-                    freight=freight,
-                    pay_method=pay_method,
-                    status=status
-                )
-
-                # 2）订单中包含几个商品，就需要向订单商品表中添加几条记录
-                for sku_id in sku_ids:
-                    # 获取用户所要购买的该商品的数量count
-                    count = cart_redis[sku_id]
-                    count = int(count)
-
-                    # 根据sku_id获取商品对象
-                    # select * from tb_sku where id=<sku_id>;
-                    # sku = SKU.objects.get(id=sku_id)
-
-                    # select * from tb_sku where id=<sku_id> for update;
-                    print('user: %s try get lock' % user.id)
-                    sku = SKU.objects.select_for_update().get(id=sku_id)
-                    print('user: %s get locked' % user.id)
-
-                    # 商品库存判断
-                    if count > sku.stock:
+                reserved = reserve_stocks(cart_dict, order_id)
+            except FlashStockError:
+                raise serializers.ValidationError('商品库存不足')
+
+        # 请求减少库存的商品和数量，组提交策略下单失败时需要在下单事务之外归还
+        decremented = {}
+
+        try:
+            with transaction.atomic():
+                # with语句块下的代码，凡是涉及到数据库操作的代码，在进行数据库操作时，都会放在同一个事务中
+
+                # 设置一个事务的保存点
+                sid = transaction.savepoint()
+
+                try:
+                    # 1）使用配置的策略按sku_id升序减少商品库存，并获取更新之后的商品数据
+                    # 秒杀商品的库存已在redis中预留，由对账任务批量写入数据库
+                    items = {sku_id: cart_dict[sku_id] for sku_id in sku_ids if sku_id not in reserved}
+                    # 组提交失败时部分商品的库存可能已经减少，先记录下来
+                    decremented = items
+                    try:
+                        skus = decrement_stocks(items, order_id)
+                    except StockDecrementError as e:
                         # 回滚事务到sid保存点
                         transaction.savepoint_rollback(sid)
-                        raise serializers.ValidationError('商品库存不足')
-
-                    # 模拟订单并发问题
-                    # print('users: %s' % user.id)
-                    import time
-                    time.sleep(10)
-
-                    # 减少商品库存、增加销量
-                    sku.stock -= count
-                    sku.sales += count
-                    sku.save()
-
-                    # 向订单商品表添加一条记录
-                    OrderGoods.objects.create(
-                        order=order,
-                        sku=sku,
-                        count=count,
-                        price=sku.price
+                        raise serializers.ValidationError(STOCK_ERROR_MESSAGES[e.reason])
+
+                    for sku_id, sku in skus.items():
+                        sku_stocks[sku_id] = (sku.stock, sku.is_launched)
+
+                    # 2）查询秒杀商品的数据
+                    if reserved:
+                        skus.update(SKU.objects.in_bulk(list(reserved)))
+
+                    if len(skus) != len(sku_ids):
+                        # 回滚事务到sid保存点
+                        transaction.savepoint_rollback(sid)
+                        raise serializers.ValidationError('商品不存在')
+
+                    # 3）计算订单中商品的总数量和实付款
+                    total_count = sum(cart_dict.values())
+                    total_amount = sum(skus[sku_id].price * cart_dict[sku_id] for sku_id in sku_ids) + freight
+
+                    # 4）向订单基本信息表中添加一条记录，商品总数和实付款直接保存最终结果
+                    order = OrderInfo.objects.create(
+                        order_id=order_id,
+                        user=user,
+                        address=address,
+                        total_count=total_count,
+                        total_amount=total_amount,
+                        freight=freight,
+                        pay_method=pay_method,
+                        status=status
                     )
 
-                    # 累加计算订单中商品的总数量和总金额
-                    total_count += count
-                    total_amount += sku.price*count
-
-                # 实付款
-                total_amount += freight
-                # 更新订单商品的总数量和实付款
-                order.total_count = total_count
-                order.total_amount = total_amount
-                order.save()
-            except serializers.ValidationError:
-                # 继续向外抛出捕获的异常
-                raise
-            except Exception:
-                # 回滚事务到sid保存点
-                transaction.savepoint_rollback(sid)
-                raise serializers.ValidationError('下单失败1')
+                    # 5）一次向订单商品表中添加订单中的所有商品记录
+                    OrderGoods.objects.bulk_create([
+                        OrderGoods(
+                            order=order,
+                            sku=skus[sku_id],
+                            count=cart_dict[sku_id],
+                            price=skus[sku_id].price
+                        )
+                        for sku_id in sku_ids
+                    ])
+
+                    # 6）提交之前确认组提交减少的库存和秒杀商品的预留，已过期被归还时下单失败
+                    if not confirm_stocks(decremented, order_id) or (reserved and not confirm_hold(order_id)):
+                        transaction.savepoint_rollback(sid)
+                        raise serializers.ValidationError('下单超时，请重新下单')
+
+                    # 7）在线支付的订单超时未支付时自动取消，在订单提交之前登记，登记失败时下单失败
+                    # 重复登记只会覆盖截止时间；事务回滚时登记的订单不存在，取消任务直接跳过
+                    if status == OrderInfo.ORDER_STATUS_ENUM['UNPAID']:
+                        schedule_order_cancel(order_id)
+                except serializers.ValidationError:
+                    # 继续向外抛出捕获的异常
+                    raise
+                except Exception:
+                    # 回滚事务到sid保存点
+                    transaction.savepoint_rollback(sid)
+                    raise serializers.ValidationError('下单失败1')
+        except Exception:
+            # 订单创建失败，归还预留的库存和组提交中已经减少的库存
+            if reserved:
+                release_hold(order_id)
+            restore_stocks(decremented, order_id)
+            raise
+
+        # 订单已提交，删除秒杀商品的预留记录
+        if reserved:
+            finish_hold(order_id)
+
+        # 下单只修改库存，商品快照(名称、价格、图片)不变，只更新商品库存索引
+        set_sku_stocks(sku_stocks)
+
+        # 增加商品销量，由定时任务批量写入数据库
+        incr_sales([(sku_id, skus[sku_id].goods_id, cart_dict[sku_id]) for sku_id in sku_ids])
 
         # 3）删除redis中对应购物车记录
-        pl = redis_conn.pipeline()
-        pl.hdel(cart_key, *sku_ids)
-        pl.srem(cart_selected_key, *sku_ids)
-        pl.execute()
+        cart_storage.delete_many(list(cart_dict.keys()))
 
         return order
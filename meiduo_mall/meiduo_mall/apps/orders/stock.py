@@ -0,0 +1,316 @@
+# 下单时减少商品库存的策略(销量由goods.counters延迟写入数据库)
+# 所有策略都按sku_id升序锁定和更新商品，多个商品的订单并发时不会因为加锁顺序不同而死锁
+# optimistic: 乐观锁，update ... where stock=<原始库存>，更新失败时重新查询该商品并重试
+# pessimistic: 悲观锁，select ... for update按sku_id升序锁定所有商品之后再更新
+# conditional: 条件更新，update ... set stock=stock-n where stock>=n，一条语句完成判断和更新
+# group: 组提交，所有进程中并发订单对同一商品的库存减少在几毫秒的窗口内合并为一条条件更新，
+#        减少的库存由预留记录持有，下单事务提交之前确认，未确认的预留记录由对账任务归还(见orders.group_commit)
+# 每次下单按商品记录尝试次数、冲突次数、重试次数和等待锁的时间，保存在redis hash(stock_metrics_<sku_id>)中
+# {
+#     '<strategy>:<metric>': '<value>',
+#     ...
+# }
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import F
+from django_redis import get_redis_connection
+from redis import RedisError
+
+from goods.models import SKU
+from orders import constants
+from orders.group_commit import (
+    stock_group_committer, confirm_holds, release_holds, RESULT_OK, RESULT_MISSING, RESULT_INSUFFICIENT
+)
+
+logger = logging.getLogger('django')
+
+
+class StockDecrementError(Exception):
+    """减少商品库存失败"""
+    # 失败原因
+    MISSING = 'missing'  # 商品不存在
+    INSUFFICIENT = 'insufficient'  # 商品库存不足
+    CONFLICT = 'conflict'  # 并发冲突，重试之后仍然失败
+
+    def __init__(self, sku_id, reason):
+        super().__init__('减少商品库存失败: %s %s' % (sku_id, reason))
+        self.sku_id = sku_id
+        self.reason = reason
+
+
+class StockMetrics(object):
+    """一次下单中各个商品的库存更新指标，下单结束之后通过一次pipeline写入redis"""
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self._metrics = {}
+
+    def incr(self, sku_id, metric, amount=1):
+        key = (sku_id, metric)
+        self._metrics[key] = self._metrics.get(key, 0) + amount
+
+    def save(self):
+        if not self._metrics:
+            return
+
+        # 指标写入失败不影响下单
+        try:
+            redis_conn = get_redis_connection('orders')
+            pl = redis_conn.pipeline(transaction=False)
+            for (sku_id, metric), amount in self._metrics.items():
+                pl.hincrby('stock_metrics_%s' % sku_id, '%s:%s' % (self.strategy, metric), int(amount))
+            pl.execute()
+        except RedisError as e:
+            logger.warning('商品库存更新指标保存失败: %s' % e)
+
+
+def get_stock_metrics(sku_id):
+    """
+    获取商品的库存更新指标:
+    {
+        '<strategy>': {'attempts': <尝试次数>, 'conflicts': <冲突次数>, 'retries': <重试次数>,
+                       'failures': <失败次数>, 'lock_wait_us': <等待锁的总时间(微秒)>},
+        ...
+    }
+    """
+    redis_conn = get_redis_connection('orders')
+    metrics = {}
+    for field, value in redis_conn.hgetall('stock_metrics_%s' % sku_id).items():
+        strategy, metric = field.decode().split(':', 1)
+        metrics.setdefault(strategy, {})[metric] = int(value)
+
+    return metrics
+
+
+class StockStrategy(object):
+    """库存更新策略基类"""
+    name = None
+    # 库存的修改是否独立于下单事务提交，是时下单事务提交之前需要调用confirm确认，下单失败时需要调用restore归还库存
+    independent = False
+
+    def decrement(self, items, metrics, order_id):
+        """
+        为订单order_id减少商品库存，必须在事务中调用，失败时抛出StockDecrementError
+        items: {
+            <sku_id>: <count>,
+            ...
+        }
+        返回更新之后的商品对象: {<sku_id>: <SKU>}
+        """
+        raise NotImplementedError
+
+    def confirm(self, items, order_id):
+        """在下单事务中、提交之前确认独立提交的库存减少，库存已被归还时返回False"""
+        return True
+
+    def restore(self, items, order_id):
+        """归还独立提交的库存减少"""
+        pass
+
+
+class OptimisticStockStrategy(StockStrategy):
+    """乐观锁"""
+    name = 'optimistic'
+
+    def decrement(self, items, metrics, order_id):
+        # select * from tb_sku where id in (<sku_id>, ...);
+        skus = SKU.objects.in_bulk(sorted(items))
+
+        for sku_id in sorted(items):
+            count = items[sku_id]
+            if sku_id not in skus:
+                raise StockDecrementError(sku_id, StockDecrementError.MISSING)
+
+            sku = skus[sku_id]
+            for i in range(constants.ORDER_STOCK_OPTIMISTIC_RETRIES):
+                metrics.incr(sku_id, 'attempts')
+                if i > 0:
+                    metrics.incr(sku_id, 'retries')
+
+                # 商品库存判断
+                if count > sku.stock:
+                    raise StockDecrementError(sku_id, StockDecrementError.INSUFFICIENT)
+
+                # update tb_sku
+                # set stock=<new_stock>
+                # where id=<sku_id> and stock=<origin_stock>;
+                origin_stock = sku.stock
+                start = time.time()
+                res = SKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=origin_stock - count)
+                metrics.incr(sku_id, 'lock_wait_us', (time.time() - start) * 10 ** 6)
+
+                if res:
+                    sku.stock -= count
+                    break
+
+                # 更新失败，只重新查询该商品之后再进行尝试
+                metrics.incr(sku_id, 'conflicts')
+                sku = SKU.objects.get(id=sku_id)
+                skus[sku_id] = sku
+            else:
+                raise StockDecrementError(sku_id, StockDecrementError.CONFLICT)
+
+        return skus
+
+
+class PessimisticStockStrategy(StockStrategy):
+    """悲观锁"""
+    name = 'pessimistic'
+
+    def decrement(self, items, metrics, order_id):
+        # select * from tb_sku where id in (<sku_id>, ...) order by id for update;
+        start = time.time()
+        skus = {sku.id: sku for sku in SKU.objects.select_for_update().filter(id__in=items).order_by('id')}
+        lock_wait = (time.time() - start) * 10 ** 6
+
+        for sku_id in sorted(items):
+            count = items[sku_id]
+            metrics.incr(sku_id, 'attempts')
+            metrics.incr(sku_id, 'lock_wait_us', lock_wait / len(items))
+
+            if sku_id not in skus:
+                raise StockDecrementError(sku_id, StockDecrementError.MISSING)
+
+            sku = skus[sku_id]
+            if count > sku.stock:
+                raise StockDecrementError(sku_id, StockDecrementError.INSUFFICIENT)
+
+            sku.stock -= count
+            SKU.objects.filter(id=sku_id).update(stock=sku.stock)
+
+        return skus
+
+
+class ConditionalStockStrategy(StockStrategy):
+    """条件更新"""
+    name = 'conditional'
+
+    def decrement(self, items, metrics, order_id):
+        for sku_id in sorted(items):
+            count = items[sku_id]
+            metrics.incr(sku_id, 'attempts')
+
+            # update tb_sku
+            # set stock=stock-<count>
+            # where id=<sku_id> and stock>=<count>;
+            start = time.time()
+            res = SKU.objects.filter(id=sku_id, stock__gte=count).update(stock=F('stock') - count)
+            metrics.incr(sku_id, 'lock_wait_us', (time.time() - start) * 10 ** 6)
+
+            if not res:
+                reason = StockDecrementError.INSUFFICIENT
+                if not SKU.objects.filter(id=sku_id).exists():
+                    reason = StockDecrementError.MISSING
+                raise StockDecrementError(sku_id, reason)
+
+        # 查询更新之后的商品数据(库存、上架状态、价格)
+        return SKU.objects.in_bulk(sorted(items))
+
+
+class GroupStockStrategy(StockStrategy):
+    """组提交，减少的库存由预留记录持有，下单事务提交之前确认"""
+    name = 'group'
+    independent = True
+
+    def decrement(self, items, metrics, order_id):
+        # 提交订单所有商品的库存减少请求，等待所有请求的结果
+        start = time.time()
+        results = stock_group_committer.submit(order_id, items)
+        lock_wait = (time.time() - start) * 10 ** 6
+
+        for sku_id in sorted(items):
+            metrics.incr(sku_id, 'attempts')
+            metrics.incr(sku_id, 'lock_wait_us', lock_wait / len(items))
+
+        # 已经减少的库存由下单失败时的restore在下单事务之外归还，
+        # 超时没有得到结果的请求之后执行成功时，预留记录由对账任务归还
+        failed = [sku_id for sku_id in sorted(items) if results.get(sku_id) != RESULT_OK]
+        if failed:
+            sku_id = failed[0]
+            result = results.get(sku_id)
+            if result == RESULT_MISSING:
+                raise StockDecrementError(sku_id, StockDecrementError.MISSING)
+            elif result == RESULT_INSUFFICIENT:
+                raise StockDecrementError(sku_id, StockDecrementError.INSUFFICIENT)
+            metrics.incr(sku_id, 'conflicts')
+            raise StockDecrementError(sku_id, StockDecrementError.CONFLICT)
+
+        # 查询更新之后的商品数据(库存、上架状态、价格)
+        return SKU.objects.in_bulk(sorted(items))
+
+    def confirm(self, items, order_id):
+        return confirm_holds(order_id, len(items))
+
+    def restore(self, items, order_id):
+        released = release_holds(order_id)
+        if released:
+            logger.info('归还订单%s减少的商品库存: %s' % (order_id, released))
+
+
+STOCK_STRATEGIES = {
+    strategy.name: strategy for strategy in (
+        OptimisticStockStrategy, PessimisticStockStrategy, ConditionalStockStrategy, GroupStockStrategy
+    )
+}
+
+
+def get_stock_strategy():
+    """获取配置(ORDER_STOCK_STRATEGY)的库存更新策略"""
+    name = getattr(settings, 'ORDER_STOCK_STRATEGY', 'optimistic')
+    if name not in STOCK_STRATEGIES:
+        raise ValueError('无效的ORDER_STOCK_STRATEGY: %s' % name)
+
+    return STOCK_STRATEGIES[name]()
+
+
+def decrement_stocks(items, order_id):
+    """
+    使用配置的策略为订单order_id减少商品库存，必须在事务中调用
+    items: {
+        <sku_id>: <count>,
+        ...
+    }
+    返回更新之后的商品对象: {<sku_id>: <SKU>}
+    """
+    if not items:
+        return {}
+
+    strategy = get_stock_strategy()
+    metrics = StockMetrics(strategy.name)
+
+    try:
+        return strategy.decrement(items, metrics, order_id)
+    except StockDecrementError as e:
+        metrics.incr(e.sku_id, 'failures')
+        raise
+    finally:
+        metrics.save()
+
+
+def confirm_stocks(items, order_id):
+    """
+    在下单事务中、提交之前确认已经独立提交的库存减少(组提交)，库存修改在下单事务中的策略不需要确认
+    减少的库存已被归还(等待超时或对账任务)时返回False，下单事务需要回滚
+    """
+    if not items:
+        return True
+
+    return get_stock_strategy().confirm(items, order_id)
+
+
+def restore_stocks(items, order_id):
+    """
+    下单失败时归还已经独立提交的库存减少(组提交)，必须在下单事务之外调用，
+    库存修改在下单事务中的策略随事务回滚，不需要归还
+    items: {
+        <sku_id>: <count>,
+        ...
+    }
+    """
+    if not items:
+        return
+
+    strategy = get_stock_strategy()
+    if strategy.independent:
+        strategy.restore(items, order_id)
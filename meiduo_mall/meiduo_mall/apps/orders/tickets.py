@@ -0,0 +1,58 @@
+# 异步下单的凭证
+# 异步下单时接口立即返回一个凭证，下单任务的状态和结果保存在redis hash(order_ticket_<ticket_id>)中，
+# 客户端通过凭证轮询下单结果
+# {
+#     'user_id': '<下单用户id>',
+#     'status': 'pending'|'processing'|'success'|'failed',
+#     'order_id': '<订单id>',  # 下单成功时
+#     'message': '<失败原因>'   # 下单失败时
+# }
+import uuid
+
+from django_redis import get_redis_connection
+
+from orders import constants
+
+TICKET_STATUS_PENDING = 'pending'
+TICKET_STATUS_PROCESSING = 'processing'
+TICKET_STATUS_SUCCESS = 'success'
+TICKET_STATUS_FAILED = 'failed'
+
+
+def _ticket_key(ticket_id):
+    return 'order_ticket_%s' % ticket_id
+
+
+def create_ticket(user_id):
+    """创建一个下单凭证，返回凭证id"""
+    ticket_id = uuid.uuid4().hex
+
+    redis_conn = get_redis_connection('orders')
+    pl = redis_conn.pipeline()
+    pl.hmset(_ticket_key(ticket_id), {'user_id': user_id, 'status': TICKET_STATUS_PENDING})
+    pl.expire(_ticket_key(ticket_id), constants.ORDER_TICKET_EXPIRES)
+    pl.execute()
+
+    return ticket_id
+
+
+def update_ticket(ticket_id, status, **fields):
+    """更新下单凭证的状态和结果"""
+    fields['status'] = status
+
+    redis_conn = get_redis_connection('orders')
+    pl = redis_conn.pipeline()
+    pl.hmset(_ticket_key(ticket_id), fields)
+    pl.expire(_ticket_key(ticket_id), constants.ORDER_TICKET_EXPIRES)
+    pl.execute()
+
+
+def get_ticket(ticket_id):
+    """获取下单凭证的数据，凭证不存在或已过期时返回None"""
+    redis_conn = get_redis_connection('orders')
+    data = redis_conn.hgetall(_ticket_key(ticket_id))
+
+    if not data:
+        return None
+
+    return {key.decode(): value.decode() for key, value in data.items()}
@@ -5,4 +5,5 @@ from orders import views
 urlpatterns = [
     url(r'^orders/settlement/$', views.OrderSettlementView.as_view()),
     url(r'^orders/$', views.OrdersView.as_view()),
+    url(r'^orders/tickets/(?P<ticket_id>[0-9a-f]{32})/$', views.OrderTicketView.as_view()),
 ]
\ No newline at end of file
@@ -0,0 +1,212 @@
+# 订单id生成器
+# 订单id是24位数字: 年月日时分秒(14位) + 毫秒(3位) + 节点号(4位) + 毫秒内序号(3位)
+# 节点号区分生成订单id的进程，每个进程在本地分配毫秒内的序号，生成订单id不需要访问数据库或redis；
+# 同一进程生成的订单id严格递增，不同进程生成的订单id按时间大致有序
+#
+# 未配置节点号时，每个进程在redis中租用一个节点号(order_id_node_<node>，SET NX EX)，后台线程定期续约，
+# 同一时刻一个节点号只属于一个进程；所有节点号都被占用时生成订单id失败，而不是与其他进程共用节点号。
+# 续约失败或续约线程停顿，本地记录的租约到期之后，生成订单id前重新租用节点号
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+
+from orders import constants
+
+
+class OrderIdNodeError(Exception):
+    """没有可用的订单id节点号"""
+    pass
+
+
+# 只有租约的持有者才能续约和释放
+# KEYS: order_id_node_<node>
+# ARGV: token, lease
+RENEW_NODE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_NODE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class OrderIdGenerator(object):
+    """订单id生成器基类"""
+    def generate(self, user):
+        raise NotImplementedError
+
+
+class TimestampUserOrderIdGenerator(OrderIdGenerator):
+    """旧的订单id: 年月日时分秒+用户id，同一用户一秒内的多个订单id会重复"""
+    def generate(self, user):
+        return datetime.now().strftime('%Y%m%d%H%M%S') + '%010d' % user.id
+
+
+class SnowflakeOrderIdGenerator(OrderIdGenerator):
+    """时间 + 节点号 + 序号的订单id生成器"""
+    def __init__(self, node=None):
+        # 指定的节点号，为None时在首次生成订单id时分配
+        self._fixed_node = node
+        self._node = None
+        self._pid = None
+        self._last_ms = -1
+        self._seq = 0
+        self._lock = threading.Lock()
+
+        # 租用的节点号: 租约的token、本地记录的租约到期时间和续约线程的停止事件
+        self._token = None
+        self._lease_until = None
+        self._stop = None
+
+    def _allocate_node(self):
+        """
+        获取当前进程的节点号:
+        1. 配置了ORDER_ID_NODE(或环境变量ORDER_ID_NODE)时使用配置的节点号，适用于单进程部署
+        2. 否则通过redis租用一个空闲的节点号
+        """
+        self._lease_until = None
+        if self._fixed_node is not None:
+            return self._fixed_node
+
+        node = os.getenv('ORDER_ID_NODE', getattr(settings, 'ORDER_ID_NODE', None))
+        if node is not None:
+            return int(node) % constants.ORDER_ID_MAX_NODES
+
+        return self._lease_node()
+
+    def _lease_node(self):
+        """从order_id_node开始依次尝试租用空闲的节点号，并启动续约线程"""
+        redis_conn = get_redis_connection('orders')
+        token = '%s:%s' % (os.getpid(), uuid.uuid4().hex)
+        start = redis_conn.incr(constants.ORDER_ID_NODE_KEY)
+
+        for i in range(constants.ORDER_ID_MAX_NODES):
+            node = (start + i) % constants.ORDER_ID_MAX_NODES
+            # 在请求之前记录时间，本地记录的到期时间不会晚于redis中的到期时间
+            now = time.time()
+            if redis_conn.set(constants.ORDER_ID_NODE_LEASE_KEY % node, token,
+                              nx=True, ex=constants.ORDER_ID_NODE_LEASE):
+                break
+        else:
+            raise OrderIdNodeError('没有可用的订单id节点号')
+
+        # 停止之前的续约线程
+        if self._stop is not None:
+            self._stop.set()
+
+        self._token = token
+        self._lease_until = now + constants.ORDER_ID_NODE_LEASE
+        self._stop = threading.Event()
+        threading.Thread(target=self._renew, args=(node, token, self._stop),
+                         name='order-id-node-lease', daemon=True).start()
+        return node
+
+    def _renew(self, node, token, stop):
+        """续约线程: 每隔租约有效期的1/3续约一次，租约已被其他进程持有时停止"""
+        redis_conn = get_redis_connection('orders')
+        script = redis_conn.register_script(RENEW_NODE_SCRIPT)
+        key = constants.ORDER_ID_NODE_LEASE_KEY % node
+
+        while not stop.wait(constants.ORDER_ID_NODE_LEASE / 3):
+            try:
+                now = time.time()
+                renewed = script(keys=[key], args=[token, constants.ORDER_ID_NODE_LEASE])
+            except Exception:
+                # redis暂时不可用，本地租约到期之后生成订单id时重新租用
+                continue
+
+            with self._lock:
+                if self._token != token:
+                    return
+                if not renewed:
+                    # 租约已丢失，生成订单id时重新租用
+                    self._lease_until = 0
+                    return
+                self._lease_until = now + constants.ORDER_ID_NODE_LEASE
+
+    def release(self):
+        """释放租用的节点号(进程退出之前调用，否则节点号在租约到期之后才能被其他进程使用)"""
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+
+            if self._token is not None and self._pid == os.getpid():
+                redis_conn = get_redis_connection('orders')
+                script = redis_conn.register_script(RELEASE_NODE_SCRIPT)
+                script(keys=[constants.ORDER_ID_NODE_LEASE_KEY % self._node], args=[self._token])
+
+            self._token = None
+            self._lease_until = None
+            self._stop = None
+            self._pid = None
+
+    def _next(self):
+        """返回(毫秒时间戳, 节点号, 序号)"""
+        with self._lock:
+            # fork出的子进程需要重新分配节点号和序号(子进程中没有父进程的续约线程)
+            pid = os.getpid()
+            if pid != self._pid:
+                self._stop = None
+                self._token = None
+                self._node = self._allocate_node()
+                self._pid = pid
+                self._last_ms = -1
+                self._seq = 0
+            elif self._lease_until is not None and time.time() >= self._lease_until:
+                # 租约可能已经到期，节点号可能已被其他进程租用，重新租用节点号，序号继续递增
+                self._node = self._lease_node()
+
+            now_ms = int(time.time() * 1000)
+            if now_ms < self._last_ms:
+                # 系统时间回拨，继续使用上一次的时间，保证订单id递增
+                now_ms = self._last_ms
+
+            if now_ms == self._last_ms:
+                self._seq += 1
+                if self._seq >= constants.ORDER_ID_MAX_SEQ:
+                    # 当前毫秒的序号已用完，等待下一毫秒
+                    while now_ms <= self._last_ms:
+                        time.sleep(0.0001)
+                        now_ms = int(time.time() * 1000)
+                    self._seq = 0
+            else:
+                self._seq = 0
+
+            self._last_ms = now_ms
+            return now_ms, self._node, self._seq
+
+    def generate(self, user=None):
+        now_ms, node, seq = self._next()
+        seconds, ms = divmod(now_ms, 1000)
+        return '%s%03d%04d%03d' % (time.strftime('%Y%m%d%H%M%S', time.localtime(seconds)), ms, node, seq)
+
+
+_generator = None
+
+
+def get_order_id_generator():
+    """获取配置(ORDER_ID_GENERATOR)的订单id生成器"""
+    global _generator
+
+    if _generator is None:
+        path = getattr(settings, 'ORDER_ID_GENERATOR', 'orders.utils.SnowflakeOrderIdGenerator')
+        _generator = import_string(path)()
+
+    return _generator
+
+
+def generate_order_id(user):
+    """生成订单id"""
+    return get_order_id_generator().generate(user)
@@ -1,42 +1,114 @@
 from decimal import Decimal
+from django.conf import settings
+from django.http import Http404
 from django.shortcuts import render
-from django_redis import get_redis_connection
 from rest_framework import status
-from rest_framework.generics import GenericAPIView
+from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 
-from goods.models import SKU
-from orders.serializers import OrderSKUSerializer, OrderSerializer
+from cart.storage import CartRedisStorage
+from goods.cache import get_sku_snapshots
+from meiduo_mall.utils.idempotency import idempotent
+from meiduo_mall.utils.pagination import CreateTimeKeysetPagination
+from orders.models import OrderInfo
+from orders.serializers import OrderSKUSerializer, OrderSerializer, OrderListSerializer
+from orders.tickets import create_ticket, get_ticket, TICKET_STATUS_PENDING
 
 
 # Create your views here.
 
 
+# GET /orders/?status=<订单状态>&cursor=<游标>
 # POST /orders/
-class OrdersView(GenericAPIView):
+class OrdersView(ListAPIView):
     permission_classes = [IsAuthenticated]
-    serializer_class = OrderSerializer
+    pagination_class = CreateTimeKeysetPagination
 
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return OrderListSerializer
+        return OrderSerializer
+
+    def get_queryset(self):
+        """
+        返回登录用户的订单，可以按订单状态过滤
+        每页只需要三次查询: 订单、订单商品、商品
+        """
+        queryset = OrderInfo.objects.filter(user=self.request.user).prefetch_related('skus__sku')
+
+        order_status = self.request.query_params.get('status')
+        if order_status:
+            if order_status not in [str(value) for value, name in OrderInfo.ORDER_STATUS_CHOICES]:
+                return queryset.none()
+            queryset = queryset.filter(status=order_status)
+
+        return queryset
+
+    @idempotent('orders')
     def post(self, request):
         """
         订单数据保存:
         1. 获取参数并进行校验(参数完整性，address是否存在，pay_method是否合法)
         2. 保存订单的数据
+            2.1 如果开启了异步下单，发出下单任务，并返回下单凭证
+            2.2 否则直接保存订单的数据
         3. 返回应答，订单创建成功
         """
         # 1. 获取参数并进行校验(参数完整性，address是否存在，pay_method是否合法)
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        # 2. 保存订单的数据(create)
+        if getattr(settings, 'ORDER_ASYNC_MODE', False):
+            # 2.1 如果开启了异步下单，发出下单任务，并返回下单凭证
+            ticket_id = create_ticket(request.user.id)
+
+            # 发出下单任务
+            from celery_tasks.orders.tasks import create_order
+            create_order.delay(ticket_id, request.user.id, serializer.validated_data['address'].id,
+                               serializer.validated_data['pay_method'])
+
+            return Response({'ticket_id': ticket_id, 'status': TICKET_STATUS_PENDING}, status=status.HTTP_202_ACCEPTED)
+
+        # 2.2 否则直接保存订单的数据(create)
         serializer.save()
 
         # 3. 返回应答，订单创建成功
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
+# GET /orders/tickets/(?P<ticket_id>[0-9a-f]{32})/
+class OrderTicketView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, ticket_id):
+        """
+        获取异步下单的结果:
+        1. 根据凭证id获取下单凭证(凭证不存在或不属于登录用户时返回404)
+        2. 返回下单状态，下单成功时返回订单id，下单失败时返回失败原因
+        """
+        # 1. 根据凭证id获取下单凭证
+        ticket = get_ticket(ticket_id)
+
+        if ticket is None or ticket['user_id'] != str(request.user.id):
+            raise Http404
+
+        # 2. 返回下单状态
+        res_data = {
+            'ticket_id': ticket_id,
+            'status': ticket['status']
+        }
+
+        if 'order_id' in ticket:
+            res_data['order_id'] = ticket['order_id']
+
+        if 'message' in ticket:
+            res_data['message'] = ticket['message']
+
+        return Response(res_data)
+
+
 # GET /orders/settlement/
 class OrderSettlementView(APIView):
     permission_classes = [IsAuthenticated]
@@ -52,39 +124,19 @@ class OrderSettlementView(APIView):
         user = request.user
 
         # 1. 从登录用户的redis购物车记录中获取用户购物车中被勾选的商品id和对应数量count
-        # 获取redis链接
-        redis_conn = get_redis_connection('cart')
-
-        # 从redis set中获取用户购物车中被勾选的商品的id
-        cart_selected_key = 'cart_selected_%s' % user.id
-
-        # (b'<sku_id>', b'<sku_id>', ...)
-        sku_ids = redis_conn.smembers(cart_selected_key)
-
-        # 从redis hash中获取用户购物车中添加的所有商品的id和对应数量count
-        cart_key = 'cart_%s' % user.id
-
-        # {
-        #     b'<sku_id>': b'<count>',
-        #     ...
-        # }
-        cart_redis = redis_conn.hgetall(cart_key)
-
-        # 组织数量
         # {
         #     '<sku_id>': '<count>',
         #     ...
         # }
-        cart_dict = {}
-        for sku_id, count in cart_redis.items():
-            cart_dict[int(sku_id)] = int(count)
+        cart_dict = CartRedisStorage(user.id).get_selected()
 
         # 2. 根据商品id获取对应的商品数据并组织运费
-        skus = SKU.objects.filter(id__in=sku_ids)
+        # 商品数据从商品快照缓存中获取，缓存未命中时才查询数据库
+        skus = get_sku_snapshots(cart_dict.keys())
 
         for sku in skus:
-            # 给sku对象增加属性count，保存该商品所要结算的数量
-            sku.count = cart_dict[sku.id]
+            # 给sku增加count，保存该商品所要结算的数量
+            sku['count'] = cart_dict[sku['id']]
 
         serializer = OrderSKUSerializer(skus, many=True)
 
@@ -0,0 +1,9 @@
+# 支付宝交易的超时时间比订单的支付截止时间提前的秒数，保证订单被取消之前支付宝已关闭交易
+ALIPAY_TIMEOUT_MARGIN = 2 * 60
+
+# 订单取消之后才完成的支付，退款失败时记录到该redis hash中人工处理
+# {
+#     '<order_id>': '{"trade_id": <支付交易号>, "amount": <支付金额>, "time": <时间戳>}',
+#     ...
+# }
+LATE_PAYMENTS_KEY = 'payment_late_payments'
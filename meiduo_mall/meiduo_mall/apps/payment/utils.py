@@ -0,0 +1,37 @@
+import json
+import logging
+import time
+
+from django_redis import get_redis_connection
+
+from payment import constants
+
+logger = logging.getLogger('django')
+
+
+def refund_late_payment(alipay, order_id, trade_id, amount):
+    """
+    订单已被超时取消之后才完成的支付，原路退款
+    支付宝以商户订单号作为退款请求号，重复的退款请求不会重复退款
+    退款失败时记录到redis中人工处理，返回是否退款成功
+    """
+    try:
+        result = alipay.api_alipay_trade_refund(refund_amount=str(amount), out_trade_no=order_id)
+        refunded = result.get('code') == '10000'
+    except Exception as e:
+        logger.error('订单取消之后的支付退款异常: [order_id: %s] %s' % (order_id, e))
+        result = None
+        refunded = False
+
+    if refunded:
+        logger.warning('订单取消之后的支付已退款: [order_id: %s trade_id: %s]' % (order_id, trade_id))
+        return True
+
+    logger.error('订单取消之后的支付退款失败，需要人工处理: [order_id: %s trade_id: %s] %s' % (order_id, trade_id, result))
+    redis_conn = get_redis_connection('default')
+    redis_conn.hset(constants.LATE_PAYMENTS_KEY, order_id, json.dumps({
+        'trade_id': trade_id,
+        'amount': str(amount),
+        'time': time.time()
+    }))
+    return False
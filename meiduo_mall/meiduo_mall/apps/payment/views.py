@@ -1,4 +1,5 @@
 import os
+import time
 
 from django.shortcuts import render
 from rest_framework import status
@@ -7,9 +8,14 @@ from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 
 from django.conf import settings
+from django.db import transaction
 
+from meiduo_mall.utils.idempotency import idempotent
+from orders.expiration import get_unpaid_deadline, unschedule_order_cancel
 from orders.models import OrderInfo
+from payment import constants
 from payment.models import Payment
+from payment.utils import refund_late_payment
 
 from alipay import AliPay
 # Create your views here.
@@ -34,11 +40,12 @@ from alipay import AliPay
 class PaymentStatusView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent('payment_status')
     def put(self, request):
         """
         保存支付结果:
         1. 获取支付结果数据并进行签名验证
-        2. 校验订单是否有效
+        2. 校验订单是否有效，订单已被超时取消时退还支付金额
         3. 保存支付结果并修改订单支付状态
         4. 返回支付交易编号
         """
@@ -66,25 +73,38 @@ class PaymentStatusView(APIView):
 
         # 2. 校验订单是否有效
         order_id = data.get('out_trade_no')
+        trade_id = data.get('trade_no')
         try:
             order = OrderInfo.objects.get(order_id=order_id,
                                           user=request.user,
                                           pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'],  # 支付宝支付
-                                          status=OrderInfo.ORDER_STATUS_ENUM['UNPAID']  # 待支付
+                                          status__in=(OrderInfo.ORDER_STATUS_ENUM['UNPAID'],  # 待支付
+                                                      OrderInfo.ORDER_STATUS_ENUM['CANCELED'])  # 已取消
                                           )
         except OrderInfo.DoesNotExist:
             return Response({'message': '无效的order_id'}, status=status.HTTP_400_BAD_REQUEST)
 
         # 3. 保存支付结果并修改订单支付状态
-        trade_id = data.get('trade_no')
-        Payment.objects.create(
-            order=order,
-            trade_id=trade_id
-        )
-
-        # 修改订单支付状态
-        order.status = OrderInfo.ORDER_STATUS_ENUM['UNSEND'] # 待发货
-        order.save()
+        with transaction.atomic():
+            # 修改订单支付状态，条件更新，避免与超时取消订单同时发生时覆盖已取消的状态
+            res = OrderInfo.objects.filter(order_id=order_id,
+                                           status=OrderInfo.ORDER_STATUS_ENUM['UNPAID']
+                                           ).update(status=OrderInfo.ORDER_STATUS_ENUM['UNSEND']) # 待发货
+
+            if res:
+                Payment.objects.create(
+                    order=order,
+                    trade_id=trade_id
+                )
+
+        if res == 0:
+            # 订单已被超时取消、库存已归还，但用户已经完成支付: 原路退款，退款失败时记录下来人工处理
+            if refund_late_payment(alipay, order_id, trade_id, order.total_amount):
+                return Response({'message': '订单已取消，支付金额已原路退回'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'message': '订单已取消，支付金额将由客服退回'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # 订单已支付，不再需要超时取消
+        unschedule_order_cancel(order_id)
 
         # 4. 返回支付交易编号
         return Response({'trade_id': trade_id})
@@ -114,6 +134,11 @@ class PaymentView(APIView):
         except OrderInfo.DoesNotExist:
             return Response({'message': '无效的order_id'}, status=status.HTTP_400_BAD_REQUEST)
 
+        # 支付宝交易的超时时间在订单支付截止时间之前，超时之后支付宝关闭交易，订单取消之后用户无法再支付
+        timeout = int((get_unpaid_deadline(order) - time.time() - constants.ALIPAY_TIMEOUT_MARGIN) // 60)
+        if timeout < 1:
+            return Response({'message': '订单支付已超时'}, status=status.HTTP_400_BAD_REQUEST)
+
         # 2. 组织支付宝支付网址和参数
         # 初始化
         alipay = AliPay(
@@ -133,6 +158,7 @@ class PaymentView(APIView):
             total_amount=str(total_pay), # 订单总金额
             subject='美多商城%s' % order_id, # 订单标题
             return_url="http://www.meiduo.site:8080/pay_success.html", # 回调地址
+            timeout_express='%sm' % timeout,  # 交易超时时间(分钟)
         )
 
         # 3. 返回支付宝支付网址和参数
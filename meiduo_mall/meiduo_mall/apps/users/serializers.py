@@ -2,7 +2,7 @@ import re
 from django_redis import get_redis_connection
 from rest_framework import serializers
 
-from goods.models import SKU
+from goods.stock_index import get_sku_stock
 from users import constants
 from users.models import User, Address
 
@@ -199,9 +199,7 @@ class BrowseHistorySerializer(serializers.Serializer):
 
     def validate_sku_id(self, value):
         # sku_id商品是否存在
-        try:
-            sku = SKU.objects.get(id=value)
-        except SKU.DoesNotExist:
+        if get_sku_stock(value) is None:
             raise serializers.ValidationError('商品不存在')
 
         return value
@@ -185,7 +185,23 @@ CACHES = {
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
-    }
+    },
+    # 存储商品快照等商品数据缓存
+    "goods": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/6",
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+        }
+    },
+    # 存储秒杀商品库存预留等订单数据
+    "orders": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/7",
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+        }
+    },
 
 }
 # Session -> 缓存, 缓存 -> Redis, Session -> Redis
@@ -260,6 +276,19 @@ CORS_ORIGIN_WHITELIST = (
     'www.meiduo.site:8080',
 )
 CORS_ALLOW_CREDENTIALS = True  # 允许携带cookie
+# 允许跨域请求携带的请求头，Idempotency-Key用于下单和支付结果保存接口的幂等
+CORS_ALLOW_HEADERS = (
+    'accept',
+    'accept-encoding',
+    'authorization',
+    'content-type',
+    'dnt',
+    'origin',
+    'user-agent',
+    'x-csrftoken',
+    'x-requested-with',
+    'idempotency-key',
+)
 
 JWT_AUTH = {
     # 设置 jwt token 的有效时间
@@ -323,8 +352,21 @@ GENERATED_STATIC_HTML_FILES_DIR = os.path.join(os.path.dirname(os.path.dirname(B
 
 # 定时任务配置
 CRONJOBS = [
-    # 每1分钟执行一次生成主页静态文件
-    ('*/1 * * * *', 'contents.crons.generate_static_index_html', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log')
+    # 首页由内容修改的信号触发重新生成，以下为兜底检查
+    # 每1分钟检查首页是否标记为需要重新生成(只访问redis)
+    ('*/1 * * * *', 'contents.crons.refresh_static_index_html', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每10分钟比较首页相关表的修改时间和记录数
+    ('*/10 * * * *', 'contents.crons.check_static_index_html', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每天凌晨3点整理redis中的购物车记录
+    ('0 3 * * *', 'cart.crons.compact_carts', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每1分钟将秒杀商品在redis中预留的库存写入数据库
+    ('*/1 * * * *', 'orders.crons.reconcile_flash_stock', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每1分钟归还组提交中过期未确认的库存预留
+    ('*/1 * * * *', 'orders.crons.expire_stock_hold', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每1分钟取消超时未支付的订单
+    ('*/1 * * * *', 'orders.crons.cancel_unpaid_orders', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
+    # 每1分钟将redis中累加的商品销量、评价数写入数据库
+    ('*/1 * * * *', 'goods.crons.flush_goods_counters', '>> ' + os.path.dirname(BASE_DIR) + '/logs/crontab.log'),
 ]
 
 # 解决crontab中文问题
@@ -350,3 +392,26 @@ HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
 ALIPAY_APPID = "2016092800613949" # 开发者应用APPID
 ALIPAY_URL = "https://openapi.alipaydev.com/gateway.do" # 支付宝网关地址
 ALIPAY_DEBUG = True # 是否使用沙箱环境
+
+# 购物车参数校验时商品库存索引的一致性模式
+# db: 每次查询数据库 cache: 信任索引 near: 索引库存接近购买数量时查询数据库确认
+SKU_STOCK_INDEX_MODE = 'near'
+
+# 登录时cookie购物车合并到redis购物车的策略
+# overwrite: 使用cookie中的数量 sum: 数量相加 max: 取较大的数量
+CART_MERGE_POLICY = 'sum'
+
+# 下单时秒杀商品(python manage.py flash_stock load)是否先在redis中预留库存
+ORDER_STOCK_RESERVATION = True
+
+# 是否开启异步下单，开启时下单接口返回凭证，由celery下单任务保存订单，客户端轮询下单结果
+ORDER_ASYNC_MODE = False
+
+# 订单id生成器，以及当前节点的节点号(0~9999，不配置时每个进程启动后通过redis分配)
+ORDER_ID_GENERATOR = 'orders.utils.SnowflakeOrderIdGenerator'
+# ORDER_ID_NODE = 1
+
+# 下单时减少商品库存的策略
+# optimistic: 乐观锁重试 pessimistic: select for update conditional: update ... where stock>=n
+# group: 所有进程中并发订单对同一商品的库存减少合并为一条条件更新(组提交)，需要同时启用expire_stock_hold定时任务
+ORDER_STOCK_STRATEGY = 'conditional'
@@ -0,0 +1,102 @@
+# 接口请求幂等
+# 客户端在请求头Idempotency-Key中传递请求的唯一标识，重试或重复点击时使用相同的标识:
+# 1. 第一个请求在redis中用SET NX占位(pending)，执行视图之后把响应保存到redis中(done)，带有效期
+# 2. 重复的请求直接返回保存的响应；第一个请求还在执行时，等待其完成之后返回相同的响应
+# 重复请求不再执行视图，也就不会访问数据库
+# 未传递Idempotency-Key的请求不做处理
+import functools
+import hashlib
+import json
+import time
+
+from django_redis import get_redis_connection
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+# 请求头名称
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+# 保存响应的有效期(秒)
+IDEMPOTENCY_EXPIRES = 24 * 60 * 60
+# 请求执行中占位的有效期(秒)，执行请求的进程崩溃时，超过这个时间之后允许重新执行
+IDEMPOTENCY_PENDING_EXPIRES = 60
+# 重复请求等待第一个请求完成的最长时间(秒)，以及轮询间隔(秒)
+IDEMPOTENCY_WAIT_TIMEOUT = 10
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+
+
+def _fingerprint(request):
+    """请求的指纹，同一个Idempotency-Key只能用于相同的请求"""
+    data = json.dumps([request.method, request.path, request.query_params, request.data],
+                      cls=JSONEncoder, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _replay(record):
+    response = Response(record['data'], status=record['status'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(scope):
+    """
+    APIView请求处理方法的幂等装饰器
+    scope: 接口名称，不同接口的Idempotency-Key互不影响
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            idempotency_key = request.META.get(IDEMPOTENCY_HEADER)
+            if not idempotency_key:
+                return func(self, request, *args, **kwargs)
+
+            key = 'idempotency_%s_%s_%s' % (scope, request.user.id, idempotency_key[:128])
+            fingerprint = _fingerprint(request)
+            redis_conn = get_redis_connection('default')
+
+            deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+            while True:
+                # 1. 第一个请求占位
+                pending = json.dumps({'state': 'pending', 'fingerprint': fingerprint})
+                if redis_conn.set(key, pending, nx=True, ex=IDEMPOTENCY_PENDING_EXPIRES):
+                    break
+
+                # 2. 重复的请求: 返回保存的响应，或者等待第一个请求完成
+                value = redis_conn.get(key)
+                if value is not None:
+                    record = json.loads(value.decode())
+                    if record['fingerprint'] != fingerprint:
+                        return Response({'message': 'Idempotency-Key已用于其他请求'},
+                                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+                    if record['state'] == 'done':
+                        return _replay(record)
+
+                if time.time() > deadline:
+                    return Response({'message': '请求正在处理中'}, status=status.HTTP_409_CONFLICT)
+
+                time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+            # 3. 执行视图，保存响应；视图异常或服务器错误时删除占位，允许客户端重试
+            try:
+                response = func(self, request, *args, **kwargs)
+            except Exception:
+                redis_conn.delete(key)
+                raise
+
+            if response.status_code >= 500:
+                redis_conn.delete(key)
+                return response
+
+            record = {
+                'state': 'done',
+                'fingerprint': fingerprint,
+                'status': response.status_code,
+                'data': response.data
+            }
+            redis_conn.set(key, json.dumps(record, cls=JSONEncoder), ex=IDEMPOTENCY_EXPIRES)
+            return response
+
+        return wrapper
+
+    return decorator
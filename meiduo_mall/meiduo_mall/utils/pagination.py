@@ -1,4 +1,12 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class StandardResultPagination(PageNumberPagination):
@@ -9,3 +17,84 @@ class StandardResultPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     # 最大`页容量`
     max_page_size = 20
+
+
+class CreateTimeKeysetPagination(BasePagination):
+    """
+    按(create_time, <主键>)倒序的游标(keyset)分页类
+    下一页从上一页最后一条记录的(create_time, <主键>)之后开始查询，不需要COUNT和OFFSET，
+    每页只需要一次查询，翻页的耗时与页码无关
+    """
+    # 分页默认`页容量`
+    page_size = 10
+    # 获取分页数据时，传递`页容量`参数名称
+    page_size_query_param = 'page_size'
+    # 最大`页容量`
+    max_page_size = 20
+    # 传递游标的参数名称
+    cursor_query_param = 'cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return max(1, min(page_size, self.max_page_size))
+
+    @staticmethod
+    def encode_cursor(create_time, pk):
+        data = json.dumps([create_time.isoformat(), pk]).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            create_time, pk = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+            create_time = parse_datetime(create_time)
+        except (TypeError, ValueError):
+            raise NotFound('无效的游标')
+
+        if create_time is None:
+            raise NotFound('无效的游标')
+
+        return create_time, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        pk_name = queryset.model._meta.pk.name
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by('-create_time', '-%s' % pk_name)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            # where create_time < <t> or (create_time = <t> and <pk> < <pk>)
+            create_time, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(create_time__lt=create_time) | Q(create_time=create_time, **{'%s__lt' % pk_name: pk})
+            )
+
+        # 多查询一条记录判断是否还有下一页
+        page = list(queryset[:page_size + 1])
+
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            last = page[-1]
+            self.next_cursor = self.encode_cursor(last.create_time, getattr(last, pk_name))
+
+        self.request = request
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data
+        })
@@ -0,0 +1,99 @@
+# 生成的静态html文件的写入
+# 1. 计算页面内容的哈希值，与本机磁盘上文件的哈希值相同时不再写入，文件的修改时间不变，CDN和浏览器缓存继续有效
+#    每个节点都生成自己的文件，部署或检出可能替换磁盘上的文件，因此总是与本机的文件比较，而不是与清单比较
+# 2. 内容变化时先写入同目录下的临时文件并fsync，再用os.replace原子替换，nginx不会读到写了一半的文件
+# 3. 每个文件的哈希值、大小和写入时间记录在redis hash(static_html_manifest)中，只作为记录，可用于生成ETag和CDN刷新列表:
+# {
+#     '<相对于GENERATED_STATIC_HTML_FILES_DIR的路径>': '{"hash": <sha256>, "size": <字节数>, "time": <写入时间戳>}',
+#     ...
+# }
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+STATIC_HTML_MANIFEST_KEY = 'static_html_manifest'
+
+# 静态文件的权限，nginx需要能够读取
+STATIC_HTML_FILE_MODE = 0o644
+
+
+def _file_hash(path):
+    """计算已有文件内容的哈希值，文件不存在时返回None"""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _atomic_write(path, data):
+    """将data写入同目录下的临时文件并fsync，再原子替换path"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, STATIC_HTML_FILE_MODE)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    # 同步目录，保证替换操作本身落盘
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_static_html(relative_path, content):
+    """
+    将页面内容写入GENERATED_STATIC_HTML_FILES_DIR下的relative_path，内容没有变化时不写入
+    返回是否写入了文件
+    """
+    data = content.encode('utf8')
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(settings.GENERATED_STATIC_HTML_FILES_DIR, relative_path)
+
+    # 1. 与本机磁盘上的文件比较，内容相同时不写入
+    written = _file_hash(path) != digest
+
+    # 2. 原子写入文件
+    if written:
+        _atomic_write(path, data)
+
+    # 3. 在清单中记录文件当前的内容
+    redis_conn = get_redis_connection('default')
+    redis_conn.hset(STATIC_HTML_MANIFEST_KEY, relative_path, json.dumps({
+        'hash': digest, 'size': len(data), 'time': time.time() if written else os.path.getmtime(path)
+    }))
+    return written
+
+
+def get_static_html_manifest(relative_paths=None):
+    """
+    获取静态文件的清单，relative_paths为None时返回所有文件
+    返回: {
+        '<相对路径>': {'hash': <sha256>, 'size': <字节数>, 'time': <写入时间戳>},
+        ...
+    }
+    """
+    redis_conn = get_redis_connection('default')
+    if relative_paths is None:
+        items = redis_conn.hgetall(STATIC_HTML_MANIFEST_KEY).items()
+    else:
+        relative_paths = list(relative_paths)
+        if not relative_paths:
+            return {}
+        values = redis_conn.hmget(STATIC_HTML_MANIFEST_KEY, relative_paths)
+        items = [(path.encode(), value) for path, value in zip(relative_paths, values) if value is not None]
+
+    return {path.decode(): json.loads(value.decode()) for path, value in items}
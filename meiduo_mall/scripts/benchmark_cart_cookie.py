@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+
+# 将`scripts`上级目录添加到搜索包目录列表中
+import sys
+sys.path.insert(0, '../')
+
+# 对比cookie购物车新旧两种编码格式的编解码耗时和cookie大小
+import os
+# 设置Django运行所依赖环境变量
+if not os.getenv('DJANGO_SETTINGS_MODULE'):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'meiduo_mall.settings.dev'
+
+# 让Django进行一次初始化
+import django
+django.setup()
+
+import base64
+import pickle
+import random
+import timeit
+
+from cart import cookie_cart
+
+# 每种购物车大小的测试次数
+NUMBER = 2000
+
+
+def make_cart(size):
+    """生成包含size个商品的购物车数据"""
+    sku_ids = random.sample(range(1, 20000), size)
+    return {
+        sku_id: {
+            'count': random.randint(1, 20),
+            'selected': random.random() < 0.8
+        }
+        for sku_id in sku_ids
+    }
+
+
+def pickle_dumps(cart_dict):
+    return base64.b64encode(pickle.dumps(cart_dict)).decode()
+
+
+def pickle_loads(data):
+    return pickle.loads(base64.b64decode(data))
+
+
+def bench(dumps, loads, cart_dict):
+    """返回(cookie字节数, 编码耗时us, 解码耗时us)"""
+    data = dumps(cart_dict)
+    assert loads(data) == cart_dict
+
+    encode_time = timeit.timeit(lambda: dumps(cart_dict), number=NUMBER) / NUMBER * 10 ** 6
+    decode_time = timeit.timeit(lambda: loads(data), number=NUMBER) / NUMBER * 10 ** 6
+    return len(data), encode_time, decode_time
+
+
+if __name__ == "__main__":
+    random.seed(0)
+
+    print('%6s | %24s | %24s' % ('items', 'pickle+base64', 'varint+hmac'))
+    print('%6s | %8s %7s %7s | %8s %7s %7s' % ('', 'bytes', 'enc/us', 'dec/us', 'bytes', 'enc/us', 'dec/us'))
+
+    for size in (1, 5, 10, 20, 50, 100):
+        cart_dict = make_cart(size)
+        old = bench(pickle_dumps, pickle_loads, cart_dict)
+        new = bench(cookie_cart.dumps, cookie_cart.loads, cart_dict)
+        print('%6d | %8d %7.1f %7.1f | %8d %7.1f %7.1f' % ((size,) + old + new))
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+
+# 将`scripts`上级目录添加到搜索包目录列表中
+import sys
+sys.path.insert(0, '../')
+
+# 订单id生成器压力测试: 多个进程同时生成订单id，检查唯一性和单调性
+# 每个进程与线上一样通过redis租用节点号，同时运行的进程租用到的节点号必须互不相同
+# python stress_order_id.py [进程数] [每个进程生成的订单id数]
+import os
+# 设置Django运行所依赖环境变量
+if not os.getenv('DJANGO_SETTINGS_MODULE'):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'meiduo_mall.settings.dev'
+
+# 让Django进行一次初始化
+import django
+django.setup()
+
+import multiprocessing
+import time
+
+from orders.utils import SnowflakeOrderIdGenerator
+
+
+def worker(args):
+    """在一个进程中生成count个订单id，返回(节点号, 订单id列表, 是否严格递增, 耗时)"""
+    barrier, count = args
+    # 与线上一样通过redis租用节点号，不指定节点号
+    generator = SnowflakeOrderIdGenerator()
+
+    # 所有进程都租用到节点号之后再开始生成，保证各进程同时持有节点号
+    # 订单id的第18~21位是节点号
+    first = generator.generate()
+    node = int(first[17:21])
+    barrier.wait()
+
+    start = time.time()
+    order_ids = [first] + [generator.generate() for _ in range(count - 1)]
+    elapsed = time.time() - start
+
+    generator.release()
+
+    monotonic = all(a < b for a, b in zip(order_ids, order_ids[1:]))
+    return node, order_ids, monotonic, elapsed
+
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    # 每个任务在单独的进程中运行，同时持有租约
+    manager = multiprocessing.Manager()
+    barrier = manager.Barrier(processes)
+    with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+        results = pool.map(worker, [(barrier, count)] * processes, 1)
+
+    nodes = [result[0] for result in results]
+    print('租用的节点号: %s' % nodes)
+    assert len(set(nodes)) == len(nodes), '同时运行的进程租用到了相同的节点号'
+
+    all_ids = set()
+    total = 0
+    for node, order_ids, monotonic, elapsed in results:
+        total += len(order_ids)
+        all_ids.update(order_ids)
+        lengths = {len(order_id) for order_id in order_ids}
+        print('节点%s: 生成%s个，%.0f个/秒，严格递增: %s，长度: %s' % (
+            node, len(order_ids), len(order_ids) / elapsed, monotonic, lengths))
+        assert monotonic, '节点%s生成的订单id不是严格递增的' % node
+        assert lengths == {24}, '节点%s生成的订单id长度错误' % node
+
+    print('总数: %s，不重复: %s' % (total, len(all_ids)))
+    assert total == len(all_ids), '订单id存在重复'